@@ -1,10 +1,12 @@
 from tweepy.streaming import StreamListener
 from tweepy import OAuthHandler
 from tweepy import Stream, API
-from requests_futures.sessions import FuturesSession
 import time
 import threading
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from datetime import datetime
 import json
+import os
 import midori
 import re
 import requests
@@ -12,8 +14,14 @@ import sqlite3
 import logging
 logger = logging.getLogger(__name__)
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 ARCHIVE_TODAY_URL = "https://archive.is/submit/"
 CHANNEL = "#"
+STATUS_RE = re.compile("http(?:s)?://(?:www\\.|mobile\\.)?twitter.com/[a-z0-9\\-_]+/status(?:es)?/([0-9]+)")
 
 import HTMLParser
 HTML_PARSER = HTMLParser.HTMLParser()
@@ -22,102 +30,749 @@ def connect_db():
     connection = sqlite3.connect("archived_stuff.db", check_same_thread=False)
     connection.execute("PRAGMA journal_mode = WAL;")
     connection.execute("CREATE TABLE IF NOT EXISTS links (source TEXT, artoday TEXT)")
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(links)")]
+    if "archived" not in columns:
+        # rows from before this column existed never count as fresh
+        connection.execute("ALTER TABLE links ADD COLUMN archived REAL")
+    connection.execute("CREATE INDEX IF NOT EXISTS links_source ON links (source)")
+    connection.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, "
+                       "screen_name TEXT COLLATE NOCASE, fetched REAL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS users_screen_name ON users (screen_name)")
     connection.commit()
     return connection
 
+class DatabaseWriter(threading.Thread):
+    """Write-behind writer that owns the database's write connection.
+       Statements queued with write() are executed and committed in groups of
+       up to batch_size, or whatever arrived within batch_ms of the first one,
+       so a burst costs one commit instead of one per row. close() flushes
+       everything still queued."""
+    def __init__(self, batch_size=200, batch_ms=50):
+        super(DatabaseWriter, self).__init__()
+        self.daemon = 1
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.queue = queue.Queue()
+        self.rows_written = 0
+        self.batches = 0
+        self.max_latency = 0
+
+    def write(self, sql, params=()):
+        self.queue.put((time.time(), sql, params))
+
+    def run(self):
+        connection = connect_db()
+        stopping = 0
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.batch_ms / 1000.0
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = 1
+                    break
+                batch.append(item)
+            self.flush(connection, batch)
+        connection.close()
+
+    def flush(self, connection, batch):
+        try:
+            for queued, sql, params in batch:
+                connection.execute(sql, params)
+            connection.commit()
+        except sqlite3.Error:
+            logger.error("Dropped a batch of {0} database writes.".format(len(batch)), exc_info=1)
+            connection.rollback()
+            return
+        self.rows_written += len(batch)
+        self.batches += 1
+        self.max_latency = max(self.max_latency, time.time() - batch[0][0])
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+TwitterUser = namedtuple("TwitterUser", "id_str screen_name")
+RenderedTweet = namedtuple("RenderedTweet", "id_str screen_name text")
+
+class UserResolver(object):
+    """Resolves Twitter user ids and screen names.
+       Answers come from a TTLCache, then from the users table, and only then
+       from Twitter: lookups queued within window_ms of each other are sent
+       together through lookup_users, 100 per call. The batch is sent by a
+       timer, or by a caller still waiting for it when the window is over."""
+    LOOKUP_PARAMS = (("id", "user_ids"), ("name", "screen_names"))
+
+    def __init__(self, twapi, database, db_lock, db_writer, cache, ttl, call_later,
+                 window_ms=50, timeout=10):
+        self.twapi = twapi
+        self.call_later = call_later
+        self.database = database
+        self.db_lock = db_lock
+        self.db_writer = db_writer
+        self.cache = cache
+        self.ttl = ttl
+        self.window_ms = window_ms
+        self.timeout = timeout
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def by_name(self, name):
+        """Return the TwitterUser called name, or None."""
+        return self.resolve("name", [name.lower()]).get(name.lower())
+
+    def by_ids(self, ids, stale=0):
+        """Return TwitterUsers for the ids that exist, in order. With stale,
+           expired database rows are good enough."""
+        found = self.resolve("id", ids, stale=stale)
+        return [found[i] for i in ids if i in found]
+
+    def prefetch(self, ids):
+        """Make sure ids are cached, without waiting for Twitter."""
+        self.resolve("id", ids, wait=0)
+
+    def resolve(self, kind, keys, wait=1, stale=0):
+        found = {}
+        missing = []
+        for key in keys:
+            user = self.cache.get((kind, key)) or self.from_db(kind, key, stale)
+            if user:
+                found[key] = user
+            else:
+                missing.append(key)
+        slots = self.enqueue(kind, missing)
+        if wait:
+            deadline = time.time() + self.timeout
+            for key, slot in slots:
+                # the timer's flush needs a pool thread, and every one of them
+                # may be waiting here: once the window is over, flush ourselves
+                if not slot[0].wait(self.window_ms / 1000.0):
+                    self.flush()
+                slot[0].wait(max(0, deadline - time.time()))
+                if slot[1]:
+                    found[key] = slot[1]
+        return found
+
+    def from_db(self, kind, key, stale):
+        cutoff = 0 if stale else time.time() - self.ttl
+        column = "id" if kind == "id" else "screen_name"
+        with self.db_lock:
+            row = self.database.execute("SELECT id, screen_name FROM users WHERE {0} = ? "
+                                        "AND fetched > ?".format(column), (key, cutoff)).fetchone()
+        if row:
+            user = TwitterUser(*row)
+            self.cache.put(("id", user.id_str), user)
+            self.cache.put(("name", user.screen_name.lower()), user)
+            return user
+
+    def enqueue(self, kind, keys):
+        slots = []
+        with self.lock:
+            for key in keys:
+                slot = self.pending.get((kind, key))
+                if not slot:
+                    slot = self.pending[(kind, key)] = [threading.Event(), None]
+                slots.append((key, slot))
+            if self.pending and not self.timer:
+                self.timer = self.call_later(self.window_ms / 1000.0, self.flush)
+        return slots
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer:
+                self.timer.cancel()
+            self.timer = None
+        for kind, param in self.LOOKUP_PARAMS:
+            keys = [key for key_kind, key in pending if key_kind == kind]
+            for i in range(0, len(keys), 100):
+                try:
+                    users = self.twapi.lookup_users(**{param: keys[i:i + 100]})
+                except Exception:
+                    logger.debug("lookup_users failed.", exc_info=1)
+                    continue
+                for user in users:
+                    user = TwitterUser(user.id_str, user.screen_name)
+                    self.remember(user)
+                    for key in (("id", user.id_str), ("name", user.screen_name.lower())):
+                        if key in pending:
+                            pending[key][1] = user
+        for event, user in pending.values():
+            event.set()
+
+    def remember(self, user):
+        self.cache.put(("id", user.id_str), user)
+        self.cache.put(("name", user.screen_name.lower()), user)
+        self.db_writer.write("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                             (user.id_str, user.screen_name, time.time()))
+
+class FilterManager(object):
+    """Keeps the follow and silence lists as sets, saved to disk atomically.
+       Only changes to the follow set affect the stream filter; those call
+       restart() once no further change has come in for debounce seconds, so
+       a run of edits costs a single reconnect."""
+    def __init__(self, restart, call_later, debounce=5, follow_file="follows.json",
+                 silence_file="silence.json"):
+        self.restart = restart
+        self.call_later = call_later
+        self.debounce = debounce
+        self.follow_file = follow_file
+        self.silence_file = silence_file
+        self.timer = None
+        self.lock = threading.Lock()
+        self.mtimes = {}
+        self.changed(follow_file)
+        self.changed(silence_file)
+        self.follow_ids = self.load(follow_file)
+        self.silenced_ids = self.load(silence_file)
+
+    def load(self, filename):
+        try:
+            with open(filename, "r") as f:
+                return frozenset(json.load(f))
+        except (IOError, OSError, ValueError):
+            logger.info("Nothing loaded from {0}.".format(filename))
+            return frozenset()
+
+    def save(self, filename, ids):
+        with open(filename + ".tmp", "w") as f:
+            json.dump(sorted(ids), f)
+        os.rename(filename + ".tmp", filename)
+        self.changed(filename)
+
+    def changed(self, filename):
+        """[internal] Returns true if filename was modified since the last call."""
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        previous, self.mtimes[filename] = self.mtimes.get(filename), mtime
+        return previous != mtime
+
+    def refresh(self):
+        """Pick up lists saved by another process, eg another shard."""
+        with self.lock:
+            if self.changed(self.silence_file):
+                self.silenced_ids = self.load(self.silence_file)
+            if self.changed(self.follow_file):
+                follow_ids = self.load(self.follow_file)
+                if follow_ids != self.follow_ids:
+                    self.follow_ids = follow_ids
+                    self.schedule_restart()
+
+    # the sets are replaced, never mutated, so readers on other threads
+    # can iterate them safely
+
+    def follow(self, user_id):
+        return self.update("follow_ids", self.follow_file, user_id, 1)
+
+    def unfollow(self, user_id):
+        return self.update("follow_ids", self.follow_file, user_id, 0)
+
+    def silence(self, user_id):
+        return self.update("silenced_ids", self.silence_file, user_id, 1)
+
+    def unsilence(self, user_id):
+        return self.update("silenced_ids", self.silence_file, user_id, 0)
+
+    def update(self, attr, filename, user_id, add):
+        """Returns false if the list was already in the requested state."""
+        with self.lock:
+            ids = getattr(self, attr)
+            if (user_id in ids) == bool(add):
+                return 0
+            ids = ids | frozenset([user_id]) if add else ids - frozenset([user_id])
+            setattr(self, attr, ids)
+            self.save(filename, ids)
+            if attr == "follow_ids":
+                self.schedule_restart()
+        return 1
+
+    def schedule_restart(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.call_later(self.debounce, self.restart)
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+
+class StatusIntake(object):
+    """Bounded queue between the stream thread and IRC.
+       The stream thread only enqueues; a consumer thread formats and sends.
+       Once the queue is half full it is backlogged, and policy decides what
+       gives first:
+         - "drop_archive": tweets are still posted, but not archived.
+         - "summarize": everything queued is collapsed into one line per author.
+         - "shed": new tweets are dropped until the backlog clears.
+       A full queue always drops new tweets."""
+    POLICIES = ("drop_archive", "summarize", "shed")
+
+    def __init__(self, handle, summarize, maxsize=200, policy="drop_archive"):
+        if policy not in self.POLICIES:
+            logger.warn("Unknown intake policy {0}, using drop_archive.".format(policy))
+            policy = "drop_archive"
+        self.handle = handle
+        self.summarize = summarize
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.received = 0
+        self.dropped = 0
+        self.unarchived = 0
+        self.summarized = 0
+        self.lag = 0
+        self.max_lag = 0
+        self.thread = threading.Thread(target=self.run, name="StatusIntake")
+        self.thread.daemon = 1
+        self.thread.start()
+
+    def backlogged(self):
+        return self.queue.qsize() >= self.maxsize // 2
+
+    def offer(self, tweet):
+        """Called on the stream thread. Never blocks."""
+        self.received += 1
+        if self.policy == "shed" and self.backlogged():
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait((time.time(), tweet))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            backlogged = self.backlogged()
+            if backlogged and self.policy == "summarize":
+                self.drain(item)
+                continue
+            self.note_lag(item[0])
+            try:
+                self.handle(item[1], archive=not backlogged)
+            except Exception:
+                logger.error("Exception handling a tweet.", exc_info=1)
+            if backlogged:
+                self.unarchived += 1
+
+    def drain(self, item):
+        """Collapse everything queued right now into one line per author."""
+        by_author = OrderedDict()
+        while item is not None:
+            self.note_lag(item[0])
+            by_author.setdefault(item[1].author.id_str, []).append(item[1])
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                item = None
+        for tweets in by_author.values():
+            try:
+                if len(tweets) == 1:
+                    self.handle(tweets[0], archive=0)
+                else:
+                    self.summarize(tweets)
+                    self.summarized += len(tweets)
+            except Exception:
+                logger.error("Exception handling a tweet.", exc_info=1)
+
+    def note_lag(self, queued):
+        self.lag = time.time() - queued
+        self.max_lag = max(self.max_lag, self.lag)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "received": self.received,
+            "dropped": self.dropped,
+            "unarchived": self.unarchived,
+            "summarized": self.summarized,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
+
+    def close(self):
+        # the consumer may be stuck behind a full queue; make room for the sentinel
+        while 1:
+            try:
+                self.queue.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+        self.thread.join(5)
+
 def authenticate(cfg):
     auth = OAuthHandler(cfg["consumer_key"], cfg["consumer_secret"])
     auth.set_access_token(cfg["access_token"], cfg["access_token_secret"])
     return auth
 
+class ArchiveJob(object):
+    """One URL being archived. Requests are fired off with callbacks; when all
+       of them have answered, callback(url, links) is called on whichever
+       thread delivered the last response."""
+    def __init__(self, url, callback, tweet=0):
+        self.url = url
+        self.callback = callback
+        self.tweet = tweet
+        self.lock = threading.Lock()
+
+    def start(self, session, done):
+        self.done = done
+        calls = [(session.post(ARCHIVE_TODAY_URL, data={
+            "url": self.url,
+        }, headers={
+            "Referer": "https://archive.is",
+        }, verify=True, allow_redirects=False), self.parse_archive_today)]
+
+        if self.tweet:
+            calls.insert(0, (session.get("http://tweetsave.com/api.php?mode=save&tweet=", params={
+                "mode": "save",
+                "tweet": self.url
+            }), self.parse_tweetsave))
+        else:
+            # blackhole archive; todo: put it in db
+            session.head("http://web.archive.org/save/{0}".format(self.url), headers={
+                "Referer": "https://archive.org/web/"
+            })
+
+        self.results = [None] * len(calls)
+        self.pending = len(calls)
+        for i, (future, parse) in enumerate(calls):
+            future.add_done_callback(lambda f, i=i, parse=parse: self.on_response(f, i, parse))
+
+    def parse_archive_today(self, response):
+        if "Refresh" in response.headers:
+            return response.headers["Refresh"][6:]
+        elif "Location" in response.headers:
+            return response.headers["Location"]
+
+    def parse_tweetsave(self, response):
+        payload = response.json()
+        if "redirect" in payload and payload["status"] == "OK":
+            return payload["redirect"]
+
+    def on_response(self, future, i, parse):
+        try:
+            self.results[i] = parse(future.result())
+        except Exception:
+            logger.debug("Archive request for {0} failed.".format(self.url), exc_info=1)
+        with self.lock:
+            self.pending -= 1
+            if self.pending:
+                return
+        try:
+            self.callback(self.url, [link for link in self.results if link])
+        except Exception:
+            logger.error("Exception in archive callback for {0}".format(self.url), exc_info=1)
+        finally:
+            self.done(self)
+
+class TTLCache(object):
+    """Least-recently-used cache whose entries also expire after ttl seconds."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                stored, value = self.entries.pop(key)
+            except KeyError:
+                return default
+            if time.time() - stored > self.ttl:
+                return default
+            self.entries[key] = (stored, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class ArchivePipeline(object):
+    """Archives URLs without ever blocking the submitter.
+       Recent results come from cache (then from lookup(url), normally the
+       database) and are returned immediately. Concurrent submissions of the
+       same URL share one job. At most max_inflight jobs talk to the archives
+       at once; the rest wait in a backlog of at most max_backlog jobs, and
+       submit() returns false when both are full. New results are passed to
+       store(url, links)."""
+    def __init__(self, session, max_inflight=4, max_backlog=100, cache=None,
+                 lookup=None, store=None):
+        self.session = session
+        self.max_inflight = max_inflight
+        self.max_backlog = max_backlog
+        self.cache = cache
+        self.lookup = lookup
+        self.store = store
+        self.inflight = 0
+        self.backlog = deque()
+        self.waiting = {}
+        self.lock = threading.Lock()
+
+    def submit(self, url, callback, tweet=0):
+        """Archive url, then call callback(url, links) from whichever thread
+           finished the job (or from this one, on a cache hit)."""
+        key = (url, tweet)
+        links = self.cache.get(key) if self.cache else None
+        if links is None and self.lookup:
+            links = self.lookup(url) or None
+            if links and self.cache:
+                self.cache.put(key, links)
+        if links is not None:
+            callback(url, links)
+            return 1
+
+        with self.lock:
+            if key in self.waiting:
+                self.waiting[key].append(callback)
+                return 1
+            job = ArchiveJob(url, lambda url, links: self.complete(key, links), tweet)
+            if self.inflight >= self.max_inflight:
+                if len(self.backlog) >= self.max_backlog:
+                    return 0
+                self.backlog.append(job)
+                self.waiting[key] = [callback]
+                return 1
+            self.inflight += 1
+            self.waiting[key] = [callback]
+        self.run(job)
+        return 1
+
+    def complete(self, key, links):
+        with self.lock:
+            callbacks = self.waiting.pop(key, [])
+        if links:
+            if self.cache:
+                self.cache.put(key, links)
+            if self.store:
+                self.store(key[0], links)
+        for callback in callbacks:
+            try:
+                callback(key[0], links)
+            except Exception:
+                logger.error("Exception in archive callback for {0}".format(key[0]), exc_info=1)
+
+    def run(self, job):
+        try:
+            job.start(self.session, self.finished)
+        except Exception:
+            logger.error("Cannot submit {0} for archival.".format(job.url), exc_info=1)
+            job.callback(job.url, [])
+            self.finished(job)
+
+    def finished(self, job):
+        with self.lock:
+            if not self.backlog:
+                self.inflight -= 1
+                return
+            job = self.backlog.popleft()
+        self.run(job)
+
+class Backoff(object):
+    """Reconnect delay that grows from start towards limit, by adding step or
+       multiplying by factor after every failure."""
+    def __init__(self, start, limit, step=0, factor=1):
+        self.start = start
+        self.limit = limit
+        self.step = step
+        self.factor = factor
+        self.reset()
+
+    def reset(self):
+        self.current = self.start
+
+    def next(self):
+        delay = self.current
+        self.current = min(self.limit, self.current * self.factor + self.step)
+        return delay
+
 class StreamThread(threading.Thread):
-    def __init__(self, listener):
+    """Supervises the connection to the streaming API.
+       The listener reports why a connection ended through report(); each kind
+       of failure backs off on its own schedule (following Twitter's
+       reconnection guidelines), and every backoff resets once a connection
+       is healthy again. A connection that goes quiet for longer than
+       keepalive_timeout (Twitter sends keep-alives every 30 seconds) counts as
+       stalled and is dropped."""
+    def __init__(self, listener, keepalive_timeout=90):
         super(StreamThread, self).__init__()
         self.listener = listener
-        self.exit = 0
+        self.keepalive_timeout = keepalive_timeout
+        self.stopping = threading.Event()
+        self.stream = None
+        self.failure = None
+        self.backoffs = {
+            "network": Backoff(0.25, 16, step=0.25),
+            "stall": Backoff(0.25, 16, step=0.25),
+            "http": Backoff(5, 320, factor=2),
+            "rate_limited": Backoff(60, 960, factor=2),
+            "restart": Backoff(0, 0),
+        }
+        self.reconnects = defaultdict(int)
+        self.connected_at = None
+        self.last_delivery = None
+        self.delivery_lag = None
 
     def run(self):
-        while not self.exit:
+        while not self.stopping.is_set():
             logger.info("connecting to twitter...")
-            self.stream = Stream(self.listener.auth, self.listener)
-            self.stream.filter(follow=self.listener.follow_ids)
-            if not self.exit:
-                time.sleep(5)
+            self.failure = None
+            self.stream = Stream(self.listener.auth, self.listener,
+                                 timeout=self.keepalive_timeout)
+            try:
+                self.stream.filter(follow=list(self.listener.filters.follow_ids))
+            except Exception as e:
+                logger.warn("Twitter stream failed: {0}".format(e))
+            self.connected_at = None
+            if self.stopping.is_set():
+                break
+            kind = self.failure[0] if self.failure else "network"
+            self.reconnects[kind] += 1
+            delay = self.backoffs[kind].next()
+            logger.info("Reconnecting to twitter in {0}s ({1}).".format(delay, kind))
+            self.stopping.wait(delay)
+
+    def report(self, kind, detail=None):
+        """Record why the current connection is about to end."""
+        if not self.failure:
+            self.failure = (kind, detail)
+
+    def connected(self):
+        if self.connected_at is None:
+            self.connected_at = time.time()
+            for backoff in self.backoffs.values():
+                backoff.reset()
+
+    def delivered(self, tweet):
+        self.connected()
+        self.last_delivery = time.time()
+        created_at = getattr(tweet, "created_at", None)
+        if created_at:
+            self.delivery_lag = (datetime.utcnow() - created_at).total_seconds()
+
+    def reconnect(self):
+        """Drop the connection and reconnect at once, eg. with a new filter."""
+        self.report("restart")
+        if self.stream:
+            self.stream.disconnect()
+
+    def stats(self):
+        now = time.time()
+        return {
+            "connected": self.connected_at is not None,
+            "uptime": now - self.connected_at if self.connected_at else 0,
+            "reconnects": dict(self.reconnects),
+            "last_failure": self.failure,
+            "since_last_delivery": now - self.last_delivery if self.last_delivery else None,
+            "delivery_lag": self.delivery_lag,
+        }
 
     def stop(self):
-        self.exit = 1
-        self.stream.disconnect()
+        self.stopping.set()
+        if self.stream:
+            self.stream.disconnect()
 
 class TweetStream(StreamListener):
     def __init__(self, api, cfg):
         super(TweetStream, self).__init__()
-        self.gsession = FuturesSession(max_workers=10)
-
         self.mapi = api
         self.cfg = cfg
+        self.sthread = None
+        self.filter_others = 1
         self.install_hooks()
 
-        self.auth = authenticate(cfg)
+    def start(self):
+        # slow setup runs on the pool, after IRC has started connecting
+        self.archiver = ArchivePipeline(self.mapi.http,
+                                        self.cfg.get("archive_inflight", 4),
+                                        self.cfg.get("archive_backlog", 100),
+                                        TTLCache(self.cfg.get("archive_cache_size", 512),
+                                                 self.cfg.get("archive_cache_ttl", 3600)),
+                                        self.m_lookup_links, self.m_store_links)
+
+        self.auth = authenticate(self.cfg)
         self.twapi = API(auth_handler=self.auth)
-        self.id_cache = {}
 
-        self.load_following()
-        self.database = connect_db()
+        self.filters = self.mapi.track_resource(FilterManager(
+            self.restart_stream, self.mapi.call_later, self.cfg.get("filter_debounce", 5)))
+        # reads go through this connection, writes through the writer thread's
+        self.database = self.mapi.track_resource(connect_db())
         self.db_lock = threading.RLock()
-
-        self.sthread = None
-        self.filter_others = 1
+        self.db_writer = self.mapi.track_resource(DatabaseWriter(
+            self.cfg.get("db_batch_size", 200), self.cfg.get("db_batch_ms", 50)))
+        self.db_writer.start()
+
+        user_ttl = self.cfg.get("user_cache_ttl", 86400)
+        self.users = UserResolver(self.twapi, self.database, self.db_lock, self.db_writer,
+                                  TTLCache(self.cfg.get("user_cache_size", 10000), user_ttl),
+                                  user_ttl, self.mapi.call_later)
+        self.users.prefetch(list(self.filters.follow_ids | self.filters.silenced_ids))
+        self.tweet_cache = TTLCache(self.cfg.get("tweet_cache_size", 1024),
+                                    self.cfg.get("tweet_cache_ttl", 3600))
+        self.intake = self.mapi.track_resource(StatusIntake(
+            self.m_push_status, self.m_push_summary,
+            self.cfg.get("intake_size", 200), self.cfg.get("intake_overflow", "drop_archive")))
+        self.mapi.register_stats("twitter.intake", self.intake.stats)
+
+        if self.mapi.get_instance().config("shards.count", 0):
+            # every shard takes commands, but only the primary one streams
+            self.mapi.call_every(self.cfg.get("filter_debounce", 5), self.filters.refresh)
         self.restart_stream()
 
     def install_hooks(self):
         self.mapi.hook_raw("KICK", self.on_kick)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_follow,
-                              predicate=lambda cmd: cmd.message.startswith("*follow"))
+                              predicate=lambda cmd: cmd.command == "*follow", cost=2)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_unfollow,
-                              predicate=lambda cmd: cmd.message.startswith("*ufollow"))
+                              predicate=lambda cmd: cmd.command == "*ufollow", cost=2)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_silence,
-                              predicate=lambda cmd: cmd.message.startswith("*silence"))
+                              predicate=lambda cmd: cmd.command == "*silence", cost=2)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_usilence,
-                              predicate=lambda cmd: cmd.message.startswith("*usilence"))
+                              predicate=lambda cmd: cmd.command == "*usilence", cost=2)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_spamon,
-                              predicate=lambda cmd: cmd.message.startswith("*nofilter"))
+                              predicate=lambda cmd: cmd.command == "*nofilter", cost=1)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_spamoff,
-                              predicate=lambda cmd: cmd.message.startswith("*yesfilter"))
+                              predicate=lambda cmd: cmd.command == "*yesfilter", cost=1)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_arc,
-                              predicate=lambda cmd: cmd.message.startswith("*arc"))
+                              predicate=lambda cmd: cmd.command == "*arc", cost=3)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_disgnostic,
-                              predicate=lambda cmd: cmd.message.startswith("*diagnostics"))
+                              predicate=lambda cmd: cmd.command == "*diagnostics", cost=2)
         self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_helpinfo,
-                              predicate=lambda cmd: cmd.message.startswith("*help"))
-        self.mapi.hook_command(midori.CONTEXT_CHANNEL, self.api_get_tweet)
-
-    def load_following(self):
-        try:
-            with open("follows.json", "r") as f:
-                self.follow_ids = json.load(f)
-        except:
-            print("No following.")
-            self.follow_ids = []
-
-        try:
-            with open("silence.json", "r") as f:
-                self.silenced_ids = json.load(f)
-        except:
-            print("No silenced.")
-            self.silenced_ids = []
-
-    def save_follows(self):
-        with open("follows.json", "w") as f:
-            json.dump(self.follow_ids, f)
-        with open("silence.json", "w") as f:
-            json.dump(self.silenced_ids, f)
+                              predicate=lambda cmd: cmd.command == "*help", cost=1)
+        self.mapi.hook_url("twitter.com", self.api_get_tweet, midori.CONTEXT_CHANNEL, cost=2)
 
     def restart_stream(self):
+        if not self.mapi.is_primary():
+            return
         if self.sthread:
-            self.sthread.stop()
-        self.sthread = StreamThread(self)
+            self.sthread.reconnect()
+            return
+        self.sthread = self.mapi.track_thread(StreamThread(
+            self, self.cfg.get("stream_keepalive_timeout", 90)))
         self.sthread.daemon = 1
         self.sthread.start()
+        self.mapi.register_stats("twitter.stream", self.sthread.stats)
+
+    def unload(self):
+        if self.sthread:
+            self.sthread.stop()
 
     def api_helpinfo(self, cmd):
         self.mapi.privmsg(cmd.channel, "To show twitter user's tweets: *follow user | Top stop showing twitter user's tweets *ufollow user | To archive.today (and attempt waybacking behind the scenes ) something *arc URL")
@@ -126,51 +781,36 @@ class TweetStream(StreamListener):
         user = self.m_get_userid(cmd.message[8:].strip())
         if not user: #or cmd.channel.name != "#nasa_surveilance_van_no.7":
             self.mapi.privmsg(cmd.channel, "An argument is required (*follow user)")
+        elif not self.filters.follow(user):
+            self.mapi.privmsg(cmd.channel, "Already in list.")
         else:
-            self.follow_ids.append(user)
-            self.save_follows()
-            self.mapi.privmsg(cmd.channel, "Added to the stalking list. Restarting stream...")
-            self.restart_stream()
+            self.mapi.privmsg(cmd.channel, "Added to the stalking list. The stream will restart shortly.")
 
     def api_unfollow(self, cmd):
         user = self.m_get_userid(cmd.message[9:].strip())
         if not user: #or cmd.channel.name != "#nasa_surveilance_van_no.7":
             self.mapi.privmsg(cmd.channel, "An argument is required (*ufollow user)")
+        elif not self.filters.unfollow(user):
+            self.mapi.privmsg(cmd.channel, "Not in list.")
         else:
-            try:
-                int(user)
-                self.follow_ids.remove(user)
-            except ValueError:
-                self.mapi.privmsg(cmd.channel, "Not in list.")
-            else:
-                self.save_follows()
-                self.mapi.privmsg(cmd.channel, "Removed from the stalking list. Restarting stream...")
-                self.restart_stream()
+            self.mapi.privmsg(cmd.channel, "Removed from the stalking list. The stream will restart shortly.")
 
     def api_silence(self, cmd):
         user = self.m_get_userid(cmd.message[9:].strip())
         if not user: #or cmd.channel.name != "#nasa_surveilance_van_no.7":
             self.mapi.privmsg(cmd.channel, "An argument is required (*silence user)")
         else:
-            self.silenced_ids.append(user)
-            self.save_follows()
+            self.filters.silence(user)
             self.mapi.privmsg(cmd.channel, "Silenced. Use '*usilence <name>' to un-silence later.")
-            self.restart_stream()
 
     def api_usilence(self, cmd):
         user = self.m_get_userid(cmd.message[10:].strip())
         if not user: #or cmd.channel.name != "#nasa_surveilance_van_no.7":
             self.mapi.privmsg(cmd.channel, "An argument is required (*usilence user)")
+        elif not self.filters.unsilence(user):
+            self.mapi.privmsg(cmd.channel, "Not in list.")
         else:
-            try:
-                int(user)
-                self.silenced_ids.remove(user)
-            except ValueError:
-                self.mapi.privmsg(cmd.channel, "Not in list.")
-            else:
-                self.save_follows()
-                self.mapi.privmsg(cmd.channel, "Un-silenced.")
-                self.restart_stream()
+            self.mapi.privmsg(cmd.channel, "Un-silenced.")
 
     def api_spamon(self, cmd):
         self.filter_others = 0
@@ -179,27 +819,26 @@ class TweetStream(StreamListener):
         self.filter_others = 1
 
     def api_get_tweet(self, cmd):
-        statuses = re.findall("http(?:s)?://twitter.com/[a-z0-9\\-_]+/status(?:es)?/([0-9]+)",
-                              cmd.message.lower())
+        statuses = OrderedDict()
+        for url in cmd.urls_on("twitter.com"):
+            match = STATUS_RE.match(url.lower())
+            if match:
+                statuses[match.group(1)] = 1
+        statuses = list(statuses)
         if not statuses:
             return
-        statuses = set(statuses)
 
-        for id_ in statuses:
-            try:
-                tweet = self.twapi.get_status(id=id_)
-            except:
-                continue
-
-            the_url = "https://twitter.com/{0}/status/{1}".format(tweet.author.screen_name, tweet.id_str)
-            urls = self.m_tweet_archive_sync(the_url)
-            self.midori_push(tweet, urls, cmd.channel)
+        for tweet in self.m_fetch_tweets(statuses):
+            the_url = "https://twitter.com/{0}/status/{1}".format(tweet.screen_name, tweet.id_str)
+            if not self.m_archive_tweet(the_url, lambda url, links, tweet=tweet:
+                                        self.midori_push(tweet, links, cmd.channel, api=cmd.api)):
+                self.midori_push(tweet, None, cmd.channel, the_url, cmd.api)
 
     def api_arc(self, cmd):
         to_arc = cmd.message[4:].strip()
         to_arc = to_arc.split(" ", 1)[0]
 
-        if re.match("http(?:s)?://twitter.com/[a-z0-9\\-_]+/status(?:es)?/([0-9]+)", to_arc):
+        if STATUS_RE.match(to_arc):
             self.mapi.privmsg(cmd.channel, "Simply linking a tweet is enough to get it archived.")
             return
 
@@ -207,153 +846,155 @@ class TweetStream(StreamListener):
             self.mapi.privmsg(cmd.channel, "An argument is required. (*arc https://example.com...)")
             return
 
-        links = self.m_archive_sync(to_arc)
-        if links:
-            self.mapi.privmsg(cmd.channel, "{0}: {1}".format(cmd.sender.nick, ", ".join(links)))
-        else:
-            self.mapi.privmsg(cmd.channel, "Archive failed; probably an invalid URL.")
+        # runs on an HTTP thread, so answer on the network the request came from
+        def reply(url, links):
+            if links:
+                cmd.api.privmsg(cmd.channel, "{0}: {1}".format(cmd.sender.nick, ", ".join(links)))
+            else:
+                cmd.api.privmsg(cmd.channel, "Archive failed; probably an invalid URL.")
+
+        if not self.m_archive(to_arc, reply):
+            self.mapi.privmsg(cmd.channel, "Too many archive requests right now, try again later.")
 
     def api_disgnostic(self, cmd):
         if cmd.sender.hostmask != self.cfg["owner_host"]:
             self.mapi.notice(cmd.sender, "You need to authenticate with your NASA employee ID and passphrase before doing that.")
         else:
-            self.mapi.notice(cmd.sender, "{0}".format(str(self.follow_ids)))
-            ul = self.m_convert_ids_to_users(self.follow_ids)
+            follow_ids = sorted(self.filters.follow_ids)
+            self.mapi.notice(cmd.sender, "{0}".format(str(follow_ids)))
+            ul = self.users.by_ids(follow_ids, stale=1)
             self.mapi.notice(cmd.sender, "{0}".format(str([u.screen_name for u in ul])))
 
-            self.mapi.notice(cmd.sender, "{0}".format(str(self.silenced_ids)))
-            ul = self.m_convert_ids_to_users(self.silenced_ids)
+            silenced_ids = sorted(self.filters.silenced_ids)
+            self.mapi.notice(cmd.sender, "{0}".format(str(silenced_ids)))
+            ul = self.users.by_ids(silenced_ids, stale=1)
             self.mapi.notice(cmd.sender, "{0}".format(str([u.screen_name for u in ul])))
 
+    def home(self):
+        """API of the network the stream is announced on."""
+        return self.mapi.get_network(self.cfg.get("network"))
+
     def on_kick(self, command):
-        if command.args[1] == self.mapi.nick and command.args[0] == self.cfg["channel"]:
-            self.mapi.join(self.cfg["channel"])
+        if (command.api is self.home() and command.args[1] == command.api.nick
+                and command.args[0] == self.cfg["channel"]):
+            command.api.join(self.cfg["channel"])
 
-    def m_archive_sync(self, url):
-        future_at = self.gsession.post(ARCHIVE_TODAY_URL, data={
-            "url": url,
-        }, headers={
-            "Referer": "https://archive.is",
-            "Connection": "close",
-        }, timeout=30, verify=True, allow_redirects=False)
-
-        #future_pe = self.gsession.post("http://www.peeep.us/upload.php", data={
-        #    "r_url": url,
-        #}, headers={
-        #    "Content-Type": "application/x-www-form-urlencoded",
-        #}, timeout=30, allow_redirects=False)
-
-        # blackhole archive; todo: put it in db
-        self.gsession.head("http://web.archive.org/save/{0}".format(url), headers={
-            "Referer": "https://archive.org/web/"
-        }, timeout=30)
-
-        response_at = future_at.result()
-        #response_pe = future_pe.result()
-
-        arc_url = []
-        if "Refresh" in response_at.headers:
-            arc_url.append(response_at.headers["Refresh"][6:])
-            with self.db_lock:
-                self.database.execute("INSERT INTO links VALUES (?, ?)", (url, response_at.headers["Refresh"][6:]))
-                self.database.commit()
-        elif "Location" in response_at.headers:
-            arc_url.append(response_at.headers["Location"])
-            with self.db_lock:
-                self.database.execute("INSERT INTO links VALUES (?, ?)", (url, response_at.headers["Location"]))
-                self.database.commit()
-
-        #if "Location" in response_pe.headers:
-        #    arc_url.append("http://peeep.us" + response_pe.headers["Location"])
-        #    with self.db_lock:
-        #        self.database.execute("INSERT INTO links VALUES (?, ?)", (url, "http://peeep.us" + response_pe.headers["Location"]))
-        #        self.database.commit()
-
-        return arc_url or None
-
-    def m_tweet_archive_sync(self, url):
-        future_at = self.gsession.post(ARCHIVE_TODAY_URL, data={
-            "url": url,
-        }, headers={
-            "Referer": "https://archive.is",
-            "Connection": "close",
-        }, timeout=30, verify=True, allow_redirects=False)
+    def m_archive(self, url, callback):
+        """Archive url in the background, then call callback(url, links).
+           Returns false if the pipeline is full."""
+        return self.archiver.submit(url, callback)
 
-        future_ts = self.gsession.get("http://tweetsave.com/api.php?mode=save&tweet=", params={
-            "mode": "save",
-            "tweet": url
-        }, timeout=30)
+    def m_archive_tweet(self, url, callback):
+        return self.archiver.submit(url, callback, tweet=1)
 
-        response = future_ts.result()
-        response_at = future_at.result()
+    def m_lookup_links(self, url):
+        cutoff = time.time() - self.cfg.get("archive_cache_ttl", 3600)
+        with self.db_lock:
+            rows = self.database.execute("SELECT artoday FROM links WHERE source = ? "
+                                         "AND archived > ? ORDER BY rowid", (url, cutoff))
+            return [row[0] for row in rows]
 
-        arc_url = []
-        try:
-            payload = response.json()
-            if "redirect" in payload and payload["status"] == "OK":
-                arc_url.append(payload["redirect"])
-                with self.db_lock:
-                    self.database.execute("INSERT INTO links VALUES (?, ?)", (url, payload["redirect"]))
-                    self.database.commit()
-        except:
-            pass
-
-        if "Refresh" in response_at.headers:
-            arc_url.append(response_at.headers["Refresh"][6:])
-            with self.db_lock:
-                self.database.execute("INSERT INTO links VALUES (?, ?)", (url, response_at.headers["Refresh"][6:]))
-                self.database.commit()
-        elif "Location" in response_at.headers:
-            arc_url.append(response_at.headers["Location"])
-            with self.db_lock:
-                self.database.execute("INSERT INTO links VALUES (?, ?)", (url, response_at.headers["Location"]))
-                self.database.commit()
-
-        return arc_url
-
-    def m_convert_ids_to_users(self, l):
-        return self.twapi.lookup_users(user_ids=l)
+    def m_store_links(self, url, links):
+        for link in links:
+            self.db_writer.write("INSERT INTO links VALUES (?, ?, ?)", (url, link, time.time()))
 
     def m_get_userid(self, name):
-        name = name.lower()
-        if name in self.id_cache:
-            return self.id_cache[name]
-        else:
-            try:
-                user = self.twapi.get_user(screen_name=name)
-            except:
-                return None
-            self.id_cache[name] = user.id_str
-            return user.id_str
-
-    def midori_push(self, tweet, arc, channel, the_url=None):
-        tw = HTML_PARSER.unescape(tweet.text).replace("\n", " ")
-        for url in tweet.entities["urls"]:
-            tw = tw.replace(url["url"], url["expanded_url"])
+        user = self.users.by_name(name)
+        return user.id_str if user else None
+
+    def m_fetch_tweets(self, ids):
+        """Return RenderedTweets for the status ids that exist, from cache or
+           from a single bulk lookup."""
+        found = dict((id_, self.tweet_cache.get(id_)) for id_ in ids)
+        missing = [id_ for id_ in ids if not found[id_]]
+        lookup = getattr(self.twapi, "statuses_lookup", None)
+        if missing and lookup:
+            for i in range(0, len(missing), 100):
+                try:
+                    tweets = lookup(missing[i:i + 100])
+                except Exception:
+                    logger.debug("statuses_lookup failed.", exc_info=1)
+                    continue
+                for tweet in tweets:
+                    found[tweet.id_str] = self.render(tweet)
+        elif missing:
+            # older tweepy has no bulk endpoint
+            for id_ in missing:
+                try:
+                    found[id_] = self.render(self.twapi.get_status(id=id_))
+                except:
+                    continue
+        return [found[id_] for id_ in ids if found.get(id_)]
+
+    def render(self, tweet):
+        if isinstance(tweet, RenderedTweet):
+            return tweet
+        rendered = self.tweet_cache.get(tweet.id_str)
+        if not rendered:
+            tw = HTML_PARSER.unescape(tweet.text).replace("\n", " ")
+            for url in tweet.entities["urls"]:
+                tw = tw.replace(url["url"], url["expanded_url"])
+            rendered = RenderedTweet(tweet.id_str, tweet.author.screen_name, tw)
+            self.tweet_cache.put(tweet.id_str, rendered)
+        return rendered
+
+    def midori_push(self, tweet, arc, channel, the_url=None, api=None):
+        tweet = self.render(tweet)
         if arc:
             text = (u"@{0}: \"{1}\" {3}({2})".format(
-                    tweet.author.screen_name, tw, ", ".join(arc),
+                    tweet.screen_name, tweet.text, ", ".join(arc),
                     "({0}) ".format(the_url) if the_url else ""))
         else:
             text = (u"@{0}: \"{1}\" ({2})".format(
-                    tweet.author.screen_name, tw, the_url))
-        self.mapi.privmsg(channel, text)
+                    tweet.screen_name, tweet.text, the_url))
+        (api or self.home()).privmsg(channel, text)
+
+    def on_connect(self):
+        self.sthread.connected()
+
+    def on_error(self, status_code):
+        logger.warn("Twitter stream returned HTTP {0}.".format(status_code))
+        self.sthread.report("rate_limited" if status_code in (420, 429) else "http", status_code)
+        # let the supervisor decide when to retry
+        return False
+
+    def on_timeout(self):
+        logger.warn("Twitter stream stalled.")
+        self.sthread.report("stall")
+        return False
 
     def on_status(self, tweet):
-        if self.filter_others and tweet.author.id_str not in self.follow_ids:
+        self.sthread.delivered(tweet)
+        if self.filter_others and tweet.author.id_str not in self.filters.follow_ids:
             return True
+        # this is the stream's intake thread; anything slow happens on the consumer
+        self.intake.offer(tweet)
+        return True
+
+    def m_push_status(self, tweet, archive=1):
         the_url = "https://twitter.com/{0}/status/{1}".format(tweet.author.screen_name, tweet.id_str)
-        if tweet.author.id_str not in self.silenced_ids:
+        if tweet.author.id_str not in self.filters.silenced_ids:
             self.midori_push(tweet, None, self.cfg["channel"], the_url)
-        links = self.m_tweet_archive_sync(the_url)
-        if tweet.author.id_str not in self.silenced_ids:
-            self.mapi.privmsg(self.cfg["channel"], "-> {0}".format(", ".join(links)))
-        return True
+        if archive:
+            self.m_archive_tweet(the_url, lambda url, links: self.on_status_archived(tweet, links))
 
-    def on_disconnect(self, status):
-        print(status)
-        print("disconnected :^(")
-        self.mapiobj.privmsg(CHANNEL, "Lost connection.")
+    def m_push_summary(self, tweets):
+        author = tweets[0].author
+        if author.id_str in self.filters.silenced_ids:
+            return
+        self.home().privmsg(self.cfg["channel"], "@{0} posted {1} tweets: {2}".format(
+            author.screen_name, len(tweets), " ".join(
+                "https://twitter.com/{0}/status/{1}".format(author.screen_name, t.id_str)
+                for t in tweets)))
+
+    def on_status_archived(self, tweet, links):
+        if links and tweet.author.id_str not in self.filters.silenced_ids:
+            self.home().privmsg(self.cfg["channel"], "-> {0}".format(", ".join(links)))
+
+    def on_disconnect(self, notice):
+        logger.warn("Twitter disconnected us: {0}".format(notice))
+        self.sthread.report("network", notice)
+        self.home().privmsg(self.cfg["channel"], "Lost connection.")
 
 __identifier__ = "twitter.stream"
 __dependencies__ = []
@@ -11,6 +11,6 @@ try:
 except Exception:
     logger.critical("Unhandled exception in Midori main loop. Report a bug!", exc_info=1)
 except KeyboardInterrupt:
-    midori.instance.api.send_raw("QUIT :rip")
+    midori.instance.quit("rip")
 finally:
     sys.exit(midori.instance.exit())
\ No newline at end of file
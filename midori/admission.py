@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+"""
+Admission control for command hooks.
+Every hook registered with a cost draws that many tokens from three buckets:
+one for the sender's host, one for the channel and one for the command. If
+any of them is short, the message is rejected before the hook runs, so a
+single user cannot keep every worker busy with expensive commands.
+"""
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ("user", "channel", "command")
+
+# scope -> (tokens refilled per second, bucket size)
+DEFAULT_LIMITS = {
+    "user": (0.2, 5),
+    "channel": (1.0, 15),
+    "command": (0.5, 10),
+}
+
+class AdmissionControl(object):
+    """Token buckets keyed by host, channel and command.
+       Limits are read from admission.<scope>.rate and admission.<scope>.burst
+       on every check, so they follow configuration reloads.
+
+    Arguments:
+        config [callable]: config(key, default), eg Midori.config.
+        max_keys [int]: Buckets kept per scope before full (idle) ones are
+                        forgotten."""
+    def __init__(self, config, max_keys=10000):
+        self.config = config
+        self.max_keys = max_keys
+        self.buckets = dict((scope, {}) for scope in SCOPES)
+        self.counters = defaultdict(lambda: 0)
+        self.lock = threading.Lock()
+
+    def limits(self, scope):
+        rate, burst = DEFAULT_LIMITS[scope]
+        return (self.config("admission.{0}.rate".format(scope), rate),
+                self.config("admission.{0}.burst".format(scope), burst))
+
+    def admit(self, cost, user=None, channel=None, command=None):
+        """Take cost tokens from the buckets of user, channel and command
+           (None skips a scope). Returns false, without taking anything, if
+           one of them does not have enough."""
+        if cost <= 0 or not self.config("admission.enabled", 1):
+            return 1
+        now = time.time()
+        levels = []
+        with self.lock:
+            for scope, key in zip(SCOPES, (user, channel, command)):
+                if key is None:
+                    continue
+                rate, burst = self.limits(scope)
+                bucket = self.buckets[scope].get(key)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+                if tokens < cost:
+                    self.counters["rejected_" + scope] += 1
+                    logger.debug("Rejected {0} (cost {1}): {2} {3} is out of tokens."
+                                 .format(command, cost, scope, key))
+                    return 0
+                levels.append((scope, key, tokens))
+            for scope, key, tokens in levels:
+                buckets = self.buckets[scope]
+                buckets[key] = [tokens - cost, now]
+                if len(buckets) > self.max_keys:
+                    self.prune(scope, now)
+            self.counters["admitted"] += 1
+        return 1
+
+    def prune(self, scope, now):
+        """[internal] Forget buckets that have refilled; a new bucket starts
+           full anyway. Call with the lock held."""
+        rate, burst = self.limits(scope)
+        buckets = self.buckets[scope]
+        for key in [k for k, (tokens, last) in buckets.items()
+                    if tokens + (now - last) * rate >= burst]:
+            del buckets[key]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            for scope in SCOPES:
+                stats["tracked_" + scope] = len(self.buckets[scope])
+            return stats
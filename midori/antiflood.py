@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+"""
+Flood detection.
+Runs on every channel message before any hook does, in constant time and
+memory: each channel keeps small sliding-window counters for messages and
+joins/parts, and the bodies of recent messages from all channels go into a
+decaying count-min sketch, so the same spam pasted across a hundred channels
+is caught without remembering the messages themselves.
+"""
+
+logger = logging.getLogger(__name__)
+
+FLOOD_RATE = "rate"
+FLOOD_REPEAT = "repeat"
+FLOOD_JOINS = "joins"
+
+# kind is one of the FLOOD_* constants; nick and host are whoever sent the
+# line that tipped it over, count is how many were seen in the window
+FloodEvent = namedtuple("FloodEvent", "kind channel nick host count")
+
+class SlidingCounter(object):
+    """Number of events in the last window seconds, kept in a ring of slots."""
+    __slots__ = ("slot_len", "counts", "total", "current")
+
+    def __init__(self, window, slots=10):
+        self.slot_len = float(window) / slots
+        self.counts = [0] * slots
+        self.total = 0
+        self.current = 0
+
+    def add(self, now, n=1):
+        """Record n events at now. Returns the count for the window."""
+        slot = int(now / self.slot_len)
+        slots = len(self.counts)
+        if slot - self.current >= slots:
+            self.counts = [0] * slots
+            self.total = 0
+        else:
+            for expired in range(self.current + 1, slot + 1):
+                self.total -= self.counts[expired % slots]
+                self.counts[expired % slots] = 0
+        self.current = max(self.current, slot)
+        self.counts[slot % slots] += n
+        self.total += n
+        return self.total
+
+class DecayingSketch(object):
+    """Count-min sketch over the last one to two windows.
+       Counts go into the current table; when a window ends it becomes the
+       previous table and the one before is forgotten. Estimates never
+       undercount, and overcount by little as long as width is well above
+       the number of distinct keys per window."""
+    def __init__(self, window, width=2048, depth=4):
+        self.window = window
+        self.width = width
+        self.depth = depth
+        self.epoch = 0
+        self.current = self.empty()
+        self.previous = self.empty()
+
+    def empty(self):
+        return [array("l", [0]) * self.width for i in range(self.depth)]
+
+    def add(self, key, now):
+        """Count key once at now. Returns its estimated count."""
+        epoch = int(now / self.window)
+        if epoch != self.epoch:
+            self.previous = self.current if epoch == self.epoch + 1 else self.empty()
+            self.current = self.empty()
+            self.epoch = epoch
+        estimate = None
+        for row in range(self.depth):
+            column = hash((row, key)) % self.width
+            self.current[row][column] += 1
+            count = self.current[row][column] + self.previous[row][column]
+            if estimate is None or count < estimate:
+                estimate = count
+        return estimate
+
+class AntiFlood(object):
+    """Flags channel floods, repeated spam and join/part floods.
+       Thresholds are read from the flood.* configuration keys on each call:
+           flood.window: seconds the counters look back (default 10)
+           flood.channel_rate: messages per window in one channel (30)
+           flood.repeat: copies of one message per window, all channels (5)
+           flood.repeat_min_length: shorter messages are never spam (10)
+           flood.suppress_repeats: keep repeats from the hooks (true); a
+                                   sender's own repeats always are, copies
+                                   from many senders only in channels with
+                                   a policy for repeat floods
+           flood.joins: joins and parts per window in one channel (10)
+           flood.cooldown: seconds between two reports of the same kind of
+                           flood in a channel (30)
+       The window size is fixed when the detector is created.
+
+    Arguments:
+        config [callable]: config(key, default), eg Midori.config.
+        casefold [callable]: Folds channel names, eg ISupport.casefold."""
+    def __init__(self, config, casefold=lambda name: name.lower()):
+        self.config = config
+        self.casefold = casefold
+        self.window = config("flood.window", 10)
+        self.sketch = DecayingSketch(self.window, config("flood.sketch_width", 2048))
+        self.channels = {}
+        self.reported = {}
+        self.policies = {}
+        self.counters = {FLOOD_RATE: 0, FLOOD_REPEAT: 0, FLOOD_JOINS: 0, "suppressed": 0}
+        self.lock = threading.Lock()
+
+    def counters_for(self, channel):
+        """[internal] Call with the lock held."""
+        folded = self.casefold(channel)
+        try:
+            return self.channels[folded]
+        except KeyError:
+            counters = self.channels[folded] = (SlidingCounter(self.window),
+                                                SlidingCounter(self.window))
+            return counters
+
+    def message(self, channel, nick, host, body):
+        """Check a channel message.
+           Returns (spam, events): spam is true if the message is a repeat
+           that should not reach any hook, events lists the FloodEvents to
+           report (at most one per kind per cooldown)."""
+        now = time.time()
+        events = []
+        normalized = " ".join(body.lower().split())
+        with self.lock:
+            messages, joins = self.counters_for(channel)
+            rate = messages.add(now)
+            if rate > self.config("flood.channel_rate", 30):
+                self.flag(events, FLOOD_RATE, channel, nick, host, rate, now)
+            spam = 0
+            if len(normalized) >= self.config("flood.repeat_min_length", 10):
+                limit = self.config("flood.repeat", 5)
+                copies = self.sketch.add(normalized, now)
+                # a popular link pasted by many people is not spam unless the
+                # channel asked for repeat floods to be acted on
+                own_copies = self.sketch.add((host, normalized), now)
+                if copies > limit:
+                    self.flag(events, FLOOD_REPEAT, channel, nick, host, copies, now)
+                    if own_copies > limit or self.action_for_kind(channel, FLOOD_REPEAT):
+                        spam = self.config("flood.suppress_repeats", 1)
+                if spam:
+                    self.counters["suppressed"] += 1
+        return spam, events
+
+    def membership(self, channel, nick, host):
+        """Count a join or part. Returns the FloodEvents to report."""
+        now = time.time()
+        events = []
+        with self.lock:
+            messages, joins = self.counters_for(channel)
+            count = joins.add(now)
+            if count > self.config("flood.joins", 10):
+                self.flag(events, FLOOD_JOINS, channel, nick, host, count, now)
+        return events
+
+    def flag(self, events, kind, channel, nick, host, count, now):
+        """[internal] Add an event unless one was reported recently."""
+        key = (kind, self.casefold(channel))
+        if now - self.reported.get(key, 0) < self.config("flood.cooldown", 30):
+            return
+        self.reported[key] = now
+        self.counters[kind] += 1
+        events.append(FloodEvent(kind, channel, nick, host, count))
+
+    def forget(self, channel):
+        """Drop a channel's counters, eg after we left it."""
+        folded = self.casefold(channel)
+        with self.lock:
+            self.channels.pop(folded, None)
+            for kind in (FLOOD_RATE, FLOOD_REPEAT, FLOOD_JOINS):
+                self.reported.pop((kind, folded), None)
+
+    def set_policy(self, channel, **actions):
+        """Set what to do about floods in channel. See API.set_flood_policy."""
+        for kind, action in actions.items():
+            if kind not in (FLOOD_RATE, FLOOD_REPEAT, FLOOD_JOINS):
+                raise ValueError("Unknown kind of flood: {0}".format(kind))
+            if action not in (None, "kickban", "ban", "moderate"):
+                raise ValueError("Unknown flood action: {0}".format(action))
+            if kind != FLOOD_REPEAT and action in ("kickban", "ban"):
+                raise ValueError("{0} floods have no single offender to {1}."
+                                 .format(kind, action))
+        folded = self.casefold(channel)
+        with self.lock:
+            policy = dict(self.policies.get(folded, {}))
+            policy.update(actions)
+            self.policies[folded] = dict((k, v) for k, v in policy.items() if v)
+
+    def action_for(self, event):
+        return self.action_for_kind(event.channel, event.kind)
+
+    def action_for_kind(self, channel, kind):
+        return self.policies.get(self.casefold(channel), {}).get(kind)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["channels"] = len(self.channels)
+            return stats
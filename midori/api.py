@@ -1,26 +1,87 @@
 from __future__ import unicode_literals
+import logging
+import time
 import weakref
-from collections import deque
+from collections import deque, namedtuple, OrderedDict
 import re
+
+import midori
+import midori.admission
+import midori.antiflood
+import midori.batcher
+import midori.isupport
+import midori.workers
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 """
 Midori API definitions.
 This module should not be imported directly, instead, your extension should have
 saved the API object passed to its __init__.
 """
 
+logger = logging.getLogger(__name__)
+
+# passed to overload observers when a bounded queue starts dropping items;
+# dropped maps verbs to how many were dropped from that queue so far
+OverloadEvent = namedtuple("OverloadEvent", "queue size maxsize dropped")
+FloodEvent = midori.antiflood.FloodEvent
+
+CONTROLS_RE = re.compile("\x02|\x03([0-9]{2}(,[0-9]{2})?)?|\x1F|\x0F|\x16")
+URL_RE = re.compile(r"https?://[^\s<>\"'\x00-\x1f]+", re.I)
+
 class API(object):
-    """Extension API."""
-    def __init__(self, instance):
+    """Extension API.
+       There is one per network, holding that network's state; hooks,
+       timers and stats are shared by all of them."""
+    def __init__(self, instance, network):
         self.instance = instance
+        # the midori.network.Network this API talks to
+        self.network = network
         self.nick = ""
         self.channels = {}
         self.users = MidoriUserDictionary()
+        self.isupport = midori.isupport.ISupport()
+        # our own nick!user@host, once the server has shown it to us
+        self.self_mask = ""
+        self.batcher = midori.batcher.OutputBatcher(
+            self.isupport, self.write_line, lambda: self.self_mask or self.nick,
+            self.call_later, network.config("join_window", 0.1))
+        self.admission = midori.admission.AdmissionControl(network.config)
+        self.antiflood = midori.antiflood.AntiFlood(network.config, self.isupport.casefold)
+        self.modes = midori.batcher.ModeQueue(self.isupport, self.send_raw, self.call_later,
+                                              network.config("mode_window", 0.3))
 
     def get_instance(self):
         """Return the midori.core.Midori instance associated with this API
            object."""
         return self.instance
 
+    def is_primary(self):
+        """Return false in every shard process but the first (see
+           midori.shard). Start process-wide jobs, such as streams and
+           pollers, only where this is true, or they run once per shard."""
+        return not self.instance.shard_index
+
+    def get_network(self, name=None):
+        """Return the API of the network called name, or of the default
+           network, eg to announce something on a network other than the one
+           the event being handled came from."""
+        if name is None:
+            return self.instance.api
+        try:
+            return self.instance.networks[name].api
+        except KeyError:
+            raise ValueError("No network called {0}.".format(name))
+
+    @property
+    def http(self):
+        """The shared midori.httpclient.HTTPClient. Use it instead of creating
+           your own sessions, so connections are pooled across extensions."""
+        return self.instance.get_http_client()
+
     def get_stats(self):
         buffer_count = 0
         total_buffer_containment = 0
@@ -30,10 +91,123 @@ class API(object):
         for channel in self.channels:
             buffer_count += 1
             total_buffer_containment += len(self.channels[channel].buffer)
-        return {
+        ext_manager = getattr(self.instance, "ext_manager", None)
+        stats = {
+            "network": self.network.name,
+            "networks": dict((name, network.stats())
+                             for name, network in self.instance.networks.items()),
             "buffer_count": buffer_count,
-            "total_buffer_containment": total_buffer_containment
+            "total_buffer_containment": total_buffer_containment,
+            "extensions": dict(ext_manager.states) if ext_manager else {},
+            "extension_start_times": dict(ext_manager.start_times) if ext_manager else {},
+            "modes": self.modes.stats(),
+            "queues": self.instance.queue_stats(),
+            "admission": self.admission.stats(),
+            "floods": self.antiflood.stats(),
+            "timers": self.instance.timers.stats(),
         }
+        for name, callback in list(self.instance.stats_providers.items()):
+            try:
+                stats[name] = callback()
+            except Exception:
+                logger.error("Exception in stats provider {0}".format(name), exc_info=1)
+        return stats
+
+    def register_stats(self, name, callback):
+        """Add the return value of callback() to get_stats() under name.
+
+        Arguments:
+            name [string]: Key to report the stats under.
+            callback [callable]: Called with no arguments, from any thread.
+        """
+        self.instance.stats_providers[name] = callback
+
+    def unregister_stats(self, name):
+        self.instance.stats_providers.pop(name, None)
+
+    def register_enricher(self, name, function):
+        """Add a derived field to every PrivateMessage.
+           cmd.<name> is computed by function(cmd) the first time it is read,
+           and cached on the message, so every extension shares the result.
+
+        Arguments:
+            name [string]: Attribute name. Must not clash with an existing field.
+            function [callable]: Called with the PrivateMessage, from any thread.
+        """
+        if name in PrivateMessage.enrichers or hasattr(PrivateMessage, name):
+            raise ValueError("PrivateMessage already has a field called {0}.".format(name))
+        PrivateMessage.enrichers[name] = function
+
+    def unregister_enricher(self, name):
+        PrivateMessage.enrichers.pop(name, None)
+
+    def hook_overload(self, callback):
+        """Call callback(event) when a bounded queue drops items.
+           event is a midori.api.OverloadEvent. Events for a queue are sent
+           at most once per queues.event_interval seconds, on the pool."""
+        self.instance.overload_observers.append(callback)
+
+    def unhook_overload(self, callback):
+        observers = self.instance.overload_observers
+        observers[:] = [o for o in observers if o != callback]
+
+    def call_later(self, delay, callback, args=(), kwargs=None):
+        """Call callback(*args, **kwargs) on the thread pool after delay seconds.
+           Returns a midori.timers.TimerHandle; call its cancel() method to
+           call it off.
+
+        Arguments:
+            delay [float]: Seconds from now.
+            callback [callable]: What to call.
+            args [tuple], kwargs [dict]: Its arguments.
+        """
+        return self.instance.timers.call_later(delay, callback, args, kwargs)
+
+    def call_every(self, interval, callback, args=(), kwargs=None, jitter=0, coalesce=1,
+                   delay=None):
+        """Call callback(*args, **kwargs) on the thread pool every interval
+           seconds until the returned handle is cancelled. Use this instead of
+           a thread that sleeps in a loop.
+
+        Arguments:
+            interval [float]: Seconds between calls.
+            jitter [float]: Optional. Add up to this many seconds to each delay
+                            at random, to spread out pollers.
+            coalesce [bool]: Optional. Skip a call while the previous one is
+                             still running, and don't make up for missed calls.
+            delay [float]: Optional. Seconds until the first call; defaults to
+                           interval.
+        """
+        return self.instance.timers.call_every(interval, callback, args, kwargs, jitter,
+                                               coalesce, delay)
+
+    def hook_flood(self, callback):
+        """Call callback(event) when a flood is detected in a channel.
+           event is a midori.api.FloodEvent; its kind is "rate" (too many
+           messages), "repeat" (the same message over and over, in any number
+           of channels) or "joins" (join/part flood). Each kind is reported
+           at most once per flood.cooldown seconds per channel, on the pool.
+           A sender's repeated messages never reach command hooks, nor do
+           repeats from many senders in a channel with a repeat policy (see
+           set_flood_policy and flood.suppress_repeats)."""
+        self.instance.flood_observers.append(callback)
+
+    def unhook_flood(self, callback):
+        observers = self.instance.flood_observers
+        observers[:] = [o for o in observers if o != callback]
+
+    def set_flood_policy(self, channel, **actions):
+        """Have the bot act on floods in channel by itself.
+        Example: api.set_flood_policy("#chan", repeat="kickban", joins="moderate")
+
+        Arguments:
+            channel -- the channel the policy applies to
+            rate, repeat, joins -- Optional. What to do about that kind of
+                flood: "moderate" sets +m for flood.moderate_duration seconds;
+                for repeats only, "ban" bans *!*@host and "kickban" also kicks.
+                None removes the action.
+        """
+        self.antiflood.set_policy(channel, **actions)
 
     def hook_raw(self, kind, callback, predicate=lambda cmd: 1):
         """Register a callback for the IRC numeric represented by kind.
@@ -51,20 +225,69 @@ class API(object):
         """
         self.instance.observers[kind].append((callback, predicate))
 
+    def unhook_raw(self, kind, callback):
+        """Remove every registration of callback for the IRC numeric kind."""
+        observers = self.instance.observers
+        # replace rather than mutate, the main loop may be iterating the old list
+        observers[kind] = [o for o in observers[kind] if o[0] != callback]
+
+    def hook_command(self, context, callback, predicate=lambda cmd: 1, cost=0):
+        """Register a callback for PRIVMSGs in context (midori.CONTEXT_*).
+           Command hooks are kept by midori.base and shared by every network.
+           See ExtensionAPI.hook_command."""
+        self.dispatcher().hook_privcommand(context, callback, predicate, cost)
+
+    def unhook_command(self, context, callback):
+        self.dispatcher().unhook_privcommand(context, callback)
+
+    def hook_url(self, host, callback, context=midori.CONTEXT_ALL, predicate=lambda cmd: 1,
+                 cost=0):
+        """Register a callback for PRIVMSGs that link to host. See
+           ExtensionAPI.hook_url."""
+        self.dispatcher().hook_url(host, callback, context, predicate, cost)
+
+    def unhook_url(self, host, callback):
+        self.dispatcher().unhook_url(host, callback)
+
+    def admit(self, cost, cmd, key=None):
+        """[internal] Charge a command hook's cost to the sender, channel and
+           command (key, default the command word) of cmd, a PrivateMessage
+           from this network. Returns false if any of them is short."""
+        if not cost:
+            return 1
+        return self.admission.admit(cost, cmd.sender.hostmask,
+                                    cmd.channel.name if cmd.channel else None,
+                                    key or cmd.command)
+
+    def dispatcher(self):
+        """[internal] Return midori.base, which keeps the command and URL hooks
+           and hands PRIVMSGs to them. It is always loaded before any other
+           extension."""
+        return self.instance.ext_manager.get_extension("midori.base")
+
     def send_raw(self, command_str):
         """Send a command to IRC.
         
         Arguments:
             command_str [unicode!]: Command to send, as a unicode string.
                                     Do not include the trailing CRLF."""
-        self.instance.write_queue.put("{0}\r\n".format(command_str).encode("utf-8"))
+        if self.batcher.pending:
+            self.batcher.flush()
+        self.write_line(command_str)
+
+    def write_line(self, command_str):
+        """[internal] Queue a line for the network thread, bypassing batching."""
+        self.network.write_queue.put("{0}\r\n".format(command_str).encode("utf-8"))
 
-    def join(self, channel):
+    def join(self, channel, key=None):
         """Join a channel.
+        JOINs issued close together are merged into as few lines as the
+        server allows, and are sent before any other command.
 
         Arguments:
-            channel [string]: channel to join, with prefix"""
-        self.send_raw("JOIN {0}".format(channel))
+            channel [string]: channel to join, with prefix
+            key [string]: Optional. The channel key."""
+        self.batcher.join(channel, key)
 
     def leave(self, channel, message="Leaving"):
         """Leave a channel.
@@ -95,6 +318,23 @@ class API(object):
         """
         self.send_raw("MODE {0} {1} {2}".format(target, mode, args))
 
+    def queue_mode(self, channel, change, param=None):
+        """Queue a single channel mode change.
+        Changes made within a short window are merged into as few MODE lines
+        as the server allows, and a change that undoes a pending one cancels
+        it. Use mode() to send a MODE line right away.
+
+        Arguments:
+            channel -- the target channel
+            change -- a sign and a mode character, eg "+v"
+            param -- Optional. The mode's argument (eg a nick or mask).
+        """
+        self.modes.queue(channel, change, param)
+
+    def flush_modes(self, channel=None):
+        """Send queued mode changes for channel (or all channels) now."""
+        self.modes.flush(channel)
+
     def away(self, message=""):
         """Mark yourself as away, specifying a message to be sent to others. If
         message is omitted, the away status will be removed.
@@ -115,28 +355,30 @@ class API(object):
 
     def privmsg(self, target, message):
         """Send a message to target channel or user.
+        Long messages are split over several lines. Given a list of targets,
+        the message is sent to as many of them per line as the server allows.
 
         Arguments:
-            target [string | midori.api.User | midori.api.Channel]: Message recipient.
+            target [string | midori.api.User | midori.api.Channel | list]: Message recipient(s).
             message [string]: Message to send."""
-        self.send_raw("PRIVMSG {0} :{1}".format(str(target), message))
+        self.batcher.message("PRIVMSG", targets_of(target), message)
 
     def action(self, target, message):
         """Send an action (/me) to a target channel or user.
 
         Arguments:
-            target [string | midori.api.User | midori.api.Channel]: Message recipient.
+            target [string | midori.api.User | midori.api.Channel | list]: Message recipient(s).
             message [string]: Message to send."""
-        self.send_raw("PRIVMSG {0} :\x01ACTION{1}\x01".format(str(target), message))
+        self.batcher.message("PRIVMSG", targets_of(target), message, "\x01ACTION ", "\x01")
 
     def notice(self, target, message):
         """Send a notice to a user or channel.
 
         Arguments:
-            target -- Either a user or a channel (prefixed with the usual hash)
+            target -- Either a user or a channel (prefixed with the usual hash), or a list
             message -- The message to send
         """
-        self.send_raw("NOTICE {0} :{1}".format(target, message))
+        self.batcher.message("NOTICE", targets_of(target), message)
 
     # Modes
 
@@ -147,7 +389,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "+v", nick)
+        self.queue_mode(channel, "+v", nick)
 
     def devoice(self, channel, nick):
         """Removes voice from someone on a channel.
@@ -156,7 +398,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "-v", nick)
+        self.queue_mode(channel, "-v", nick)
 
     def hop(self, channel, nick):
         """Gives half operator status to someone on a channel.
@@ -165,7 +407,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "+h", nick)
+        self.queue_mode(channel, "+h", nick)
 
     def dehop(self, channel, nick):
         """Removes half operator status from someone on a channel.
@@ -174,7 +416,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "-h", nick)
+        self.queue_mode(channel, "-h", nick)
 
     def op(self, channel, nick):
         """Gives operator status to someone on a channel.
@@ -183,7 +425,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "+o", nick)
+        self.queue_mode(channel, "+o", nick)
 
     def deop(self, channel, nick):
         """Removes operator status from someone on a channel.
@@ -192,7 +434,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "-o", nick)
+        self.queue_mode(channel, "-o", nick)
 
     def protect(self, channel, nick):
         """Gives protected status to someone on a channel.
@@ -201,7 +443,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "+a", nick)
+        self.queue_mode(channel, "+a", nick)
 
     def deprotect(self, channel, nick):
         """Removes protected status from someone on a channel.
@@ -210,7 +452,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "-a", nick)
+        self.queue_mode(channel, "-a", nick)
 
     def owner(self, channel, nick):
         """Gives owner status to someone on a channel.
@@ -219,7 +461,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "+q", nick)
+        self.queue_mode(channel, "+q", nick)
 
     def deowner(self, channel, nick):
         """Removes owner status from someone on a channel.
@@ -228,7 +470,7 @@ class API(object):
             channel -- The channel on which to set the mode.
             nick -- The targeted user.
         """
-        self.mode(channel, "-q", nick)
+        self.queue_mode(channel, "-q", nick)
 
     def ban(self, channel, nick):
         """Sets a ban on a channel against a nickname.
@@ -240,7 +482,7 @@ class API(object):
             channel -- The channel on which to set the ban.
             nick -- The user to ban.
         """
-        self.mode(channel, "+b", nick + "!*@*")
+        self.queue_mode(channel, "+b", nick + "!*@*")
 
     def unban(self, channel, nick):
         """Removes a ban on a channel against a nickname.
@@ -252,7 +494,7 @@ class API(object):
             channel -- The channel on which to remove the ban.
             nick -- The user to unban.
         """
-        self.mode(channel, "-b", "{0}!*@*".format(nick))
+        self.queue_mode(channel, "-b", "{0}!*@*".format(nick))
 
     def ban_by_mask(self, channel, mask):
         """Sets a ban on a channel against a mask in the form of
@@ -262,7 +504,7 @@ class API(object):
             channel -- The channel on which to set the ban.
             mask -- The mask to ban.
         """
-        self.mode(channel, "+b", mask)
+        self.queue_mode(channel, "+b", mask)
 
     def unban_by_mask(self, channel, mask):
         """Removes a ban on a channel against a mask in the form of
@@ -272,7 +514,7 @@ class API(object):
             channel -- The channel on which to remove the ban.
             mask -- The mask to unban.
         """
-        self.mode(channel, "-b", mask)
+        self.queue_mode(channel, "-b", mask)
 
     def kickban(self, channel, nick, reason=""):
         """Sets a ban on a user, then kicks them from the channel.
@@ -283,8 +525,214 @@ class API(object):
             reason -- Optional. A reason for the kickban.
         """
         self.ban(channel, nick)
+        # the ban has to be in place before they can rejoin
+        self.flush_modes(channel)
         self.kick(channel, nick, reason)
 
+class ExtensionAPI(object):
+    """The API handle given to a single extension.
+       It behaves exactly like an API object, but remembers the hooks,
+       threads and resources its extension registers so they can be torn down
+       when the extension is unloaded or reloaded.
+       Network state and commands (nick, channels, privmsg...) go to the
+       network whose event is being handled, or to the default network
+       outside of a hook. Use cmd.api or get_network() to pick one yourself,
+       eg from a thread of your own.
+       Hooks only fire once is_ready() returns true, so an extension's start()
+       phase can finish before its callbacks are called.
+       In a shard process, raw hooks skip the copies of lines that every shard
+       receives, unless sees_replicas is set; that way they run once
+       whichever shard they are in."""
+    def __init__(self, api, ext_id, is_ready=lambda: 1, sees_replicas=0):
+        object.__setattr__(self, "_api", api)
+        object.__setattr__(self, "ext_id", ext_id)
+        object.__setattr__(self, "is_ready", is_ready)
+        object.__setattr__(self, "sees_replicas", sees_replicas)
+        object.__setattr__(self, "raw_hooks", [])
+        object.__setattr__(self, "command_hooks", [])
+        object.__setattr__(self, "url_hooks", [])
+        object.__setattr__(self, "enricher_names", [])
+        object.__setattr__(self, "overload_hooks", [])
+        object.__setattr__(self, "flood_hooks", [])
+        object.__setattr__(self, "timers", [])
+        object.__setattr__(self, "threads", [])
+        object.__setattr__(self, "resources", [])
+        object.__setattr__(self, "stats_names", [])
+        object.__setattr__(self, "last_used", time.time())
+
+    def __getattr__(self, name):
+        return getattr(self.current_api(), name)
+
+    def __setattr__(self, name, value):
+        # state set through the API (the nick...) belongs to the network
+        setattr(self.current_api(), name, value)
+
+    def current_api(self):
+        """Return the API of the network whose event is being handled on this
+           thread, else the default one."""
+        network = midori.workers.current_network()
+        return network.api if network is not None else self._api
+
+    def hook_raw(self, kind, callback, predicate=lambda cmd: 1):
+        predicate = self.gate(predicate)
+        self.raw_hooks.append((kind, callback, predicate))
+        self._api.hook_raw(kind, callback, predicate)
+    hook_raw.__doc__ = API.hook_raw.__doc__
+
+    def unhook_raw(self, kind, callback):
+        self.raw_hooks[:] = [h for h in self.raw_hooks if h[:2] != (kind, callback)]
+        self._api.unhook_raw(kind, callback)
+
+    def hook_command(self, context, callback, predicate=lambda cmd: 1, cost=0):
+        """Register a callback for PRIVMSGs in context (midori.CONTEXT_*).
+           See API.hook_raw for the meaning of predicate.
+           A hook with a cost only runs if the sender, the channel and the
+           command each have that many admission tokens left; give expensive
+           commands (network requests, database writes) a higher cost."""
+        predicate = self.gate(predicate)
+        self.command_hooks.append((context, callback, predicate, cost))
+        self._api.hook_command(context, callback, predicate, cost)
+
+    def unhook_command(self, context, callback):
+        self.command_hooks[:] = [h for h in self.command_hooks if h[:2] != (context, callback)]
+        self._api.unhook_command(context, callback)
+
+    def hook_url(self, host, callback, context=None, predicate=lambda cmd: 1, cost=0):
+        """Register a callback for PRIVMSGs that link to host or one of its
+           subdomains, eg "twitter.com". Use cmd.urls_on(host) in the callback
+           to get the matching URLs. The callback is not called for other
+           lines, so this is much cheaper than scanning every message.
+
+        Arguments:
+            host [string]: Lowercase host name.
+            callback [callable]: Called once per matching message.
+            context [int]: midori.CONTEXT_* flags. Defaults to CONTEXT_ALL.
+            predicate [callable]: See API.hook_raw.
+            cost [int]: Admission cost, see hook_command.
+        """
+        if context is None:
+            context = midori.CONTEXT_ALL
+        predicate = self.gate(predicate)
+        self.url_hooks.append((host, callback, context, predicate, cost))
+        self._api.hook_url(host, callback, context, predicate, cost)
+
+    def unhook_url(self, host, callback):
+        self.url_hooks[:] = [h for h in self.url_hooks if h[:2] != (host, callback)]
+        self._api.unhook_url(host, callback)
+
+    def hook_overload(self, callback):
+        self.overload_hooks.append(callback)
+        self._api.hook_overload(callback)
+    hook_overload.__doc__ = API.hook_overload.__doc__
+
+    def call_later(self, delay, callback, args=(), kwargs=None):
+        return self.track_timer(self._api.call_later(delay, callback, args, kwargs))
+    call_later.__doc__ = API.call_later.__doc__
+
+    def call_every(self, interval, callback, args=(), kwargs=None, jitter=0, coalesce=1,
+                   delay=None):
+        return self.track_timer(self._api.call_every(interval, callback, args, kwargs, jitter,
+                                                     coalesce, delay))
+    call_every.__doc__ = API.call_every.__doc__
+
+    def track_timer(self, handle):
+        """[internal] Remember a timer so that unloading cancels it."""
+        self.timers[:] = [t for t in self.timers if not t.done]
+        self.timers.append(handle)
+        return handle
+
+    def hook_flood(self, callback):
+        self.flood_hooks.append(callback)
+        self._api.hook_flood(callback)
+    hook_flood.__doc__ = API.hook_flood.__doc__
+
+    def register_enricher(self, name, function):
+        self._api.register_enricher(name, function)
+        self.enricher_names.append(name)
+    register_enricher.__doc__ = API.register_enricher.__doc__
+
+    def gate(self, predicate):
+        """[internal] Wrap predicate so it fails until the extension is ready,
+           and so we know when the extension was last used."""
+        def gated(cmd):
+            if getattr(cmd, "replica", 0) and not self.sees_replicas:
+                return 0
+            if self.is_ready() and predicate(cmd):
+                object.__setattr__(self, "last_used", time.time())
+                return 1
+            return 0
+        return gated
+
+    def redeliver(self, event):
+        """[internal] Run this extension's hooks for an event it missed, such as
+           the one that caused it to be loaded on demand."""
+        if isinstance(event, PrivateMessage):
+            # charged like in midori.base, or loading on demand would be a
+            # way around the admission limits
+            hooks = [(callback, predicate, cost, None)
+                     for context, callback, predicate, cost in self.command_hooks
+                     if context & event.context]
+            hooks.extend((callback, predicate, cost, "url:" + host)
+                         for host, callback, context, predicate, cost in self.url_hooks
+                         if context & event.context and event.urls_on(host))
+        else:
+            hooks = [(h[1], h[2], 0, None) for h in self.raw_hooks if h[0] == event.kind]
+        for callback, predicate, cost, key in hooks:
+            if predicate(event) and event.api.admit(cost, event, key):
+                callback(event)
+
+    def register_stats(self, name, callback):
+        self.stats_names.append(name)
+        self._api.register_stats(name, callback)
+
+    def track_thread(self, thread):
+        """Register a thread owned by this extension. On unload, it is joined
+           after the extension's unload() method has asked it to stop.
+           Returns thread."""
+        self.threads[:] = [t for t in self.threads if t.is_alive()]
+        self.threads.append(thread)
+        return thread
+
+    def track_resource(self, resource):
+        """Register an object whose close() method will be called on unload.
+           Returns resource."""
+        self.resources.append(resource)
+        return resource
+
+    def release(self, timeout=5):
+        """[internal] Remove everything this extension registered."""
+        for name in self.stats_names:
+            self._api.unregister_stats(name)
+        for kind, callback, predicate in self.raw_hooks:
+            self._api.unhook_raw(kind, callback)
+        for context, callback, predicate, cost in self.command_hooks:
+            self._api.unhook_command(context, callback)
+        for host, callback, context, predicate, cost in self.url_hooks:
+            self._api.unhook_url(host, callback)
+        for name in self.enricher_names:
+            self._api.unregister_enricher(name)
+        for callback in self.overload_hooks:
+            self._api.unhook_overload(callback)
+        for callback in self.flood_hooks:
+            self._api.unhook_flood(callback)
+        for handle in self.timers:
+            handle.cancel()
+        for resource in reversed(self.resources):
+            try:
+                resource.close()
+            except Exception:
+                logger.error("Cannot close {0} for {1}".format(resource, self.ext_id),
+                             exc_info=1)
+        for thread in self.threads:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warn("{0} left thread {1} running after unload."
+                            .format(self.ext_id, thread.name))
+        for owned in (self.raw_hooks, self.command_hooks, self.url_hooks, self.resources,
+                      self.threads, self.stats_names, self.enricher_names,
+                      self.overload_hooks, self.flood_hooks, self.timers):
+            del owned[:]
+
 class MidoriUserDictionary(weakref.WeakValueDictionary):
     def get(self, a, b):
         if a in self:
@@ -293,12 +741,94 @@ class MidoriUserDictionary(weakref.WeakValueDictionary):
             return TransientUser(b)
 
 class PrivateMessage(object):
-    def __init__(self, sender, target, ctxmode, message):
+    """A PRIVMSG, as passed to command hooks.
+       cmd.network is the midori.network.Network it came from, and cmd.api
+       that network's API. cmd.tags holds its IRCv3 message tags.
+       Derived fields are computed on first access by the functions in
+       PrivateMessage.enrichers and cached, so a line is only scanned once no
+       matter how many extensions look at it. Built in are:
+           message: the text with formatting codes stripped
+           links: (host, url) pairs in order of appearance, host lowercased
+           urls: the URLs alone
+           urls_by_host: OrderedDict of host -> [url, ...]
+           command: the first word of message, or "" for an empty line
+           ctcp: (verb, params) for a CTCP request such as ACTION, else None"""
+    enrichers = {}
+
+    def __init__(self, sender, target, ctxmode, message, network=None, tags=None,
+                 timestamp=None):
         self.sender = sender
         self.channel = target
         self.context = ctxmode
         self.raw_message = message
-        self.message = strip_controls(message)
+        self.network = network
+        self.tags = tags or {}
+        # when it was sent, see midori.core.Command.time
+        self.time = timestamp if timestamp is not None else time.time()
+
+    @property
+    def api(self):
+        return self.network.api if self.network is not None else None
+
+    def __getattr__(self, name):
+        try:
+            enricher = PrivateMessage.enrichers[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = enricher(self)
+        setattr(self, name, value)
+        return value
+
+    def urls_on(self, host):
+        """Return the URLs in this message on host or one of its subdomains."""
+        suffix = "." + host
+        return [url for found, url in self.links if found == host or found.endswith(suffix)]
+
+def enrich_message(cmd):
+    return strip_controls(cmd.raw_message)
+
+def enrich_links(cmd):
+    if "://" not in cmd.message:
+        return []
+    links = []
+    for url in URL_RE.findall(cmd.message):
+        url = url.rstrip(".,;:!?)]}>")
+        try:
+            host = urlsplit(url).hostname
+        except ValueError:
+            continue
+        if host:
+            links.append((host, url))
+    return links
+
+def enrich_urls(cmd):
+    return [url for host, url in cmd.links]
+
+def enrich_urls_by_host(cmd):
+    by_host = OrderedDict()
+    for host, url in cmd.links:
+        by_host.setdefault(host, []).append(url)
+    return by_host
+
+def enrich_command(cmd):
+    words = cmd.message.split(None, 1)
+    return words[0] if words else ""
+
+def enrich_ctcp(cmd):
+    raw = cmd.raw_message
+    if len(raw) < 2 or raw[0] != "\x01":
+        return None
+    verb, _, params = raw.strip("\x01").partition(" ")
+    return (verb.upper(), params)
+
+PrivateMessage.enrichers.update({
+    "message": enrich_message,
+    "links": enrich_links,
+    "urls": enrich_urls,
+    "urls_by_host": enrich_urls_by_host,
+    "command": enrich_command,
+    "ctcp": enrich_ctcp,
+})
 
 class Channel(object):
     def __init__(self, name):
@@ -316,6 +846,11 @@ class User(object):
         self.nick = user_tuple[0]
         self.user_name = user_tuple[1]
         self.hostmask = user_tuple[2]
+        # known with extended-join and away-notify; account is None when
+        # logged out, away None when present
+        self.account = None
+        self.real_name = None
+        self.away = None
 
     def __str__(self):
         return self.nick
@@ -327,9 +862,18 @@ class TransientUser(object):
         self.nick = user_tuple[0]
         self.user_name = user_tuple[1]
         self.hostmask = user_tuple[2]
+        self.account = None
+        self.real_name = None
+        self.away = None
 
     def __str__(self):
         return self.nick
 
+def targets_of(target):
+    """Return target as a list of recipients."""
+    if isinstance(target, (list, tuple, set, frozenset)):
+        return list(target)
+    return [target]
+
 def strip_controls(string):
-    return re.sub("\x02|\x03([0-9]{2}(,[0-9]{2})?)?|\x1F|\x0F|\x16", "", string)
+    return CONTROLS_RE.sub("", string)
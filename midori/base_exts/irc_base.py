@@ -1,12 +1,22 @@
 import logging
+import threading
+
 import midori.api
+import midori.caps
 
 class IRCBase(object):
     def __init__(self, api, nil):
         self.api = api
         self.hooks = []
+        # the hook lists are replaced rather than changed in place, so that
+        # delegate_msg can use them without locking; the lock is for writers
+        self.hooks_lock = threading.Lock()
+        # host -> hooks, so a line with links only reaches the extensions
+        # interested in those hosts
+        self.url_hooks = {}
         self.api.hook_raw("PING", self.on_ping)
         self.api.hook_raw("001", self.on_ready)
+        self.api.hook_raw("005", self.on_isupport)
         self.api.hook_raw("PRIVMSG", self.delegate_msg)
         self.api.hook_raw("JOIN", self.on_join)
         self.api.hook_raw("PART", self.on_part)
@@ -16,43 +26,105 @@ class IRCBase(object):
         self.api.hook_raw("MODE", self.on_mode)
         # self.api.hook_raw("376", self.on_mode)
         self.api.hook_raw("NICK", self.on_nick)
-        self.is_waiting_for_mode_r = 0
+        self.api.hook_raw("AWAY", self.on_away)
+        self.api.hook_raw("CHGHOST", self.on_chghost)
+        self.api.hook_raw("BATCH", self.on_batch)
+        self.api.hook_raw("CAP", self.on_cap)
+        self.api.hook_raw("AUTHENTICATE", self.on_authenticate)
+        for numeric in (midori.caps.RPL_LOGGEDIN, midori.caps.RPL_SASLSUCCESS) \
+                + midori.caps.SASL_FAILURES:
+            self.api.hook_raw(numeric, self.on_sasl_result)
+        # names of the networks waiting for NickServ, and of those autojoined
+        self.waiting_for_mode_r = set()
+        self.autojoined = set()
+        # (network name, reference) -> [type, commands] for the open netsplit
+        # and netjoin batches
+        self.batches = {}
+        self.batch_lock = threading.Lock()
+        for network in self.api.get_instance().networks.values():
+            network.subscribe(lambda old, new, network=network:
+                              self.on_channels_changed(network, old, new), "channels")
         logger.info("Core hooks installed.")
-        api.hook_command = self.hook_privcommand
-        api.unhook_command = self.unhook_privcommand
-        api.hook_command(midori.CONTEXT_PRIVATE, self.return_version,
-                         lambda cmd: cmd.message.startswith("\x01VERSION")
-                                     and cmd.message.endswith("\x01"))
-
-    def hook_privcommand(self, context, callback, predicate=lambda cmd: 1):
-        self.hooks.append({
+        # API.hook_command finds us once we're loaded, which we aren't yet
+        self.hook_privcommand(midori.CONTEXT_PRIVATE, self.return_version,
+                              lambda cmd: cmd.ctcp is not None and cmd.ctcp[0] == "VERSION",
+                              cost=1)
+
+    def hook_privcommand(self, context, callback, predicate=lambda cmd: 1, cost=0):
+        hook = {
             "ctx": context,
             "call": callback,
-            "predicate": predicate
-        })
+            "predicate": predicate,
+            "cost": cost,
+        }
+        with self.hooks_lock:
+            self.hooks = self.hooks + [hook]
 
     def unhook_privcommand(self, context, callback):
-        caught = None
-        for i in self.hooks:
-            if i["ctx"] == context and i["call"] == callback:
-                caught = i
-                break
+        with self.hooks_lock:
+            caught = None
+            for i in self.hooks:
+                if i["ctx"] == context and i["call"] == callback:
+                    caught = i
+                    break
+            if caught:
+                self.hooks = [i for i in self.hooks if i is not caught]
         if caught:
             logger.info("Removing PRIVMSG hook for {0} in context {1}".format(callback, context))
-            self.hooks.remove(caught)
+
+    def hook_url(self, host, callback, context=midori.CONTEXT_ALL, predicate=lambda cmd: 1,
+                 cost=0):
+        host = host.lower()
+        hook = {
+            "ctx": context,
+            "call": callback,
+            "predicate": predicate,
+            "cost": cost,
+            "key": "url:" + host,
+        }
+        with self.hooks_lock:
+            url_hooks = dict(self.url_hooks)
+            url_hooks[host] = url_hooks.get(host, []) + [hook]
+            self.url_hooks = url_hooks
+
+    def unhook_url(self, host, callback):
+        host = host.lower()
+        with self.hooks_lock:
+            url_hooks = dict(self.url_hooks)
+            remaining = [i for i in url_hooks.get(host, []) if i["call"] != callback]
+            if remaining:
+                url_hooks[host] = remaining
+            else:
+                url_hooks.pop(host, None)
+            self.url_hooks = url_hooks
+
+    def hooks_for_links(self, cmd):
+        """Return the URL hooks matching any host linked in cmd, each once."""
+        url_hooks = self.url_hooks
+        found = []
+        for host in cmd.urls_by_host:
+            labels = host.split(".")
+            for i in range(len(labels)):
+                for hook in url_hooks.get(".".join(labels[i:]), ()):
+                    if hook not in found:
+                        found.append(hook)
+        return found
 
     def delegate_msg(self, command):
-        user = self.api.users.get(command.sender[0], command.sender)
+        if getattr(command, "replica", 0):
+            return
+        api = command.api
+        user = api.users.get(command.sender[0], command.sender)
         if user is None:
             logger.info("User not known, command discarded.")
             return
         user.user_name = command.sender[1]
         user.hostmask = command.sender[2]
-        if command.args[0] == self.api.nick:
+        if command.args[0] == api.nick:
             channel = None
             ctxmode = midori.CONTEXT_PRIVATE
         else:
-            channel = self.api.channels.get(command.args[0])
+            channel = api.channels.get(command.args[0])
             channel.buffer.append({
                 "sender": command.args[0],
                 "message": command.message,
@@ -64,114 +136,315 @@ class IRCBase(object):
                 "channel": channel,
                 "message": command.message,
             })
-        cmd = midori.api.PrivateMessage(user, channel, ctxmode, command.message)
-        for passing in filter(lambda x: x["ctx"] & ctxmode, self.hooks):
-            if passing["predicate"](cmd):
+        cmd = midori.api.PrivateMessage(user, channel, ctxmode, command.message,
+                                        command.network, command.tags, command.time)
+        if channel is not None and not command.network.remote:
+            spam, events = api.antiflood.message(command.args[0], command.sender[0],
+                                                 command.sender[2], cmd.message)
+            for event in events:
+                self.report_flood(api, event)
+            if spam:
+                return
+        bus = api.get_instance().bus
+        if bus is not None:
+            # the extensions are in the shard processes
+            bus.route(command)
+            return
+        # a copy: hooks added by an extension this event loads on demand must
+        # not run here, it is redelivered to them
+        for passing in [h for h in self.hooks if h["ctx"] & ctxmode]:
+            if (passing["predicate"](cmd)
+                    and api.admit(passing["cost"], cmd, passing.get("key"))):
                 passing["call"](cmd)
+        if self.url_hooks and "://" in command.message:
+            for passing in self.hooks_for_links(cmd):
+                if (passing["ctx"] & ctxmode and passing["predicate"](cmd)
+                        and api.admit(passing["cost"], cmd, passing.get("key"))):
+                    passing["call"](cmd)
+
+    def report_flood(self, api, event):
+        logger.info("{0} flood in {1} ({2} in the window, last from {3})."
+                    .format(event.kind, event.channel, event.count, event.nick))
+        instance = api.get_instance()
+        for callback in list(instance.flood_observers):
+            instance.workers.dispatch(callback, args=(event,), network=api.network)
+        action = api.antiflood.action_for(event)
+        if action == "kickban":
+            api.kickban(event.channel, event.nick, "Flooding")
+        elif action == "ban":
+            api.ban_by_mask(event.channel, "*!*@{0}".format(event.host))
+        elif action == "moderate":
+            api.queue_mode(event.channel, "+m")
+            api.call_later(api.network.config("flood.moderate_duration", 60),
+                           api.queue_mode, (event.channel, "-m"))
 
     def on_ping(self, command):
-        self.api.send_raw("PONG :{0}".format(command.message))
+        command.api.send_raw("PONG :{0}".format(command.message))
+
+    def on_isupport(self, command):
+        command.api.isupport.update(command.args[1:])
+
+    def on_cap(self, command):
+        command.network.caps.on_cap(command)
+
+    def on_authenticate(self, command):
+        command.network.caps.on_authenticate(command)
+
+    def on_sasl_result(self, command):
+        command.network.caps.on_sasl_result(command)
 
     def on_ready(self, command):
-        modes = self.api.get_instance().config("modes", "+wpsC")
+        api, network = command.api, command.network
+        network.caps.registered()
+        # a new connection; forget what the last server told us
+        api.isupport.reset()
+        api.self_mask = ""
+        with self.batch_lock:
+            for key in [k for k in self.batches if k[0] == network.name]:
+                del self.batches[key]
+        if network.remote:
+            # registering is up to the process holding the connection
+            api.nick = command.args[0]
+            return
+        modes = network.config("modes", "+wpsC")
         if modes:
-            self.api.mode(self.api.nick, modes)
+            api.mode(api.nick, modes)
 
-        password = self.api.get_instance().config("nickserv_password", 0)
+        password = network.config("nickserv_password", 0)
         if password:
-            self.is_waiting_for_mode_r = 1
-            self.api.privmsg(self.api.get_instance().config("nickserv", "NickServ"),
-                             "IDENTIFY {0}".format(password))
+            self.waiting_for_mode_r.add(network.name)
+            api.privmsg(network.config("nickserv", "NickServ"),
+                        "IDENTIFY {0}".format(password))
             # we're going to wait for nickserv identification before autojoin.
         else:
-            self.is_waiting_for_mode_r = 0
-            for channel in self.api.get_instance().config("channels", []):
-                self.api.join(channel)
+            self.waiting_for_mode_r.discard(network.name)
+            self.autojoin(network)
+
+    def autojoin(self, network):
+        for channel in network.config("channels", []):
+            network.api.join(channel)
+        self.autojoined.add(network.name)
+
+    def on_channels_changed(self, network, old, new):
+        # the channel list was edited while we're running; sync up without a restart
+        if network.name not in self.autojoined:
+            return
+        before = set(network.lookup(old, "channels", []))
+        after = set(network.lookup(new, "channels", []))
+        for channel in after - before:
+            network.api.join(channel)
+        for channel in before - after:
+            network.api.leave(channel)
 
     def on_join(self, command):
-        cname = command.message or command.args[0]
-        if command.sender[0] == self.api.nick:
-            self.api.channels[cname] = midori.api.Channel(cname)
+        if self.batched(command):
+            return
+        api = command.api
+        cname = command.args[0] if command.args else command.message
+        if command.sender[0] == api.nick:
+            api.channels[cname] = midori.api.Channel(cname)
+            if None not in command.sender:
+                api.self_mask = "{0}!{1}@{2}".format(*command.sender)
         else:
-            try:
-                user = self.api.users[command.sender[0]]
-            except KeyError:
-                user = midori.api.User(command.sender)
-                self.api.users[command.sender[0]] = user
-            channel = self.api.channels.get(cname)
+            user = self.joined_user(command)
+            channel = api.channels.get(cname)
             if channel:
                 channel.users.add(user)
+                self.check_membership_flood(api, cname, command)
             else:
                 logger.warn("JOIN message dropped because we aren't subscribed to the target channel.")
 
+    def joined_user(self, command):
+        """Return the record of the user joining, updated from the line.
+           With extended-join it reads "JOIN #channel account :real name"."""
+        user = self.user_record(command.api, *command.sender)
+        if len(command.args) > 1:
+            user.account = command.args[1] if command.args[1] != "*" else None
+            user.real_name = command.message
+        return user
+
+    def user_record(self, api, nick, user_name=None, hostmask=None):
+        """Return the User for nick, creating it if needed, and fill in what
+           we learnt about it."""
+        try:
+            user = api.users[nick]
+        except KeyError:
+            user = midori.api.User((nick, user_name or "(unknown)", hostmask or "(unknown)"))
+            api.users[nick] = user
+        else:
+            if user_name:
+                user.user_name = user_name
+            if hostmask:
+                user.hostmask = hostmask
+        return user
+
+    def check_membership_flood(self, api, channel, command):
+        if api.network.remote:
+            return
+        for event in api.antiflood.membership(channel, command.sender[0], command.sender[2]):
+            self.report_flood(api, event)
+
     def on_part(self, command):
+        api = command.api
+        if command.sender[0] == api.nick:
+            api.channels.pop(command.args[0], None)
+            api.antiflood.forget(command.args[0])
+            return
         try:
-            user = self.api.users[command.sender[0]]
+            user = api.users[command.sender[0]]
         except KeyError:
             return
-        channel = self.api.channels.get(command.args[0])
+        channel = api.channels.get(command.args[0])
         if channel:
             channel.users.remove(user)
+            self.check_membership_flood(api, command.args[0], command)
         else:
             logger.warn("PART message dropped because we aren't subscribed to the target channel.")
 
     def on_kick(self, command):
-        if command.args[1] == self.api.nick:
-            self.api.channels.remove(command.args[0])
+        api = command.api
+        if command.args[1] == api.nick:
+            api.channels.pop(command.args[0], None)
+            api.antiflood.forget(command.args[0])
         else:
             try:
-                user = self.api.users[command.args[1]]
+                user = api.users[command.args[1]]
             except KeyError:
                 return
-            channel = self.api.channels.get(command.args[0])
+            channel = api.channels.get(command.args[0])
             if channel:
                 channel.users.remove(user)
             else:
                 logger.warn("KICK message dropped because we aren't subscribed to the target channel.")
 
     def on_quit(self, command):
+        if self.batched(command):
+            return
+        api = command.api
         try:
-            user = self.api.users[command.sender[0]]
+            user = api.users[command.sender[0]]
         except KeyError:
             return
-        for channel in self.api.channels:
+        for channel in api.channels:
             try:
-                self.api.channels[channel].users.remove(user)
+                api.channels[channel].users.remove(user)
             except KeyError:
                 pass
 
     def on_names(self, command):
+        api = command.api
+        channel = api.channels.get(command.args[2])
+        if not channel:
+            logger.warn("NAMES message dropped because we aren't subscribed to the target channel.")
+            return
+        # with multi-prefix there can be several, eg "@+nick"
+        symbols = "".join(s for m, s in api.isupport.prefixes) or "!~&@%+"
         for name in command.message.split(" "):
-            name = name.lstrip("!~&@%+")
-            if name == self.api.nick:
+            name = name.lstrip(symbols)
+            if not name:
+                continue
+            # with userhost-in-names, nick!user@host
+            nick, _, mask = name.partition("!")
+            user_name, _, hostmask = mask.partition("@")
+            if nick == api.nick:
+                if hostmask:
+                    api.self_mask = name
                 continue
+            channel.users.add(self.user_record(api, nick, user_name, hostmask))
+
+    def on_away(self, command):
+        try:
+            user = command.api.users[command.sender[0]]
+        except KeyError:
+            return
+        user.away = last_param(command)
+
+    def on_chghost(self, command):
+        api = command.api
+        params = command.args + ([command.message] if command.message is not None else [])
+        if len(params) < 2:
+            return
+        if command.sender[0] == api.nick:
+            api.self_mask = "{0}!{1}@{2}".format(api.nick, params[0], params[1])
+            return
+        self.user_record(api, command.sender[0], params[0], params[1])
+
+    def on_batch(self, command):
+        """Collect netsplit and netjoin batches, and apply each at once when
+           it ends. Other batches' lines are handled as they come."""
+        if not command.args or len(command.args[0]) < 2:
+            return
+        key = (command.network.name, command.args[0][1:])
+        if command.args[0][0] == "+":
+            kind = command.args[1].lower() if len(command.args) > 1 else ""
+            if kind in ("netsplit", "netjoin"):
+                with self.batch_lock:
+                    self.batches[key] = [kind, []]
+            return
+        with self.batch_lock:
+            batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        kind, commands = batch
+        if kind == "netsplit":
+            self.apply_netsplit(command.api, commands)
+        else:
+            self.apply_netjoin(command.api, commands)
+
+    def batched(self, command):
+        """If command belongs to an open netsplit or netjoin batch, hold it
+           there and return true."""
+        reference = command.tags.get("batch")
+        if reference is None:
+            return 0
+        with self.batch_lock:
+            batch = self.batches.get((command.network.name, reference))
+            if batch is None:
+                return 0
+            batch[1].append(command)
+            return 1
+
+    def apply_netsplit(self, api, commands):
+        gone = set()
+        for command in commands:
             try:
-                user = self.api.users[name]
+                gone.add(api.users[command.sender[0]])
             except KeyError:
-                user = midori.api.User((name, "(unknown)", "(unknown)"))
-                self.api.users[name] = user
-            channel = self.api.channels.get(command.args[2])
+                pass
+        for channel in list(api.channels.values()):
+            channel.users.difference_update(gone)
+        logger.info("Netsplit: {0} users quit.".format(len(gone)))
+
+    def apply_netjoin(self, api, commands):
+        # the users are coming back, not flooding in: no membership flood checks
+        joined = {}
+        for command in commands:
+            cname = command.args[0] if command.args else command.message
+            joined.setdefault(cname, []).append(self.joined_user(command))
+        for cname, users in joined.items():
+            channel = api.channels.get(cname)
             if channel:
-                channel.users.add(user)
-            else:
-                logger.warn("NAMES message dropped because we aren't subscribed to the target channel.")
+                channel.users.update(users)
+        logger.info("Netjoin: {0} users rejoined.".format(sum(len(u) for u in joined.values())))
 
     def on_nick(self, command):
-        if command.sender[0] == self.api.nick:
-            self.api.nick = command.args[0]
+        api = command.api
+        if command.sender[0] == api.nick:
+            api.nick = last_param(command)
         else:
             try:
-                user = self.api.users[command.sender[0]]
+                user = api.users[command.sender[0]]
             except KeyError:
                 return
-            user.nick = command.message
-            del self.api.users[command.sender[0]]
-            self.api.users[user.nick] = user
+            user.nick = last_param(command)
+            del api.users[command.sender[0]]
+            api.users[user.nick] = user
 
     def on_mode(self, command):
         # it is more reliable to check for the registered flag instead of
         # arbitrary messages from NickServ (which may change between services)
-        if command.args[0] != self.api.nick or not self.is_waiting_for_mode_r:
+        network = command.network
+        if command.args[0] != network.api.nick or network.name not in self.waiting_for_mode_r:
             return
 
         added_modes = []
@@ -188,15 +461,23 @@ class IRCBase(object):
                 (deleted_modes if is_deleting else added_modes).append(ch)
 
         if "r" in added_modes:
-            for channel in self.api.get_instance().config("channels", []):
-                self.api.join(channel)
-            self.is_waiting_for_mode_r = 0
+            self.autojoin(network)
+            self.waiting_for_mode_r.discard(network.name)
 
     def return_version(self, command):
-        self.api.notice(command.sender, "\x01VERSION Stolen NASA Satellite 1.0001something-AA\x01")
+        command.api.notice(command.sender, "\x01VERSION Stolen NASA Satellite 1.0001something-AA\x01")
+
+def last_param(command):
+    """Return a line's last parameter, whether or not it was sent as a
+       trailing one, or None."""
+    if command.message is not None:
+        return command.message
+    return command.args[-1] if command.args else None
 
 __identifier__ = "midori.base"
 __dependencies__ = []
 __version__ = midori.VERSION
 __ext_class__ = IRCBase
+# tracks state from the lines every shard gets a copy of
+__sees_replicas__ = 1
 logger = logging.getLogger(__identifier__)
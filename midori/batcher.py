@@ -0,0 +1,279 @@
+from __future__ import unicode_literals
+import logging
+import threading
+from collections import OrderedDict
+
+"""
+Outgoing line batching.
+Packs as much as the server allows into each line we send: queued JOINs are
+merged into comma-separated lists, messages to several targets use one
+multi-target PRIVMSG/NOTICE per chunk, long messages are split at word
+boundaries without ever cutting a UTF-8 sequence in half, and channel mode
+changes are collected and packed into a few MODE lines. Limits come from the
+server's ISUPPORT tokens.
+"""
+
+logger = logging.getLogger(__name__)
+
+# when we don't know our own nick!user@host, assume the longest usual one
+UNKNOWN_USER_LEN = 10
+UNKNOWN_HOST_LEN = 63
+
+class OutputBatcher(object):
+    """Batches output for one connection.
+
+    Arguments:
+        isupport [midori.isupport.ISupport]: The server's limits.
+        write [callable]: Sends one line, without the CRLF.
+        get_mask [callable]: Returns our "nick!user@host", or just our nick
+                             while the rest is unknown.
+        call_later [callable]: call_later(delay, callback), eg API.call_later.
+        join_window [float]: Seconds to wait for more JOINs before sending."""
+    def __init__(self, isupport, write, get_mask, call_later, join_window=0.1):
+        self.isupport = isupport
+        self.write = write
+        self.get_mask = get_mask
+        self.call_later = call_later
+        self.join_window = join_window
+        self.pending_joins = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def join(self, channel, key=None):
+        """Queue a JOIN. It is sent with the other queued JOINs after
+           join_window seconds, or before anything else we send."""
+        folded = self.isupport.casefold(channel)
+        with self.lock:
+            if any(self.isupport.casefold(c) == folded for c, k in self.pending_joins):
+                return
+            self.pending_joins.append((channel, key))
+            if self.timer is None:
+                self.timer = self.call_later(self.join_window, self.flush)
+
+    @property
+    def pending(self):
+        return bool(self.pending_joins)
+
+    def flush(self):
+        """Send everything that is queued."""
+        with self.lock:
+            joins, self.pending_joins = self.pending_joins, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if joins:
+            for line in self.join_lines(joins):
+                self.write(line)
+
+    def join_lines(self, joins):
+        """Pack (channel, key) pairs into as few JOIN lines as possible.
+           Keyed channels go first in each line, as the keys are matched to
+           channels by position."""
+        joins = [j for j in joins if j[1]] + [j for j in joins if not j[1]]
+        room = self.isupport.linelen - 2
+        limit = self.isupport.targmax("JOIN")
+        lines = []
+        channels, keys = [], []
+        for channel, key in joins:
+            candidate_channels = channels + [channel]
+            candidate_keys = keys + [key] if key else keys
+            length = len(join_line(candidate_channels, candidate_keys).encode("utf-8"))
+            if channels and (length > room or (limit and len(candidate_channels) > limit)):
+                lines.append(join_line(channels, keys))
+                channels, keys = [channel], [key] if key else []
+            else:
+                channels, keys = candidate_channels, candidate_keys
+        if channels:
+            lines.append(join_line(channels, keys))
+        return lines
+
+    def message(self, verb, targets, text, prefix="", suffix=""):
+        """Send text to every target with as few lines as possible.
+           Each line of text is split into chunks that fit after the server
+           adds our hostmask, and targets are grouped up to the server's
+           TARGMAX and line length.
+
+        Arguments:
+            verb [string]: PRIVMSG or NOTICE.
+            targets [list]: Recipients; anything str() turns into a nick or channel.
+            text [string]: The message. Newlines start a new message.
+            prefix, suffix [string]: Wrapped around every chunk, eg for CTCP ACTION."""
+        targets = [str(t) for t in targets]
+        if not targets:
+            return
+        # queued JOINs first, we may be about to talk in those channels
+        self.flush()
+        longest_target = max(len(t.encode("utf-8")) for t in targets)
+        limit = (self.payload_limit(verb, longest_target)
+                 - len(prefix.encode("utf-8")) - len(suffix.encode("utf-8")))
+        chunks = []
+        for line in text.splitlines() or [""]:
+            chunks.extend(prefix + chunk + suffix for chunk in split_message(line, limit))
+        longest_chunk = max(len(c.encode("utf-8")) for c in chunks)
+        room = self.isupport.linelen - 2 - len(verb) - len("  :") - longest_chunk
+        for group in self.group_targets(verb, targets, room):
+            for chunk in chunks:
+                self.write("{0} {1} :{2}".format(verb, group, chunk))
+
+    def payload_limit(self, verb, target_len):
+        """Bytes of text that fit in a message to a target target_len bytes
+           long, as the server relays it to the recipient."""
+        mask = self.get_mask()
+        if "!" not in mask:
+            mask = "{0}!{1}@{2}".format(mask, "u" * UNKNOWN_USER_LEN, "h" * UNKNOWN_HOST_LEN)
+        overhead = len(":  :\r\n") + len(mask.encode("utf-8")) + len(verb) + target_len + 1
+        return max(self.isupport.linelen - overhead, 1)
+
+    def group_targets(self, verb, targets, room):
+        """Join targets into comma-separated lists within the server's limits."""
+        limit = self.isupport.targmax(verb)
+        groups = []
+        current = []
+        for target in targets:
+            length = len(",".join(current + [target]).encode("utf-8"))
+            if current and (length > room or (limit and len(current) >= limit)):
+                groups.append(",".join(current))
+                current = []
+            current.append(target)
+        if current:
+            groups.append(",".join(current))
+        return groups
+
+def join_line(channels, keys):
+    if keys:
+        return "JOIN {0} {1}".format(",".join(channels), ",".join(keys))
+    return "JOIN {0}".format(",".join(channels))
+
+def split_message(text, limit):
+    """Split text into chunks of at most limit bytes of UTF-8.
+       Chunks end at a space when there is one, and never inside a multi-byte
+       character."""
+    data = text.encode("utf-8")
+    chunks = []
+    while len(data) > limit:
+        cut = data.rfind(b" ", 0, limit + 1)
+        if cut > 0:
+            chunks.append(data[:cut])
+            data = data[cut + 1:]
+            continue
+        cut = limit
+        # back up over continuation bytes (10xxxxxx) to a character start
+        while cut > 0 and (bytearray(data[cut:cut + 1])[0] & 0xC0) == 0x80:
+            cut -= 1
+        if cut == 0:
+            cut = limit
+        chunks.append(data[:cut])
+        data = data[cut:]
+    chunks.append(data)
+    return [chunk.decode("utf-8", "replace") for chunk in chunks]
+
+class ModeQueue(object):
+    """Collects channel mode changes and sends them in as few MODE lines as
+       the server's MODES= limit allows.
+       Changes to a channel are held for window seconds after the first one.
+       A change that undoes a pending one (+v nick, then -v nick) cancels it,
+       and repeating a change only sends it once.
+
+    Arguments:
+        isupport [midori.isupport.ISupport]: The server's limits.
+        write [callable]: Sends one line, without the CRLF.
+        call_later [callable]: call_later(delay, callback, args), eg API.call_later.
+        window [float]: Seconds to collect changes for."""
+    def __init__(self, isupport, write, call_later, window=0.3):
+        self.isupport = isupport
+        self.write = write
+        self.call_later = call_later
+        self.window = window
+        # folded channel -> [channel name, OrderedDict of key -> change]
+        self.pending = {}
+        self.timers = {}
+        self.counters = {"queued": 0, "cancelled": 0, "lines": 0}
+        self.lock = threading.Lock()
+
+    def queue(self, channel, change, param=None):
+        """Queue one mode change.
+
+        Arguments:
+            channel [string]: Target channel.
+            change [string]: A sign and one mode character, eg "+v".
+            param [string]: The mode's parameter, if it takes one."""
+        adding = change[0] != "-"
+        mode = change[-1]
+        if mode in "".join(self.isupport.chanmodes[1:]):
+            # these have one value per channel; a repeat replaces it
+            key = (mode,)
+        else:
+            # list and prefix modes stack, one entry per target
+            key = (mode, self.isupport.casefold(param or ""))
+        folded = self.isupport.casefold(channel)
+        with self.lock:
+            self.counters["queued"] += 1
+            name, changes = self.pending.setdefault(folded, [channel, OrderedDict()])
+            previous = changes.get(key)
+            if previous is not None and previous[0] != adding:
+                del changes[key]
+                self.counters["cancelled"] += 2
+            else:
+                changes[key] = (adding, mode, param)
+            if folded not in self.timers:
+                self.timers[folded] = self.call_later(self.window, self.flush, (channel,))
+
+    def flush(self, channel=None):
+        """Send the pending changes for channel, or for every channel."""
+        with self.lock:
+            if channel is None:
+                folded_names = list(self.pending)
+            else:
+                folded_names = [self.isupport.casefold(channel)]
+            batches = []
+            for folded in folded_names:
+                timer = self.timers.pop(folded, None)
+                if timer is not None:
+                    timer.cancel()
+                if folded in self.pending:
+                    name, changes = self.pending.pop(folded)
+                    batches.append((name, list(changes.values())))
+        for name, changes in batches:
+            lines = self.mode_lines(name, changes)
+            with self.lock:
+                self.counters["lines"] += len(lines)
+            for line in lines:
+                self.write(line)
+
+    def mode_lines(self, channel, changes):
+        """Pack (adding, mode, param) changes into MODE lines."""
+        limit = self.isupport.modes
+        room = self.isupport.linelen - 2
+        lines = []
+        current = []
+        for change in changes:
+            candidate = current + [change]
+            params = sum(1 for c in candidate if c[2] is not None)
+            if current and (params > limit
+                            or len(mode_line(channel, candidate).encode("utf-8")) > room):
+                lines.append(mode_line(channel, current))
+                current = [change]
+            else:
+                current = candidate
+        if current:
+            lines.append(mode_line(channel, current))
+        return lines
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["pending"] = sum(len(c) for n, c in self.pending.values())
+            return stats
+
+def mode_line(channel, changes):
+    modes = []
+    params = []
+    sign = None
+    for adding, mode, param in changes:
+        if adding != sign:
+            modes.append("+" if adding else "-")
+            sign = adding
+        modes.append(mode)
+        if param is not None:
+            params.append(param)
+    return " ".join(["MODE", channel, "".join(modes)] + params)
@@ -0,0 +1,304 @@
+from __future__ import unicode_literals
+import base64
+import calendar
+import logging
+import threading
+import time
+
+"""
+IRCv3 capability negotiation and message tags.
+Before registering we ask the server what it supports (CAP LS 302), request
+what we can use, log in with SASL if configured, and end negotiation; servers
+that don't know CAP ignore it and register us as before. The capabilities:
+    multi-prefix, userhost-in-names: NAMES lists every prefix and the full
+        nick!user@host of each member
+    extended-join: JOIN carries the account and real name
+    away-notify, chghost: away status and host changes as they happen
+    message-tags, server-time, batch: tagged lines, with the time the server
+        saw them, and related lines (eg a netsplit's QUITs) grouped together
+so midori.base builds complete user records from what the server sends
+anyway instead of asking for them.
+
+Settings, per network:
+    "capabilities": [...],      // the ones to request, default WANTED
+    "cap_timeout": 30,          // give up negotiating after this long
+    "sasl": {
+        "mechanism": "PLAIN",   // or "EXTERNAL", with server.tls_certfile
+        "username": "...",
+        "password": "...",
+        "required": false       // disconnect instead of registering unidentified
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+WANTED = ("multi-prefix", "userhost-in-names", "extended-join", "away-notify", "chghost",
+          "message-tags", "server-time", "batch")
+
+# SASL numerics: logged in, success, and the ways it can fail
+RPL_LOGGEDIN = "900"
+RPL_SASLSUCCESS = "903"
+SASL_FAILURES = ("902", "904", "905", "906", "907")
+
+# AUTHENTICATE payloads are sent in chunks of this many base64 characters
+SASL_CHUNK = 400
+# capability names per CAP REQ line, in characters
+REQ_LENGTH = 400
+
+class Capabilities(object):
+    """Capability state and negotiation for one network.
+       `name in network.caps` tells whether a capability is enabled.
+
+    Arguments:
+        network [midori.network.Network]: The network negotiating."""
+    def __init__(self, network):
+        self.network = network
+        self.lock = threading.Lock()
+        self.timer = None
+        # counts negotiations, so a timeout from an earlier connection that
+        # has already gone off can tell it is stale
+        self.attempt = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # name -> value, as advertised by CAP LS
+            self.available = {}
+            self.enabled = set()
+            self.requested = set()
+            self.negotiating = 0
+            # None, "authenticating", "done" or "failed"
+            self.sasl_state = None
+            # the account SASL logged us in to
+            self.account = None
+
+    def __contains__(self, name):
+        return name in self.enabled
+
+    def send(self, line):
+        if not self.network.remote:
+            self.network.api.send_raw(line)
+
+    def mechanism(self):
+        mechanism = self.network.config("sasl.mechanism", None)
+        if mechanism is None and self.network.config("sasl.password", None):
+            mechanism = "PLAIN"
+        return mechanism.upper() if mechanism else None
+
+    def wanted(self):
+        wanted = set(self.network.config("capabilities", WANTED))
+        if self.mechanism():
+            wanted.add("sasl")
+        return wanted
+
+    def start(self):
+        """Open negotiation; called before NICK and USER."""
+        self.cancel_timer()
+        self.reset()
+        with self.lock:
+            self.negotiating = 1
+            self.attempt += 1
+            attempt = self.attempt
+        self.send("CAP LS 302")
+        self.timer = self.network.instance.timers.call_later(
+            self.network.config("cap_timeout", 30), self.timed_out, (attempt,))
+
+    def on_cap(self, command):
+        subcommand = command.args[1].upper() if len(command.args) > 1 else ""
+        # "CAP * LS * :..." means more LS lines follow
+        more = len(command.args) > 2 and command.args[2] == "*"
+        if command.message is not None:
+            names = command.message.split()
+        else:
+            names = command.args[3 if more else 2:]
+        if subcommand in ("LS", "NEW"):
+            with self.lock:
+                for name in names:
+                    name, _, value = name.partition("=")
+                    self.available[name] = value
+            if not more and not self.network.remote:
+                self.request()
+        elif subcommand == "ACK":
+            with self.lock:
+                for name in names:
+                    if name.startswith("-"):
+                        self.enabled.discard(name[1:])
+                    else:
+                        self.enabled.add(name)
+                    self.requested.discard(name.lstrip("-"))
+            logger.info("Capabilities enabled on {0}: {1}".format(
+                self.network.name, " ".join(sorted(self.enabled))))
+            self.proceed()
+        elif subcommand == "NAK":
+            logger.warning("Capabilities refused by {0}: {1}".format(self.network.name,
+                                                                     " ".join(names)))
+            with self.lock:
+                self.requested.difference_update(names)
+            self.proceed()
+        elif subcommand == "DEL":
+            with self.lock:
+                for name in names:
+                    self.available.pop(name, None)
+                    self.enabled.discard(name)
+
+    def request(self):
+        """Ask for every wanted capability the server has and we haven't."""
+        with self.lock:
+            names = sorted(n for n in self.wanted()
+                           if n in self.available and n not in self.enabled)
+            # SASL is only for registering, and only with a mechanism it has
+            mechanisms = self.available.get("sasl", "")
+            usable = not mechanisms or self.mechanism() in mechanisms.split(",")
+            if "sasl" in names and not (self.negotiating and usable):
+                names.remove("sasl")
+            self.requested.update(names)
+        if not names:
+            self.proceed()
+            return
+        line = []
+        for name in names:
+            if line and len(" ".join(line + [name])) > REQ_LENGTH:
+                self.send("CAP REQ :{0}".format(" ".join(line)))
+                line = []
+            line.append(name)
+        self.send("CAP REQ :{0}".format(" ".join(line)))
+
+    def proceed(self):
+        """Authenticate or end negotiation once every request is answered."""
+        with self.lock:
+            if not self.negotiating or self.requested:
+                return
+            authenticate = "sasl" in self.enabled and self.sasl_state is None
+            if authenticate:
+                self.sasl_state = "authenticating"
+        if authenticate:
+            self.send("AUTHENTICATE {0}".format(self.mechanism()))
+        elif self.sasl_state != "authenticating":
+            self.end()
+
+    def on_authenticate(self, command):
+        """The server is ready for our credentials."""
+        if self.sasl_state != "authenticating":
+            return
+        if self.mechanism() == "EXTERNAL":
+            payload = b""
+        else:
+            username = self.network.config("sasl.username", None) or self.network.config(
+                "identity.nick")
+            payload = "\0".join([username, username, self.network.config("sasl.password", "")])
+            payload = payload.encode("utf-8")
+        encoded = base64.b64encode(payload).decode("ascii")
+        for i in range(0, len(encoded), SASL_CHUNK):
+            self.send("AUTHENTICATE {0}".format(encoded[i:i + SASL_CHUNK]))
+        if len(encoded) % SASL_CHUNK == 0:
+            # an empty payload, or one ending on a chunk boundary
+            self.send("AUTHENTICATE +")
+
+    def on_sasl_result(self, command):
+        if command.kind == RPL_LOGGEDIN:
+            self.account = command.args[2] if len(command.args) > 2 else None
+            return
+        if self.sasl_state != "authenticating":
+            return
+        if command.kind == RPL_SASLSUCCESS:
+            logger.info("Logged in to {0} with SASL.".format(self.network.name))
+            self.sasl_state = "done"
+            self.end()
+            return
+        self.sasl_state = "failed"
+        logger.error("SASL authentication on {0} failed: {1}".format(self.network.name,
+                                                                     command.message))
+        if self.network.config("sasl.required", 0):
+            self.send("QUIT :SASL authentication failed")
+        else:
+            self.end()
+
+    def end(self):
+        with self.lock:
+            if not self.negotiating:
+                return
+            self.negotiating = 0
+        self.cancel_timer()
+        self.send("CAP END")
+
+    def timed_out(self, attempt):
+        if self.negotiating and attempt == self.attempt:
+            logger.warning("Capability negotiation with {0} timed out.".format(self.network.name))
+            if self.sasl_state == "authenticating":
+                self.sasl_state = "failed"
+            self.end()
+
+    def disconnected(self):
+        """Called when the connection is lost; negotiation starts over."""
+        with self.lock:
+            self.negotiating = 0
+        self.cancel_timer()
+
+    def registered(self):
+        """Called on 001; a server without CAP registers us without CAP END."""
+        with self.lock:
+            self.negotiating = 0
+        self.cancel_timer()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def load(self, enabled):
+        """Take over another process's enabled capabilities."""
+        with self.lock:
+            self.enabled = set(enabled)
+
+    def stats(self):
+        return {
+            "enabled": sorted(self.enabled),
+            "sasl": self.sasl_state,
+            "account": self.account,
+        }
+
+def parse_tags(string):
+    """Parse the tags of a line (without the leading "@") into a dict.
+       Tags without a value map to ""."""
+    tags = {}
+    for item in string.split(";"):
+        if not item:
+            continue
+        key, _, value = item.partition("=")
+        tags[key] = unescape_tag(value)
+    return tags
+
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def unescape_tag(value):
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        if value[i] == "\\":
+            # a lone trailing backslash is dropped
+            if i + 1 < len(value):
+                out.append(TAG_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+            continue
+        out.append(value[i])
+        i += 1
+    return "".join(out)
+
+def parse_time(value):
+    """Parse a server-time tag (eg "2011-10-19T16:40:51.620Z") into a Unix
+       timestamp, or return None."""
+    if not value:
+        return None
+    try:
+        seconds = calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+    fraction = value[19:].rstrip("Z")
+    if fraction.startswith("."):
+        try:
+            seconds += float(fraction)
+        except ValueError:
+            pass
+    return seconds
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import threading
+
+"""
+Configuration snapshots.
+The JSON configuration file is compiled into a flat, read-only map of dotted
+keys, so a lookup is a single dict access instead of a walk down the tree.
+When the file changes on disk a new snapshot is compiled and swapped in, and
+everyone who subscribed to a changed key is notified.
+"""
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class FrozenDict(dict):
+    """dict that refuses modification. Used for subtrees stored in snapshots."""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Configuration snapshots are read-only.")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+def freeze(value):
+    """Return a read-only copy of a decoded JSON value."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+class TypedAccessors(object):
+    """Typed lookups on top of a get(key, default, rtype) method."""
+    def _typed(self, key, default, types, type_name):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        if not isinstance(value, types) or (bool not in types and isinstance(value, bool)):
+            raise ConfigurationError("Mis-configured key: {0} (expected {1})."
+                                     .format(key, type_name))
+        return value
+
+    def get_int(self, key, default=None):
+        return self._typed(key, default, (int,), "an integer")
+
+    def get_float(self, key, default=None):
+        value = self._typed(key, default, (int, float), "a number")
+        return float(value) if value is not None else None
+
+    def get_bool(self, key, default=None):
+        return self._typed(key, default, (bool, int), "a boolean")
+
+    def get_str(self, key, default=None):
+        return self._typed(key, default, (type(u""), str), "a string")
+
+    def get_list(self, key, default=()):
+        return self._typed(key, default, (tuple,), "a list")
+
+    def get_dict(self, key, default=None):
+        return self._typed(key, default, (dict,), "an object")
+
+class ConfigSnapshot(TypedAccessors):
+    """An immutable, compiled configuration.
+       Every node of the JSON tree is reachable with a single lookup using its
+       dotted path; "server.port" and "extension.twitter.stream" both work."""
+    def __init__(self, tree, mtime=0):
+        self.tree = freeze(tree)
+        self.mtime = mtime
+        self.values = {}
+        self._flatten("", self.tree)
+
+    def _flatten(self, prefix, node):
+        for key, value in node.items():
+            path = prefix + key
+            self.values[path] = value
+            if isinstance(value, dict):
+                self._flatten(path + ".", value)
+
+    def get(self, key, default=None, rtype=None):
+        value = self.values.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        return rtype(value) if rtype else value
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def diff(self, other):
+        """Return the set of keys whose values differ between two snapshots."""
+        return set(key for key in set(self.values) | set(other.values)
+                   if self.values.get(key, _MISSING) != other.values.get(key, _MISSING))
+
+class Config(TypedAccessors):
+    """Live configuration.
+       Holds the current ConfigSnapshot and replaces it atomically when the
+       backing file changes. Lookups always go to the current snapshot."""
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = []
+        self.failed_mtime = None
+        self.lock = threading.Lock()
+        self.snapshot = self.compile()
+
+    def compile(self):
+        mtime = os.path.getmtime(self.path)
+        with open(self.path) as fp:
+            return ConfigSnapshot(json.load(fp), mtime)
+
+    def get(self, key, default=None, rtype=None):
+        return self.snapshot.get(key, default, rtype)
+
+    def __contains__(self, key):
+        return key in self.snapshot
+
+    def view(self, prefix):
+        """Return a ConfigView rooted at prefix."""
+        return ConfigView(self, prefix)
+
+    def subscribe(self, callback, prefix=""):
+        """Call callback(old_snapshot, new_snapshot) after a reload that changed
+           prefix or anything below it. Callbacks run on the thread that noticed
+           the change, so keep them short.
+
+        Arguments:
+            callback [callable]: The callback you are registering.
+            prefix [string]: Dotted key to watch. The default watches everything."""
+        with self.lock:
+            self.subscribers.append((prefix, callback))
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s[1] != callback]
+
+    def check(self):
+        """Reload the configuration if the file's mtime changed."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime in (self.snapshot.mtime, self.failed_mtime):
+            return
+        try:
+            snapshot = self.compile()
+        except (IOError, OSError, ValueError) as e:
+            self.failed_mtime = mtime
+            logger.error("Not reloading {0}, keeping the old configuration: {1}"
+                         .format(self.path, e))
+            return
+        self.swap(snapshot)
+
+    def swap(self, snapshot):
+        """Replace the current snapshot and notify subscribers."""
+        with self.lock:
+            old, self.snapshot = self.snapshot, snapshot
+            subscribers = list(self.subscribers)
+        changed = old.diff(snapshot)
+        if not changed:
+            return
+        logger.info("Configuration reloaded ({0} keys changed).".format(len(changed)))
+        for prefix, callback in subscribers:
+            if prefix and not any(key == prefix or key.startswith(prefix + ".")
+                                  for key in changed):
+                continue
+            try:
+                callback(old, snapshot)
+            except Exception:
+                logger.error("Exception in configuration subscriber {0}".format(callback),
+                             exc_info=1)
+
+class ConfigView(TypedAccessors):
+    """Read-only view of the configuration below a key prefix.
+       Extensions receive one of these as their settings. It reads through to
+       the live Config, so it never goes stale after a reload."""
+    def __init__(self, config, prefix):
+        self.config = config
+        self.prefix = prefix + "." if prefix else ""
+
+    def get(self, key, default=None, rtype=None):
+        return self.config.get(self.prefix + key, default, rtype)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return (self.prefix + key) in self.config
+
+    def keys(self):
+        return list(self.config.get(self.prefix[:-1], {}).keys())
+
+    def view(self, key):
+        return ConfigView(self.config, self.prefix + key)
+
+    def subscribe(self, callback, key=""):
+        """Like Config.subscribe, relative to this view."""
+        self.config.subscribe(callback, self.prefix + key if key else self.prefix[:-1])
+
+    def unsubscribe(self, callback):
+        self.config.unsubscribe(callback)
+
+class ConfigurationError(Exception):
+    """Raised when Midori is not configured correctly"""
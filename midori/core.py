@@ -1,14 +1,21 @@
 import logging
-import json
 import re
 import os
 import sys
+import threading
 import time
 from collections import defaultdict
 
 import midori
 import midori.api
+import midori.caps
+import midori.config
 import midori.extloader
+import midori.httpclient
+import midori.network
+import midori.shard
+import midori.timers
+import midori.tls
 import midori.workers
 
 try:
@@ -27,92 +34,266 @@ class Midori(object):
     """A modular, non-blocking IRC bot."""
     def __init__(self, config_file="config.json"):
         self.basedir = os.path.realpath(".")
-        with open(os.path.join(self.basedir, config_file)) as fp:
-            self._config = json.load(fp)
-        self.api = midori.api.API(self)
+        self.config_file = config_file
+        self.configuration = midori.config.Config(os.path.join(self.basedir, config_file))
         self.loaded_extensions = 0
-        self.net_thread = None
-        self.read_queue = queue.Queue()
-        self.write_queue = queue.Queue()
+        self.ext_apis = {}
+        self.stub_apis = {}
+        # in a shard process, which shard this is; see midori.shard
+        self.shard_index = None
+        self.bus = None
         self.observers = defaultdict(lambda: [])
-        self.workers = midori.workers.ThreadPool(self._config.get("workers_size", 2))
+        self.stats_providers = {}
+        self.http_client = None
+        self.http_lock = threading.Lock()
+        self.tls = midori.tls.TLSCache()
+        # verb -> midori.workers.SHED_* rank; anything not listed is never shed
+        self.shed_policy = dict(self.config("queues.shed", {
+            "PRIVMSG": midori.workers.SHED_FIRST,
+            "NOTICE": midori.workers.SHED_LATE,
+        }))
+        self.dropped = defaultdict(lambda: defaultdict(lambda: 0))
+        self.last_overload = {}
+        self.overload_observers = []
+        self.flood_observers = []
+        self.overload_lock = threading.Lock()
+        self.read_queue = midori.workers.SheddingQueue(
+            "read", self.config("queues.read", 5000), self.shed_rank, self.on_shed)
+        self.workers = midori.workers.ThreadPool(self.config("workers_size", 2),
+                                                 self.config("queues.workers", 5000),
+                                                 self.on_shed)
+        self.timers = midori.timers.TimerWheel(self.workers.dispatch,
+                                               self.config("timers.resolution", 0.05))
+        self.timers.start()
+        self.watch_handles = []
+        # name -> midori.network.Network; extensions are handed the first
+        # (default) network's API, which follows the network of the event
+        # being handled
+        self.networks = midori.network.from_config(self)
+        self.api = list(self.networks.values())[0].api
+        self.api.register_stats("tls", self.tls.stats)
+        self.watch(self.configuration.check)
 
     def load_extensions(self):
-        ext_settings = self.config("extension", {})
+        search_dirs = [os.path.join(os.path.dirname(__file__), "base_exts")]
+        if not self.bus:
+            # with shards, the owner only runs the core
+            search_dirs.append(os.path.join(self.basedir, "extensions"))
+        manifest_cache = self.config("extension_manifest_cache", ".extension_manifests.json")
+        if self.shard_index is not None:
+            manifest_cache += ".{0}".format(self.shard_index)
         self.ext_manager = midori.extloader.ExtensionManager(
-            search_dirs=[os.path.join(os.path.dirname(__file__), "base_exts"),
-                         os.path.join(self.basedir, "extensions")],
+            search_dirs=search_dirs,
             blacklist=self.config("extension_blacklist", []),
+            manifest_cache=os.path.join(self.basedir, manifest_cache),
+            pinned=["midori.base"],
         )
-        self.ext_manager.load_extensions(lambda mod: (self.api, ext_settings.get(mod.__identifier__, {})))
+        self.ext_manager.load_extensions(self.extension_args,
+            self.install_stubs if self.config("extension_lazy_load", 1) else None)
         logger.info("I have {0} extensions loaded.".format(self.ext_manager.count()))
+        if self.config("extension_autoreload", 1):
+            self.watch(self.reload_extensions)
+        if self.config("extension_idle_timeout", 0):
+            self.watch(self.unload_idle_extensions)
+
+    def watch(self, check):
+        """Run check every config_poll_interval seconds, on the pool. A check
+           that is still running when the next one is due is skipped."""
+        self.watch_handles.append(self.timers.call_every(self.config("config_poll_interval", 5),
+                                                         check))
+
+    def extension_args(self, mod):
+        """Build the arguments passed to an extension's __init__."""
+        ext_id = mod.__identifier__
+        ext_api = midori.api.ExtensionAPI(self.api, ext_id,
+                                          lambda: self.ext_manager.is_ready(ext_id),
+                                          getattr(mod, "__sees_replicas__", 0))
+        self.ext_apis[ext_id] = ext_api
+        return (ext_api, self.configuration.view("extension.{0}".format(mod.__identifier__)))
+
+    def extension_unloaded(self, ext_id, extension):
+        self.ext_apis.pop(ext_id).release()
+
+    def install_stubs(self, ext_id, manifest):
+        """Hook the triggers of a dormant extension so that the first matching
+           event loads it. With manifest=None, remove those hooks again."""
+        stub_api = self.stub_apis.pop(ext_id, None)
+        if stub_api:
+            stub_api.release()
+        if manifest is None:
+            return
+        stub_api = midori.api.ExtensionAPI(self.api, ext_id)
+        activate = lambda event: self.activate_extension(ext_id, event)
+        for kind in manifest.triggers.get("raw", ()):
+            stub_api.hook_raw(kind, activate)
+        for prefix in manifest.triggers.get("commands", ()):
+            stub_api.hook_command(midori.CONTEXT_ALL, activate,
+                                  lambda cmd, prefix=prefix: cmd.message.startswith(prefix))
+        for host in manifest.triggers.get("urls", ()):
+            stub_api.hook_url(host, activate)
+        self.stub_apis[ext_id] = stub_api
+
+    def activate_extension(self, ext_id, event):
+        try:
+            self.ext_manager.activate(ext_id, self.extension_args)
+        except Exception:
+            logger.error("Cannot load {0} on demand.".format(ext_id), exc_info=1)
+            return
+        # the stub swallowed this event, hand it to the real hooks
+        self.ext_apis[ext_id].redeliver(event)
+
+    def unload_idle_extensions(self):
+        cutoff = time.time() - self.config("extension_idle_timeout", 0)
+        for ext_id in list(self.ext_manager.activated):
+            if ext_id not in self.ext_manager.activated:
+                continue
+            doomed = self.ext_manager.dependents(ext_id)
+            if all(self.ext_apis[i].last_used < cutoff for i in doomed):
+                try:
+                    self.ext_manager.deactivate(ext_id, self.extension_unloaded)
+                except midori.extloader.LoadError as e:
+                    logger.debug(str(e))
+                else:
+                    logger.info("Unloaded idle extension {0}.".format(ext_id))
+
+    def reload_extensions(self):
+        """Reload extensions whose source changed. The connection stays up."""
+        reloaded = self.ext_manager.reload_changed(self.extension_args, self.extension_unloaded)
+        if reloaded:
+            logger.info("Reloaded extensions: {0}".format(", ".join(reloaded)))
+            self.ext_manager.start_extensions(self.workers.dispatch)
 
     def run(self):
-        self.irc_nick = self.config("identity.nick", "")
-        self.irc_user = self.config("identity.user", "")
-        self.irc_host = self.config("server.host", "")
-        self.irc_port = self.config("server.port", 0)
-        self.irc_realname = self.config("identity.real_name", "")
-        self.api.nick = self.irc_nick
+        for network in self.networks.values():
+            network.check_config()
+        if self.config("shards.count", 0) and not self.bus:
+            self.bus = midori.shard.ShardBus(self, self.config_file, self.config("shards.count"))
+            self.api.register_stats("shards", self.bus.stats)
+            self.bus.start()
         if not self.loaded_extensions:
+            # only the fast register phase runs here, start() phases run on the
+            # pool while we connect
             self.load_extensions()
-        for cf in ("irc_nick", "irc_user", "irc_host", "irc_port", "irc_realname"):
-            if not getattr(self, cf):
-                raise ConfigurationError("Mis-configured key: {0}. Please check.".format(cf))
-        self.use_ssl = self.config("server.use_ssl", -1)
-        if self.use_ssl not in (0, 1):
-            raise ConfigurationError("Mis-configured key: use_ssl.")
+            self.ext_manager.start_extensions(self.workers.dispatch)
+        for network in self.networks.values():
+            network.connect()
+        # one loop serves every network; lost connections are retried on a timer
+        multi = len(self.networks) > 1
         while 1:
-            self.net_thread = midori.workers.NetworkThread(self, self.irc_host,
-                                                           self.irc_port, self.use_ssl,
-                                                           self.read_queue, self.write_queue)
-            self.net_thread.start()
-            self.handshake()
-            while self.net_thread.is_alive():
-                try:
-                    cmd = self.read_queue.get(timeout=300)
-                except queue.Empty:
-                    self.api.send_raw("PING :{0}".format(self.irc_nick))
-                if not cmd:
-                    break
-                midori.net_recv.info("\033[32m{0}\033[0m".format(fix_log_string(cmd.string_rep)))
-                for callback, predicate in self.observers[cmd.kind]:
-                    if predicate(cmd):
-                        self.workers.dispatch(callback, args=(cmd,))
-            logger.error("Disconnected from IRC. Trying again in 360 seconds...")
-            time.sleep(360)
+            try:
+                cmd = self.read_queue.get(timeout=5)
+            except queue.Empty:
+                continue
+            network = cmd.network
+            network.last_read = time.time()
+            midori.net_recv.info("\033[32m{0}{1}\033[0m".format(
+                "[{0}] ".format(network.name) if multi else "", fix_log_string(cmd.string_rep)))
+            self.dispatch_command(cmd)
+            # PRIVMSGs are passed on by the core once they have passed the flood checks
+            if self.bus and cmd.kind != "PRIVMSG":
+                self.bus.route(cmd)
+
+    def dispatch_command(self, cmd):
+        """Run the raw hooks for a Command on the pool."""
+        shed = self.shed_policy.get(cmd.kind, midori.workers.SHED_NEVER)
+        for callback, predicate in self.observers[cmd.kind]:
+            if predicate(cmd):
+                self.workers.dispatch(callback, args=(cmd,), shed=shed, network=cmd.network)
+
+    def shed_rank(self, item):
+        """Shed rank of a queued line or Command, from the verb policy."""
+        if item is None:
+            return midori.workers.SHED_NEVER
+        return self.shed_policy.get(item_kind(item), midori.workers.SHED_NEVER)
+
+    def on_shed(self, shed_queue, item):
+        """Count a dropped item, and tell the overload observers at most once
+           per queues.event_interval seconds per queue."""
+        if isinstance(item, midori.workers.ThreadPoolTask):
+            item = item.args[0] if item.args else None
+        kind = item_kind(item) if item is not None else "task"
+        now = time.time()
+        with self.overload_lock:
+            self.dropped[shed_queue.name][kind] += 1
+            if now - self.last_overload.get(shed_queue.name, 0) < self.config("queues.event_interval", 1):
+                return
+            self.last_overload[shed_queue.name] = now
+            event = midori.api.OverloadEvent(shed_queue.name, shed_queue.qsize(),
+                                             shed_queue.maxsize,
+                                             dict(self.dropped[shed_queue.name]))
+        logger.warn("Queue {0} is full, dropping: {1}".format(event.queue, event.dropped))
+        for callback in list(self.overload_observers):
+            self.workers.dispatch(callback, args=(event,))
+
+    def queue_stats(self):
+        stats = {}
+        queues = [self.read_queue, self.workers.queue]
+        queues.extend(network.write_queue for network in self.networks.values())
+        if self.bus:
+            queues.extend(shard.queue for shard in self.bus.shards)
+        for shed_queue in queues:
+            stats[shed_queue.name] = shed_queue.stats()
+            stats[shed_queue.name]["dropped_by_kind"] = dict(self.dropped[shed_queue.name])
+        return stats
 
     def config(self, key, default=None, rtype=lambda x: x):
-        value = self._config
-        # so you can use . in key for drilling into subobjects
-        for i in key.split("."):
-            if i in value:
-                value = value[i]
-            else:
-                # call for key in global config, or return caller's default
-                return default
-        return rtype(value)
+        # keys are dotted paths into the current snapshot, eg "server.port"
+        return self.configuration.get(key, default, rtype)
 
-    def handshake(self):
-        pass_ = self.config("server.password", "")
-        if pass_:
-            self.api.send_raw("PASS {0}".format(pass_))
-        self.api.send_raw("NICK {0}".format(self.irc_nick))
-        self.api.send_raw("USER {0} * 8 :{1}".format(self.irc_user, self.irc_realname))
+    def get_http_client(self):
+        """Return the shared HTTPClient, creating it on first use."""
+        with self.http_lock:
+            if self.http_client is None:
+                self.http_client = midori.httpclient.HTTPClient(
+                    max_concurrency=self.config("http.max_concurrency", 10),
+                    per_host=self.config("http.per_host", 4),
+                    timeout=self.config("http.timeout", 30),
+                    max_queued=self.config("http.max_queued", 1000),
+                    user_agent=self.config("http.user_agent", None))
+                self.api.register_stats("http", self.http_client.stats)
+            return self.http_client
+
+    def quit(self, message=""):
+        """Send QUIT on every network."""
+        for network in self.networks.values():
+            if network.connected:
+                network.api.send_raw("QUIT :{0}".format(message))
 
     def exit(self):
         logger.warn("Shutting down. Bye bye!")
+        for handle in self.watch_handles:
+            handle.cancel()
+        if hasattr(self, "ext_manager"):
+            self.ext_manager.unload_all(self.extension_unloaded)
+        if self.bus:
+            self.bus.stop()
+        self.timers.stop()
         self.workers.stop()
-        if self.net_thread:
-            self.net_thread.stopping = 1
-            logger.info("Waiting for network thread to die...")
-            self.net_thread.join()
+        if self.http_client:
+            self.http_client.close()
+        for network in self.networks.values():
+            network.disconnect()
         return 0
 
+def item_kind(item):
+    """Return the verb of a Command or of an encoded outgoing line."""
+    if isinstance(item, bytes):
+        return item.split(b" ", 1)[0].decode("ascii", "replace").upper()
+    return getattr(item, "kind", "other")
+
 class Command(object):
     """high-level IRC command"""
-    def __init__(self, command):
+    def __init__(self, command, network=None):
         self.string_rep = command
+        # the midori.network.Network this line came from
+        self.network = network
+        self.received = time.time()
+        # IRCv3 message tags, eg {"time": "...", "batch": "ref"}
+        self.tags = {}
+        if command.startswith("@"):
+            tags, _, command = command.partition(" ")
+            self.tags = midori.caps.parse_tags(tags[1:])
+            command = command.lstrip(" ")
         if " :" in command:
             left, self.message = command.split(" :", 1)
         else:
@@ -127,11 +308,21 @@ class Command(object):
                 self.sender = tuple(user)
         self.kind = self.args.pop(0)
 
+    @property
+    def api(self):
+        """The API of the network this line came from."""
+        return self.network.api if self.network is not None else None
+
+    @property
+    def time(self):
+        """When the line was sent: the server's server-time tag if it has
+           one, else when we read it."""
+        return midori.caps.parse_time(self.tags.get("time")) or self.received
+
     def __repr__(self):
         return "<midori.core.Command({0})>".format(self.string_rep)
 
     def __str__(self):
         return self.string_rep
 
-class ConfigurationError(Exception):
-    """Raised when Midori is not configured correctly"""
+ConfigurationError = midori.config.ConfigurationError
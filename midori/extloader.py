@@ -1,7 +1,13 @@
+import ast
+import hashlib
 import imp
+import json
 import logging
 import os
 import sys
+import threading
+import time
+from collections import defaultdict, deque
 
 """
 This module manages your program's extensions.
@@ -11,23 +17,123 @@ them, this only provides an interface to manage them.
 
 logger = logging.getLogger(__name__)
 
+# extension lifecycle: constructed (hooks registered) -> start() running -> usable
+# dormant extensions are known but not imported; their triggers are stubbed out
+STATE_DORMANT = "dormant"
+STATE_REGISTERED = "registered"
+STATE_STARTING = "starting"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+MANIFEST_FIELDS = ("__identifier__", "__dependencies__", "__ext_class__", "__version__")
+# __triggers__ = {"commands": ["*prefix", ...], "raw": ["VERB", ...],
+# "urls": ["example.com", ...]} makes an extension lazy: it is only imported
+# the first time one of those fires.
+OPTIONAL_MANIFEST_FIELDS = ("__triggers__",)
+
+def extension_source(full_path):
+    """Return the file holding an extension's manifest, or None if full_path
+       doesn't look like an extension."""
+    if full_path.endswith(".py") and os.path.isfile(full_path):
+        return full_path
+    init = os.path.join(full_path, "__init__.py")
+    if os.path.isdir(full_path) and os.path.isfile(init):
+        return init
+    return None
+
+class Manifest(object):
+    """Extension metadata, read from the module source without importing it.
+       __identifier__, __dependencies__ and __triggers__ must be literals;
+       __version__ may be any expression, in which case it is only known after
+       import."""
+    def __init__(self, path, source, mtime, digest, identifier, dependencies, version,
+                 triggers=None):
+        self.path = path
+        self.source = source
+        self.mtime = mtime
+        self.digest = digest
+        self.identifier = identifier
+        self.dependencies = list(dependencies)
+        self.version = version
+        self.triggers = triggers
+
+    @classmethod
+    def parse(cls, path, source, data, mtime, digest):
+        try:
+            tree = ast.parse(data, source)
+        except SyntaxError as e:
+            raise LoadError("The extension in '{0}' cannot be parsed: {1}".format(source, e))
+        fields = {}
+        for node in tree.body:
+            if not (isinstance(node, ast.Assign) and len(node.targets) == 1
+                    and isinstance(node.targets[0], ast.Name)
+                    and node.targets[0].id in MANIFEST_FIELDS + OPTIONAL_MANIFEST_FIELDS):
+                continue
+            try:
+                fields[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                fields[node.targets[0].id] = None
+        for magic_var in MANIFEST_FIELDS:
+            if magic_var not in fields:
+                raise LoadError("The extension in '{0}' has no {1}. It cannot "
+                                "be loaded.".format(source, magic_var))
+        if fields["__identifier__"] is None or not isinstance(fields["__dependencies__"],
+                                                               (list, tuple)):
+            raise LoadError("The extension in '{0}' must declare __identifier__ and "
+                            "__dependencies__ as literals.".format(source))
+        triggers = fields.get("__triggers__")
+        if "__triggers__" in fields and not isinstance(triggers, dict):
+            raise LoadError("The extension in '{0}' must declare __triggers__ as a "
+                            "literal dict.".format(source))
+        return cls(path, source, mtime, digest, fields["__identifier__"],
+                   fields["__dependencies__"], fields["__version__"], triggers)
+
+    def to_dict(self):
+        return {
+            "source": self.source,
+            "mtime": self.mtime,
+            "digest": self.digest,
+            "identifier": self.identifier,
+            "dependencies": self.dependencies,
+            "version": self.version,
+            "triggers": self.triggers,
+        }
+
+    @classmethod
+    def from_dict(cls, path, d):
+        return cls(path, d["source"], d["mtime"], d["digest"], d["identifier"],
+                   d["dependencies"], d["version"], d.get("triggers"))
+
 class ExtensionManager(object):
     def __init__(self, search_dirs=(os.path.join(os.path.realpath("."), "extensions"),),
-                 blacklist=()):
+                 blacklist=(), manifest_cache=None, pinned=()):
         """Main extension loader class.
            - search_dirs: Iterable containing where to look for loadable extensions.
                           (The default is ./extensions, where . is the current directory.
            - blacklist: Iterable containing the identifiers of extensions that will
                         not be loaded.
-           - init_args: The positional arguments that will be passed to the __init__
-                        methods of extensions.
-           - init_kwargs: The keyword arguments that will be passed to the __init__
-                          methods of extensions."""
-        self._recursiondepth = 0
-        self.file_map = {}
+           - manifest_cache: Optional path of a JSON file used to remember extension
+                             manifests between runs. Entries are keyed by path and
+                             revalidated by mtime, then by content hash.
+           - pinned: Iterable containing the identifiers of extensions that can never
+                     be unloaded or reloaded."""
         self.search_dirs = list(search_dirs)
         self.blacklist = list(blacklist)
+        self.pinned = set(pinned)
+        self.manifest_cache = manifest_cache
+        self.manifests = {}
+        self.modules = {}
         self.extensions = {}
+        self.loaded = {}
+        self.dormant = {}
+        self.activated = set()
+        self.lazy_callback = None
+        self.activation_lock = threading.RLock()
+        self.states = {}
+        self.start_times = {}
+        self.state_lock = threading.Lock()
+        self.saved_entries = None
+        self.load_manifest_cache()
 
     def count(self):
         """Returns the number of extensions loaded."""
@@ -41,36 +147,179 @@ class ExtensionManager(object):
         except KeyError:
             raise ExtensionMissingError(ext_id)
 
+    def load_manifest_cache(self):
+        if not self.manifest_cache or not os.path.exists(self.manifest_cache):
+            return
+        try:
+            with open(self.manifest_cache) as fp:
+                entries = json.load(fp)
+            self.manifests = dict((path, Manifest.from_dict(path, d))
+                                  for path, d in entries.items())
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            logger.warn("Extension manifest cache is unreadable. Rebuilding it.")
+            self.manifests = {}
+
+    def save_manifest_cache(self):
+        if not self.manifest_cache:
+            return
+        entries = dict((path, m.to_dict()) for path, m in self.manifests.items())
+        if entries == self.saved_entries:
+            return
+        self.saved_entries = entries
+        try:
+            with open(self.manifest_cache + ".tmp", "w") as fp:
+                json.dump(entries, fp)
+            os.rename(self.manifest_cache + ".tmp", self.manifest_cache)
+        except (IOError, OSError) as e:
+            logger.warn("Cannot write extension manifest cache: {0}".format(e))
+
+    def refresh_manifest(self, full_path, source):
+        """[internal] Return an up-to-date manifest for the extension at full_path."""
+        mtime = os.path.getmtime(source)
+        cached = self.manifests.get(full_path)
+        if cached and cached.mtime == mtime:
+            return cached
+        with open(source, "rb") as fp:
+            data = fp.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if cached and cached.digest == digest:
+            cached.mtime = mtime
+            return cached
+        return Manifest.parse(full_path, source, data, mtime, digest)
+
     def scan_dirs(self):
-        """[internal] Refresh the list of extensions that can be loaded."""
-        sys.dont_write_bytecode = True
+        """[internal] Refresh the list of extensions that can be loaded.
+           This reads manifests only; no extension code is executed."""
+        found = {}
         for path in self.search_dirs:
-            logger.info("Scanning directory {0}...".format(os.path.abspath(path)))
-            for ext_file in os.listdir(path):
+            if not os.path.isdir(path):
+                continue
+            logger.debug("Scanning directory {0}...".format(os.path.abspath(path)))
+            for ext_file in sorted(os.listdir(path)):
                 full_path = os.path.join(path, ext_file)
-                if not any((ext_file.endswith(".py"),
-                            os.path.isdir(full_path))):
+                source = extension_source(full_path)
+                if not source:
                     continue
-                cached_mtime = self.file_map.get(full_path, (0,))[0]
-                if os.path.getmtime(full_path) != cached_mtime:
-                    mod = imp.load_source("pbx.{0}".format(ext_file), full_path)
-                    try:
-                        self.check_validity(mod)
-                    except LoadError:
-                        pass
-                    else:
-                        self.file_map[full_path] = (os.path.getmtime(full_path),
-                                                    mod.__identifier__, mod.__version__)
+                try:
+                    found[full_path] = self.refresh_manifest(full_path, source)
+                except LoadError as ex:
+                    logger.error(str(ex))
+        self.manifests = found
+        self.save_manifest_cache()
+        return found
+
+    def candidates(self, warn=1):
+        """[internal] Map identifiers to manifests, minus blacklisted and
+           duplicate extensions."""
+        candidates = {}
+        for path in sorted(self.manifests):
+            manifest = self.manifests[path]
+            if manifest.identifier in self.blacklist:
+                if warn:
+                    logger.warn("Extension candidate from {0} is on the blacklist. "
+                                "Skipping.".format(path))
+            elif manifest.identifier in candidates:
+                if warn:
+                    logger.warn("There is already an extension with the identifier '{0}'. "
+                                "Skipping.".format(manifest.identifier))
+            else:
+                candidates[manifest.identifier] = manifest
+        return candidates
+
+    def resolve(self, candidates, roots=None):
+        """Return the identifiers of roots (default: all candidates) and their
+           dependencies, ordered so that every extension comes after the ones it
+           depends on. Extensions that are already loaded are left out."""
+        closure = set()
+        stack = list(roots if roots is not None else candidates)
+        while stack:
+            ext_id = stack.pop()
+            if ext_id in closure or ext_id in self.extensions:
+                continue
+            if ext_id not in candidates:
+                raise ExtensionMissingError(ext_id)
+            closure.add(ext_id)
+            for dependency in candidates[ext_id].dependencies:
+                if dependency not in candidates and dependency not in self.extensions:
+                    raise DependencyError("Unsatisfied dependency {0} for extension {1}."
+                                          .format(dependency, ext_id))
+                stack.append(dependency)
+
+        return self.order(dict((ext_id, candidates[ext_id]) for ext_id in closure))
+
+    def order(self, manifests):
+        """[internal] Topologically sort manifests (a dict of identifier to
+           Manifest), only considering dependencies inside manifests.
+           Pinned extensions are the core that the API of the others relies
+           on, so every other extension implicitly depends on them."""
+        core = set(ext_id for ext_id in manifests if ext_id in self.pinned)
+        pending = dict((ext_id, set(d for d in m.dependencies if d in manifests) |
+                                (set() if ext_id in core else core))
+                       for ext_id, m in manifests.items())
+        dependents = defaultdict(list)
+        for ext_id, deps in pending.items():
+            for dependency in deps:
+                dependents[dependency].append(ext_id)
+        ready = deque(sorted(ext_id for ext_id, deps in pending.items() if not deps))
+        order = []
+        while ready:
+            ext_id = ready.popleft()
+            order.append(ext_id)
+            for dependent in sorted(dependents[ext_id]):
+                pending[dependent].discard(ext_id)
+                if not pending[dependent]:
+                    ready.append(dependent)
+        if len(order) != len(manifests):
+            raise DependencyError("Dependency cycle: {0}."
+                                  .format(" -> ".join(self.find_cycle(pending))))
+        return order
+
+    def find_cycle(self, pending):
+        """[internal] Walk unresolved dependencies until one repeats."""
+        path = [sorted(ext_id for ext_id, deps in pending.items() if deps)[0]]
+        while path.count(path[-1]) < 2:
+            path.append(sorted(pending[path[-1]])[0])
+        return path[path.index(path[-1]):]
 
     def check_validity(self, mod):
         """Check that an extension module has the four magic attributes
            required by the loader."""
-        for magic_var in ("__identifier__", "__dependencies__", "__ext_class__",
-                          "__version__"):
+        for magic_var in MANIFEST_FIELDS:
             if not hasattr(mod, magic_var):
                 raise LoadError("The extension in '{0}' has no {1}. It cannot "
                                 "be loaded.".format(mod.__file__, magic_var))
 
+    def import_module(self, manifest):
+        """[internal] Execute an extension's module code. This is the only place
+           where that happens."""
+        name = "pbx.{0}".format(os.path.basename(manifest.path))
+        if manifest.source != manifest.path:
+            mod = imp.load_package(name, manifest.path)
+        else:
+            mod = imp.load_source(name, manifest.path)
+        self.check_validity(mod)
+        if mod.__identifier__ != manifest.identifier:
+            raise LoadError("The extension in '{0}' changed its identifier while loading."
+                            .format(manifest.path))
+        return mod
+
+    def load_manifest(self, manifest, preload_callback):
+        """[internal] Import and construct one extension whose dependencies are
+           already loaded."""
+        mod = self.import_module(manifest)
+        logger.info("Loading {0} {1}.".format(mod.__identifier__, mod.__version__))
+        self.modules[mod.__identifier__] = mod
+        self.loaded[mod.__identifier__] = manifest
+        self.states[mod.__identifier__] = STATE_REGISTERED
+        try:
+            self.extensions[mod.__identifier__] = mod.__ext_class__(*preload_callback(mod))
+        except Exception:
+            del self.modules[mod.__identifier__], self.loaded[mod.__identifier__]
+            del self.states[mod.__identifier__]
+            sys.modules.pop(mod.__name__, None)
+            raise
+        return mod.__identifier__
+
     def load_extension_from_file(self, filename, preload_callback):
         """Try to load an extension from filename.
            This will not return an extrnsion object, instead it will return the identifier
@@ -78,69 +327,280 @@ class ExtensionManager(object):
            Use ExtensionManager.get_extension() to get the loaded extension object."""
         self.scan_dirs()
         for path in self.search_dirs:
-            if os.path.join(path, filename) in self.file_map:
-                candidate = os.path.join(path, filename)
+            if os.path.join(path, filename) in self.manifests:
+                manifest = self.manifests[os.path.join(path, filename)]
                 break
         else:
             raise LoadError("No such file: {0}".format(filename))
-        mod = imp.load_source("pbx.{0}".format(os.path.basename(candidate)), candidate)
-        return self.load_with_dependencies(mod, preload_callback)
-
-    def load_with_dependencies(self, mod, preload_callback):
-        """Try to load an extension, with all dependencies, from the module mod.
-           Returns the identifier of mod on success."""
-        self._recursiondepth += 1
-        if self._recursiondepth > 15:
-            raise DependencyError("We bounced around too many times trying to load {0}."
-                                  .format(mod.__file__))
-        for dependency in mod.__dependencies__:
-            if dependency in self.extensions:
-                continue
-            for filename in self.file_map:
-                if self.file_map[filename][1] == dependency:
-                    mod = imp.load_source("pbx.{0}".format(os.path.basename(filename)), filename)
-                    self.load_with_dependencies(mod, preload_callback)
-            else:
-                raise DependencyError("Unsatisfied dependency {0} for extension {1}."
-                                      .format(dependency, mod.__file__))
-        logger.info("Dependencies loaded.")
-        self.extensions[mod.__identifier__] = mod.__ext_class__(*preload_callback(mod))
-        self._recursiondepth -= 1
-        return mod.__identifier__
+        return self.load_with_dependencies(manifest.identifier, preload_callback)
 
-    def load_extensions(self, preload_callback):
+    def load_with_dependencies(self, ext_id, preload_callback):
+        """Try to load an extension, with all dependencies, by identifier.
+           Returns ext_id on success."""
+        candidates = self.candidates()
+        sys.dont_write_bytecode = True
+        try:
+            for dependency in self.resolve(candidates, roots=[ext_id]):
+                self.load_manifest(candidates[dependency], preload_callback)
+        finally:
+            sys.dont_write_bytecode = False
+        return ext_id
+
+    def load_extensions(self, preload_callback, lazy_callback=None):
         """Actually load the extensions.
            preload_callback is called before an extension object is constructed.
            Return values will be passed to the extension's __init__.
+           If lazy_callback is given, extensions declaring __triggers__ are left
+           dormant instead: lazy_callback(ext_id, manifest) should install stubs
+           for manifest.triggers that call ExtensionManager.activate(), and
+           lazy_callback(ext_id, None) should remove them again.
            When this method returns, extension objects can be accessed using
            ExtensionManager.get_extension()."""
-        sys.dont_write_bytecode = True
+        self.lazy_callback = lazy_callback
         self.scan_dirs()
-        modules = []
-        for path in self.search_dirs:
-            for ext_file in os.listdir(path):
-                if not any((ext_file.endswith(".py"),
-                            os.path.isdir(os.path.join(path, ext_file)))):
+        candidates = self.candidates()
+        order = self.resolve(candidates)
+        lazy = self.lazy_subset(candidates, order)
+        sys.dont_write_bytecode = True
+        try:
+            for ext_id in order:
+                if ext_id in lazy:
+                    self.park(candidates[ext_id])
+                else:
+                    self.load_manifest(candidates[ext_id], preload_callback)
+        finally:
+            sys.dont_write_bytecode = False
+
+    def lazy_subset(self, candidates, ext_ids):
+        """[internal] Return the members of ext_ids that may stay dormant: the
+           ones with triggers that no eagerly loaded extension depends on."""
+        if not self.lazy_callback:
+            return set()
+        lazy = set(i for i in ext_ids if candidates[i].triggers)
+        while 1:
+            needed = set()
+            stack = [i for i in ext_ids if i not in lazy] + list(self.extensions)
+            while stack:
+                ext_id = stack.pop()
+                manifest = candidates.get(ext_id) or self.loaded.get(ext_id)
+                for dependency in (manifest.dependencies if manifest else ()):
+                    if dependency not in needed:
+                        needed.add(dependency)
+                        stack.append(dependency)
+            if not lazy & needed:
+                return lazy
+            lazy -= needed
+
+    def park(self, manifest):
+        """[internal] Leave an extension dormant behind its trigger stubs."""
+        logger.info("{0} will be loaded on demand.".format(manifest.identifier))
+        self.dormant[manifest.identifier] = manifest
+        self.states[manifest.identifier] = STATE_DORMANT
+        self.lazy_callback(manifest.identifier, manifest)
+
+    def unpark(self, ext_id):
+        """[internal] Forget a dormant extension and remove its stubs."""
+        del self.dormant[ext_id]
+        self.states.pop(ext_id, None)
+        self.lazy_callback(ext_id, None)
+
+    def activate(self, ext_id, preload_callback):
+        """Load a dormant extension, and any dormant dependencies, then run their
+           start() phases on the calling thread. Returns once ext_id is ready,
+           or immediately if it is already loaded."""
+        with self.activation_lock:
+            if ext_id in self.extensions:
+                return
+            candidates = dict(self.dormant)
+            sys.dont_write_bytecode = True
+            try:
+                for dependency in self.resolve(candidates, roots=[ext_id]):
+                    self.unpark(dependency)
+                    self.load_manifest(candidates[dependency], preload_callback)
+                    self.activated.add(dependency)
+            finally:
+                sys.dont_write_bytecode = False
+            self.start_extensions(lambda call, args: call(*args))
+
+    def deactivate(self, ext_id, unload_callback=None):
+        """Unload an extension that was activated on demand and put it back to
+           sleep, along with its dependents. Returns the identifiers unloaded."""
+        with self.activation_lock:
+            doomed = self.dependents(ext_id)
+            manifests = [self.loaded[victim] for victim in doomed]
+            if not all(m.triggers for m in manifests):
+                raise LoadError("{0} has dependents that cannot be loaded on demand."
+                                .format(ext_id))
+            self.delete_extension(ext_id, unload_callback)
+            for manifest in manifests:
+                self.activated.discard(manifest.identifier)
+                self.park(manifest)
+            return doomed
+
+    def is_ready(self, ext_id):
+        return self.states.get(ext_id) == STATE_READY
+
+    def start_extensions(self, dispatch):
+        """Run the start() phase of every registered extension.
+           Constructing an extension should only register its hooks; anything
+           slow (logging in somewhere, opening databases, starting threads)
+           belongs in an optional start() method. Those are run with
+           dispatch(call, args), in parallel, as soon as the extensions they
+           depend on are ready. Extensions without start() are ready at once.
+           This returns immediately; check ExtensionManager.states for progress."""
+        with self.state_lock:
+            runnable = self.next_startable()
+        for ext_id in runnable:
+            dispatch(self.run_start, args=(ext_id, dispatch))
+
+    def next_startable(self):
+        """[internal] Mark startable extensions as starting and return the ones
+           that have a start() method. Call with state_lock held."""
+        runnable = []
+        progress = 1
+        while progress:
+            progress = 0
+            for ext_id, state in list(self.states.items()):
+                if state != STATE_REGISTERED:
                     continue
-                mod = imp.load_source("pbx.{0}".format(ext_file), os.path.join(path, ext_file))
-                try:
-                    self.check_validity(mod)
-                except LoadError as ex:
-                    logger.error(str(ex))
-                if mod.__identifier__ in self.blacklist:
-                    logger.warn("Extension candidate from {0} is on the blacklist. "
-                                "Skipping.".format(mod.__file__))
+                deps = [self.states.get(d) for d in self.loaded[ext_id].dependencies]
+                if STATE_FAILED in deps:
+                    logger.error("Not starting {0}, a dependency failed.".format(ext_id))
+                    self.states[ext_id] = STATE_FAILED
+                elif all(d in (STATE_READY, None) for d in deps):
+                    if hasattr(self.extensions[ext_id], "start"):
+                        self.states[ext_id] = STATE_STARTING
+                        runnable.append(ext_id)
+                        continue
+                    self.states[ext_id] = STATE_READY
+                else:
                     continue
-                modules.append(mod)
-        for ext_module in modules:
-            if ext_module.__identifier__ in self.extensions:
-                logger.warn("There is already an extension with the identifier '{0}'. "
-                            "Skipping.".format(ext_module.__identifier__))
-            self.load_with_dependencies(ext_module, preload_callback)
-        sys.dont_write_bytecode = False
-
-    def delete_extension(self, ext_id):
-        pass
+                progress = 1
+        return runnable
+
+    def run_start(self, ext_id, dispatch):
+        """[internal] Run one extension's start() and kick off its dependents."""
+        extension = self.extensions.get(ext_id)
+        if extension is None:
+            return
+        began = time.time()
+        try:
+            extension.start()
+        except Exception:
+            logger.error("{0} failed to start.".format(ext_id), exc_info=1)
+            state = STATE_FAILED
+        else:
+            state = STATE_READY
+        self.start_times[ext_id] = time.time() - began
+        logger.info("{0} is {1} after {2:.2f}s.".format(ext_id, state, self.start_times[ext_id]))
+        with self.state_lock:
+            if self.states.get(ext_id) == STATE_STARTING:
+                self.states[ext_id] = state
+            runnable = self.next_startable()
+        for other in runnable:
+            dispatch(self.run_start, args=(other, dispatch))
+
+    def dependents(self, ext_id):
+        """Return ext_id and every loaded extension that depends on it, directly
+           or not, in the order they should be unloaded (dependents first)."""
+        doomed = set([ext_id])
+        changed = 1
+        while changed:
+            changed = 0
+            for other, manifest in self.loaded.items():
+                if other not in doomed and doomed.intersection(manifest.dependencies):
+                    doomed.add(other)
+                    changed = 1
+        return list(reversed(self.order(dict((i, self.loaded[i]) for i in doomed))))
+
+    def delete_extension(self, ext_id, unload_callback=None):
+        """Unload an extension, and everything that depends on it.
+           The extension's unload() method is called if it has one, then
+           unload_callback(ext_id, extension_object) so the owner can release
+           whatever it handed out in preload_callback.
+           Returns the identifiers that were unloaded."""
+        if ext_id not in self.extensions:
+            raise ExtensionMissingError(ext_id)
+        doomed = self.dependents(ext_id)
+        pinned = self.pinned.intersection(doomed)
+        if pinned:
+            raise LoadError("Refusing to unload pinned extension(s): {0}"
+                            .format(", ".join(sorted(pinned))))
+        for victim in doomed:
+            self.teardown(victim, unload_callback)
+        return doomed
+
+    def unload_all(self, unload_callback=None):
+        """Unload every extension, pinned ones included, dependents first.
+           Used at shutdown so extensions can flush their state."""
+        for victim in reversed(self.order(dict(self.loaded))):
+            self.teardown(victim, unload_callback)
+
+    def teardown(self, victim, unload_callback):
+        """[internal] Unload a single extension."""
+        extension = self.extensions.pop(victim)
+        logger.info("Unloading {0}.".format(victim))
+        if hasattr(extension, "unload"):
+            try:
+                extension.unload()
+            except Exception:
+                logger.error("Exception unloading {0}".format(victim), exc_info=1)
+        if unload_callback:
+            unload_callback(victim, extension)
+        del self.loaded[victim]
+        self.activated.discard(victim)
+        self.states.pop(victim, None)
+        self.start_times.pop(victim, None)
+        sys.modules.pop(self.modules.pop(victim).__name__, None)
+
+    def reload_changed(self, preload_callback, unload_callback=None):
+        """Rescan the search directories. Extensions whose source changed (or
+           disappeared) are unloaded with their dependents, then changed and new
+           extensions are loaded again. Returns the identifiers that were loaded."""
+        # activate, deactivate and the idle unloader run on other threads
+        with self.activation_lock:
+            self.scan_dirs()
+            candidates = self.candidates(warn=0)
+            changed = [ext_id for ext_id, manifest in self.loaded.items()
+                       if ext_id not in self.pinned and (ext_id not in candidates
+                           or candidates[ext_id].digest != manifest.digest)]
+            for ext_id, manifest in list(self.dormant.items()):
+                if ext_id not in candidates or candidates[ext_id].digest != manifest.digest:
+                    self.unpark(ext_id)
+            to_load = set(ext_id for ext_id in candidates
+                          if ext_id not in self.extensions and ext_id not in self.dormant)
+            for ext_id in changed:
+                if ext_id in self.extensions:
+                    to_load.update(self.delete_extension(ext_id, unload_callback))
+            to_load.intersection_update(candidates)
+            if not to_load:
+                return []
+            loaded = []
+            sys.dont_write_bytecode = True
+            try:
+                order = self.resolve(candidates, roots=to_load)
+                lazy = self.lazy_subset(candidates, order)
+                for ext_id in order:
+                    if ext_id in self.dormant:
+                        if ext_id in lazy:
+                            continue
+                        self.unpark(ext_id)
+                    elif ext_id in lazy:
+                        self.park(candidates[ext_id])
+                        continue
+                    if not set(candidates[ext_id].dependencies).issubset(self.extensions):
+                        logger.error("Not reloading {0}, a dependency failed to load."
+                                     .format(ext_id))
+                        continue
+                    try:
+                        loaded.append(self.load_manifest(candidates[ext_id], preload_callback))
+                    except Exception:
+                        logger.error("Cannot reload {0}".format(ext_id), exc_info=1)
+            except (DependencyError, ExtensionMissingError) as e:
+                logger.error("Not reloading extensions: {0}".format(e))
+            finally:
+                sys.dont_write_bytecode = False
+            return loaded
 
 class DependencyError(Exception):
     """Raised on error resolving dependencies."""
@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    requests = None
+
+"""
+Shared HTTP client.
+Extensions reach it through api.http instead of building their own sessions,
+so connections to a host are kept alive and reused across extensions, and the
+bot as a whole never has more than a bounded number of requests in flight.
+"""
+
+logger = logging.getLogger(__name__)
+
+class HTTPClient(object):
+    """Asynchronous HTTP client with per-host connection pooling.
+       request() and its shortcuts take the same arguments as the
+       corresponding requests.Session methods, and return a
+       concurrent.futures.Future that resolves to a requests.Response.
+       At most max_concurrency requests run at once, and at most per_host of
+       them against a single host; the rest wait in per-host queues, which
+       are served round-robin so a slow host cannot starve the others. When
+       max_queued requests are already waiting, the returned future fails
+       with HTTPOverloadError."""
+    def __init__(self, max_concurrency=10, per_host=4, timeout=30, max_queued=1000,
+                 user_agent=None):
+        if requests is None:
+            raise HTTPUnavailableError("api.http needs the requests and futures packages.")
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.session = requests.Session()
+        # one pool per host, with as many keep-alive connections as we allow
+        # concurrent requests to it
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.lock = threading.Lock()
+        self.waiting = defaultdict(deque)
+        self.hosts = deque()
+        self.running = 0
+        self.host_running = defaultdict(lambda: 0)
+        self.queued = 0
+        self.closed = 0
+        self.counters = defaultdict(lambda: 0)
+        self.total_latency = 0.0
+
+    def request(self, method, url, **kwargs):
+        """Queue an HTTP request. Returns a Future.
+
+        Arguments:
+            method [string]: HTTP method, eg "GET".
+            url [string]: Absolute URL.
+            kwargs: Passed to requests.Session.request. timeout defaults to
+                    the client's shared timeout."""
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc.lower()
+        future = Future()
+        with self.lock:
+            if self.closed:
+                future.set_exception(HTTPUnavailableError("The HTTP client is closed."))
+                return future
+            if self.queued >= self.max_queued:
+                self.counters["rejected"] += 1
+                future.set_exception(HTTPOverloadError(
+                    "Too many queued requests, not fetching {0}.".format(url)))
+                return future
+            if not self.waiting[host]:
+                self.hosts.append(host)
+            self.waiting[host].append((future, method, url, kwargs, time.time()))
+            self.queued += 1
+            self.counters["requests"] += 1
+            ready = self.next_jobs()
+        self.submit(ready)
+        return future
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def next_jobs(self):
+        """[internal] Take waiting requests that fit within the limits, one host
+           at a time. Call with the lock held."""
+        ready = []
+        while self.running < self.max_concurrency:
+            for i in range(len(self.hosts)):
+                host = self.hosts[0]
+                self.hosts.rotate(-1)
+                if self.host_running.get(host, 0) < self.per_host:
+                    break
+            else:
+                break
+            job = self.waiting[host].popleft()
+            if not self.waiting[host]:
+                del self.waiting[host]
+                self.hosts.remove(host)
+            self.queued -= 1
+            self.running += 1
+            self.host_running[host] += 1
+            ready.append((host, job))
+        return ready
+
+    def submit(self, ready):
+        for host, job in ready:
+            self.executor.submit(self.perform, host, job)
+
+    def perform(self, host, job):
+        """[internal] Run one request on an executor thread."""
+        future, method, url, kwargs, queued_at = job
+        started = time.time()
+        failed = 0
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except Exception as e:
+                    failed = 1
+                    future.set_exception(e)
+                else:
+                    future.set_result(response)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.host_running[host] -= 1
+                if not self.host_running[host]:
+                    del self.host_running[host]
+                self.counters["completed"] += 1
+                self.counters["errors"] += failed
+                self.total_latency += time.time() - started
+                self.counters["queue_wait_ms"] += int((started - queued_at) * 1000)
+                ready = self.next_jobs() if not self.closed else []
+            self.submit(ready)
+
+    def stats(self):
+        with self.lock:
+            completed = self.counters["completed"]
+            return {
+                "requests": self.counters["requests"],
+                "completed": completed,
+                "errors": self.counters["errors"],
+                "rejected": self.counters["rejected"],
+                "running": self.running,
+                "queued": self.queued,
+                "hosts_active": len(self.host_running),
+                "avg_latency_ms": int(self.total_latency * 1000 / completed) if completed else 0,
+                "avg_queue_wait_ms": self.counters["queue_wait_ms"] // completed if completed else 0,
+            }
+
+    def close(self):
+        """Fail every waiting request and close pooled connections. Requests
+           already running are allowed to finish."""
+        with self.lock:
+            self.closed = 1
+            waiting, self.waiting = self.waiting, defaultdict(deque)
+            self.hosts.clear()
+            self.queued = 0
+        for jobs in waiting.values():
+            for job in jobs:
+                # failed like requests made after closing, not cancelled, so
+                # callbacks see an HTTPUnavailableError
+                if job[0].set_running_or_notify_cancel():
+                    job[0].set_exception(HTTPUnavailableError(
+                        "The HTTP client closed before fetching {0}.".format(job[2])))
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+class HTTPOverloadError(Exception):
+    """Raised (through the future) when too many requests are queued."""
+
+class HTTPUnavailableError(Exception):
+    """Raised when the HTTP client cannot be used."""
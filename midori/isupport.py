@@ -0,0 +1,174 @@
+from __future__ import unicode_literals
+import logging
+import threading
+
+"""
+ISUPPORT (RPL_ISUPPORT, numeric 005) registry.
+Servers advertise their limits and features as KEY=VALUE tokens right after
+registration. They decide how many targets fit in one command, how long a line
+may be and how nicknames compare, so everything that batches or splits output
+reads them from here instead of assuming RFC 1459 defaults.
+"""
+
+logger = logging.getLogger(__name__)
+
+CASEMAPS = {
+    "ascii": ("", ""),
+    "rfc1459": ("[]\\~", "{}|^"),
+    "strict-rfc1459": ("[]\\", "{}|"),
+}
+
+class ISupport(object):
+    """Tokens from the current server's 005 replies.
+       Lookups fall back to conservative defaults until the server has told us
+       otherwise, and reset() forgets everything when we reconnect."""
+    DEFAULTS = {
+        "CASEMAPPING": "rfc1459",
+        "CHANTYPES": "#&",
+        "CHANMODES": "b,k,l,imnpst",
+        "PREFIX": "(ov)@+",
+        "LINELEN": "512",
+        "MODES": "3",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.tokens = {}
+            self.parsed = {}
+
+    def update(self, params):
+        """Apply the tokens of one 005 reply.
+
+        Arguments:
+            params [list]: The parameters between our nick and the trailing
+                           "are supported by this server" text."""
+        with self.lock:
+            for token in params:
+                if token.startswith("-"):
+                    self.tokens.pop(token[1:].upper(), None)
+                    continue
+                key, _, value = token.partition("=")
+                self.tokens[key.upper()] = unescape(value)
+            self.parsed = {}
+
+    def load(self, tokens):
+        """Replace every token at once, eg with another process's."""
+        with self.lock:
+            self.tokens = dict(tokens)
+            self.parsed = {}
+
+    def get(self, key, default=None):
+        return self.tokens.get(key, self.DEFAULTS.get(key, default))
+
+    def __contains__(self, key):
+        return key in self.tokens
+
+    def cached(self, key, parse):
+        """[internal] Parse a token once per update."""
+        try:
+            return self.parsed[key]
+        except KeyError:
+            value = self.parsed[key] = parse(self.get(key, ""))
+            return value
+
+    def get_int(self, key, default):
+        try:
+            return int(self.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    @property
+    def linelen(self):
+        """Maximum line length in bytes, including the CRLF."""
+        return self.get_int("LINELEN", 512)
+
+    @property
+    def modes(self):
+        """Mode changes with a parameter allowed in one MODE command."""
+        if self.get("MODES") == "":
+            # no value means no limit; stay reasonable anyway
+            return 12
+        return self.get_int("MODES", 3)
+
+    def targmax(self, command):
+        """Return how many targets command accepts at once, or None if the
+           server gives no limit (the line length still applies).
+           Commands TARGMAX doesn't list get the same defaults as without it;
+           Solanum, for one, leaves JOIN and PART out."""
+        command = command.upper()
+        if "TARGMAX" in self.tokens:
+            targmax = self.cached("TARGMAX", parse_targmax)
+            if command in targmax:
+                return targmax[command]
+        if command in ("PRIVMSG", "NOTICE"):
+            return self.get_int("MAXTARGETS", 1)
+        if command in ("JOIN", "PART"):
+            return None
+        return 1
+
+    @property
+    def chantypes(self):
+        return self.get("CHANTYPES")
+
+    def is_channel(self, target):
+        return target[:1] in self.chantypes
+
+    @property
+    def prefixes(self):
+        """List of (mode, symbol) pairs, highest rank first."""
+        return self.cached("PREFIX", parse_prefix)
+
+    @property
+    def chanmodes(self):
+        """The four CHANMODES groups: list modes, modes that always take a
+           parameter, modes that take one only when set, and flags."""
+        return self.cached("CHANMODES", parse_chanmodes)
+
+    def casefold(self, name):
+        """Lowercase a nick or channel name the way the server compares them."""
+        upper, lower = CASEMAPS.get(self.get("CASEMAPPING").lower(), CASEMAPS["rfc1459"])
+        name = name.lower()
+        for u, l in zip(upper, lower):
+            name = name.replace(u, l)
+        return name
+
+def unescape(value):
+    """Decode the \\xHH escapes allowed in ISUPPORT values."""
+    if "\\x" not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        if value[i:i + 2] == "\\x" and len(value) >= i + 4:
+            try:
+                out.append(chr(int(value[i + 2:i + 4], 16)))
+                i += 4
+                continue
+            except ValueError:
+                pass
+        out.append(value[i])
+        i += 1
+    return "".join(out)
+
+def parse_targmax(value):
+    targmax = {}
+    for item in value.split(","):
+        command, _, limit = item.partition(":")
+        if command:
+            targmax[command.upper()] = int(limit) if limit.isdigit() else None
+    return targmax
+
+def parse_prefix(value):
+    if not value.startswith("(") or ")" not in value:
+        return []
+    modes, symbols = value[1:].split(")", 1)
+    return list(zip(modes, symbols))
+
+def parse_chanmodes(value):
+    groups = value.split(",")
+    groups += [""] * (4 - len(groups))
+    return groups[:4]
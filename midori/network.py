@@ -0,0 +1,170 @@
+import logging
+import time
+from collections import OrderedDict
+
+import midori.api
+import midori.caps
+import midori.config
+import midori.workers
+
+"""
+Network sessions.
+One process can stay connected to several IRC networks. Each one is a Network
+with its own connection, write queue and API object, which holds that
+network's nick, channels, users and server limits. The read queue, the thread
+pool, the timers and the loaded extensions are shared by all of them, and every
+Command and PrivateMessage carries the Network it came from.
+
+Networks are configured under "networks", one object per network, whose keys
+override the top-level ones:
+    "networks": {
+        "rizon": {"server": {...}, "identity": {...}, "channels": [...]},
+        "libera": {...}
+    }
+Without a "networks" key the top-level settings describe a single network
+called "default".
+"""
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class Network(object):
+    """One IRC network's session.
+
+    Arguments:
+        instance [midori.core.Midori]: The process-wide Midori instance.
+        name [string]: The network's name, as used in logs and stats.
+        prefix [string]: Configuration key holding its settings, eg
+                         "networks.rizon". "" reads the top-level keys."""
+    def __init__(self, instance, name, prefix=""):
+        self.instance = instance
+        self.name = name
+        self.prefix = prefix + "." if prefix else ""
+        self.write_queue = midori.workers.SheddingQueue(
+            "write.{0}".format(name) if prefix else "write", self.config("queues.write", 2000),
+            instance.shed_rank, instance.on_shed)
+        self.net_thread = None
+        # true in a shard process, where the owner process holds the connection
+        self.remote = 0
+        self.connected = 0
+        self.connects = 0
+        self.last_read = time.time()
+        self.reconnect_handle = None
+        self.keepalive_handle = None
+        # details of the current connection's TLS handshake, see midori.tls
+        self.tls = None
+        self.api = midori.api.API(instance, self)
+        self.caps = midori.caps.Capabilities(self)
+
+    def config(self, key, default=None, rtype=lambda x: x):
+        """Look up a setting, preferring this network's own value."""
+        return self.lookup(self.instance.configuration.snapshot, key, default, rtype)
+
+    def lookup(self, snapshot, key, default=None, rtype=lambda x: x):
+        """Like config, in a given midori.config.ConfigSnapshot."""
+        if self.prefix:
+            value = snapshot.get(self.prefix + key, _MISSING, rtype)
+            if value is not _MISSING:
+                return value
+        return snapshot.get(key, default, rtype)
+
+    def subscribe(self, callback, key):
+        """Call callback(old, new) when key changes for this network, whether
+           in its own settings or in the top-level ones it falls back to."""
+        self.instance.configuration.subscribe(callback, key)
+        if self.prefix:
+            self.instance.configuration.subscribe(callback, self.prefix + key)
+
+    def check_config(self):
+        for key in ("identity.nick", "identity.user", "identity.real_name", "server.host",
+                    "server.port"):
+            if not self.config(key):
+                raise ConfigurationError("Mis-configured key: {0}{1}. Please check."
+                                         .format(self.prefix, key))
+        if self.config("server.use_ssl", -1) not in (0, 1):
+            raise ConfigurationError("Mis-configured key: {0}server.use_ssl."
+                                     .format(self.prefix))
+
+    def connect(self):
+        """Start a connection, and register once it is up."""
+        self.reconnect_handle = None
+        self.api.nick = self.config("identity.nick")
+        self.last_read = time.time()
+        self.tls = None
+        self.net_thread = midori.workers.NetworkThread(
+            self.instance, self, self.config("server.host"), self.config("server.port"),
+            self.config("server.use_ssl"), self.instance.read_queue, self.write_queue)
+        self.net_thread.start()
+        self.connected = 1
+        self.connects += 1
+        self.handshake()
+        if self.keepalive_handle is None:
+            self.keepalive_handle = self.instance.timers.call_every(60, self.keepalive)
+
+    def handshake(self):
+        self.caps.start()
+        pass_ = self.config("server.password", "")
+        if pass_:
+            self.api.send_raw("PASS {0}".format(pass_))
+        self.api.send_raw("NICK {0}".format(self.config("identity.nick")))
+        self.api.send_raw("USER {0} * 8 :{1}".format(self.config("identity.user"),
+                                                     self.config("identity.real_name")))
+
+    def keepalive(self):
+        """PING the server when it has been quiet for ping_interval seconds."""
+        interval = self.config("ping_interval", 300)
+        if self.connected and time.time() - self.last_read >= interval:
+            self.last_read = time.time()
+            self.api.send_raw("PING :{0}".format(self.api.nick))
+
+    def disconnected(self):
+        """Called by the network thread when the connection is lost."""
+        self.connected = 0
+        self.caps.disconnected()
+        if getattr(self.net_thread, "stopping", 0):
+            return
+        delay = self.config("reconnect_delay", 360)
+        logger.error("Disconnected from {0}. Trying again in {1} seconds...".format(self.name,
+                                                                                   delay))
+        self.reconnect_handle = self.instance.timers.call_later(delay, self.connect)
+
+    def disconnect(self):
+        for handle in (self.reconnect_handle, self.keepalive_handle):
+            if handle is not None:
+                handle.cancel()
+        self.reconnect_handle = self.keepalive_handle = None
+        if self.net_thread:
+            self.net_thread.stopping = 1
+            logger.info("Waiting for the network thread of {0} to die...".format(self.name))
+            self.net_thread.join()
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "nick": self.api.nick,
+            "channels": len(self.api.channels),
+            "users": len(self.api.users),
+            "tls": self.tls,
+            "caps": self.caps.stats(),
+        }
+
+    def __repr__(self):
+        return "<midori.network.Network({0})>".format(self.name)
+
+def from_config(instance):
+    """Return an OrderedDict of name -> Network for the configured networks,
+       the default one first."""
+    networks = instance.config("networks", None)
+    if not networks:
+        return OrderedDict([("default", Network(instance, "default"))])
+    names = sorted(networks)
+    default = instance.config("default_network", names[0])
+    if default not in networks:
+        raise ConfigurationError("Mis-configured key: default_network.")
+    names.remove(default)
+    return OrderedDict((name, Network(instance, name, "networks." + name))
+                       for name in [default] + names)
+
+ConfigurationError = midori.config.ConfigurationError
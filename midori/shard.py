@@ -0,0 +1,405 @@
+import binascii
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.connection import Client, Listener
+
+import midori
+import midori.api
+import midori.core
+import midori.workers
+
+"""
+Sharded deployment.
+With shards.count set, the process started by midori.py only owns the IRC
+connections: it registers, answers PINGs, keeps the core channel state and
+checks for floods. Extensions run in shards.count worker processes, started
+and restarted by the owner, so they are no longer bound to one interpreter
+lock. Lines travel between the processes over a Unix socket:
+    - lines about a channel go to the shard that channel hashes to, so each
+      shard sees all of its channels' traffic in order;
+    - private messages go to the shard of the sender's nick;
+    - everything else (numerics, NICK, QUIT...) goes to every shard, so each
+      one can track its users, and is marked as a replica on all but the
+      first. Only the core hooks see replicas.
+Whatever a shard sends goes back over the same socket to the owner, which
+writes it to the network.
+Each shard has its own memory: extensions that keep process-wide state must
+keep it on disk (or elsewhere) rather than in memory, and should only run
+background jobs such as streams or pollers where API.is_primary() is true.
+"""
+
+logger = logging.getLogger(__name__)
+
+# passed to worker processes, which find the bus with them
+ADDRESS_ENV = "MIDORI_BUS_ADDRESS"
+AUTHKEY_ENV = "MIDORI_BUS_AUTHKEY"
+
+# handled by the owner alone
+OWNER_ONLY = ("PING", "PONG")
+# numerics whose second parameter is a channel (topic, names, modes, bans)
+CHANNEL_IN_SECOND = ("324", "329", "331", "332", "333", "366", "367", "368")
+
+def shard_of(key, count):
+    """Return the shard a nick or channel belongs to. Stable across processes
+       and restarts, unlike hash()."""
+    return zlib.crc32(key.encode("utf-8")) % count
+
+def channel_of(cmd):
+    """Return the channel a line is about, or None."""
+    if cmd.kind == "JOIN":
+        name = cmd.args[0] if cmd.args else cmd.message
+    elif cmd.kind == "353":
+        name = cmd.args[2] if len(cmd.args) > 2 else None
+    elif cmd.kind in CHANNEL_IN_SECOND:
+        name = cmd.args[1] if len(cmd.args) > 1 else None
+    else:
+        name = cmd.args[0] if cmd.args else None
+    if name and cmd.api.isupport.is_channel(name):
+        return name
+    return None
+
+class BusLine(object):
+    """A line queued for a shard."""
+    __slots__ = ("kind", "network", "raw", "replica")
+
+    def __init__(self, kind, network, raw, replica=0):
+        self.kind = kind
+        self.network = network
+        self.raw = raw
+        self.replica = replica
+
+class ShardBus(object):
+    """The owner's side of the bus: spawns the shards, routes lines to them
+       and relays their output.
+
+    Arguments:
+        instance [midori.core.Midori]: The owner's instance.
+        config_file [string]: Passed on to the shards.
+        count [int]: Number of shards."""
+    def __init__(self, instance, config_file, count):
+        self.instance = instance
+        self.config_file = config_file
+        self.count = count
+        self.address = os.path.join(instance.basedir, instance.config("shards.socket",
+                                                                      ".midori-bus.sock"))
+        self.authkey = os.urandom(16)
+        self.listener = None
+        self.stopping = 0
+        self.shards = [Shard(self, index) for index in range(count)]
+
+    def start(self):
+        if os.path.exists(self.address):
+            # left over from a process that didn't exit cleanly
+            os.unlink(self.address)
+        self.listener = Listener(self.address, "AF_UNIX", authkey=self.authkey)
+        thread = threading.Thread(target=self.accept_loop, name="ShardBus")
+        thread.daemon = 1
+        thread.start()
+        for shard in self.shards:
+            shard.start()
+        self.instance.flood_observers.append(self.forward_flood)
+        logger.info("Started {0} shards on {1}.".format(self.count, self.address))
+
+    def accept_loop(self):
+        while not self.stopping:
+            try:
+                conn = self.listener.accept()
+                hello, index = conn.recv()
+            except Exception:
+                if not self.stopping:
+                    logger.error("Rejected a connection to the shard bus.", exc_info=1)
+                continue
+            if hello != "hello" or not 0 <= index < self.count:
+                conn.close()
+                continue
+            self.shards[index].attach(conn)
+
+    def route(self, cmd):
+        """Send a line received from IRC to the shards that need it."""
+        if cmd.kind in OWNER_ONLY:
+            return
+        name = cmd.network.name
+        channel = channel_of(cmd)
+        if channel is not None:
+            key = cmd.api.isupport.casefold(channel)
+        elif cmd.kind in ("PRIVMSG", "NOTICE") and cmd.sender and cmd.sender[0]:
+            key = cmd.api.isupport.casefold(cmd.sender[0])
+        else:
+            for shard in self.shards:
+                shard.put(BusLine(cmd.kind, name, cmd.string_rep, shard.index != 0))
+            return
+        self.shards[shard_of(key, self.count)].put(BusLine(cmd.kind, name, cmd.string_rep))
+
+    def forward_flood(self, event):
+        """Flood observer: pass the event on to the shard of its channel."""
+        network = midori.workers.current_network()
+        if network is None:
+            return
+        index = shard_of(network.api.isupport.casefold(event.channel), self.count)
+        self.shards[index].put(BusLine("FLOOD", network.name, tuple(event)))
+
+    def snapshot(self, index):
+        """Return what shard index needs to know about each network: our nick,
+           the server's ISUPPORT tokens and capabilities, and the members of
+           its channels."""
+        state = {}
+        for name, network in self.instance.networks.items():
+            api = network.api
+            channels = {}
+            for channel in list(api.channels.values()):
+                if shard_of(api.isupport.casefold(channel.name), self.count) == index:
+                    channels[channel.name] = [(u.nick, u.user_name, u.hostmask, u.account,
+                                               u.real_name, u.away)
+                                              for u in list(channel.users)]
+            state[name] = {
+                "nick": api.nick,
+                "self_mask": api.self_mask,
+                "isupport": dict(api.isupport.tokens),
+                "caps": sorted(network.caps.enabled),
+                "connected": network.connected,
+                "channels": channels,
+            }
+        return state
+
+    def stop(self):
+        self.stopping = 1
+        for shard in self.shards:
+            shard.stop()
+        if self.listener:
+            self.listener.close()
+        for shard in self.shards:
+            shard.reap()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def stats(self):
+        return dict(("shard.{0}".format(shard.index), shard.stats()) for shard in self.shards)
+
+class Shard(object):
+    """One worker process, seen from the owner."""
+    def __init__(self, bus, index):
+        self.bus = bus
+        self.index = index
+        instance = bus.instance
+        self.queue = midori.workers.SheddingQueue(
+            "shard.{0}".format(index), instance.config("shards.queue", 5000),
+            instance.shed_rank, instance.on_shed)
+        self.process = None
+        self.conn = None
+        self.stopping = 0
+        self.attached = threading.Condition(threading.Lock())
+        self.counters = {"sent": 0, "received": 0, "restarts": 0}
+
+    def start(self):
+        thread = threading.Thread(target=self.send_loop, name="Shard-{0}".format(self.index))
+        thread.daemon = 1
+        thread.start()
+        self.spawn()
+
+    def spawn(self):
+        if self.stopping:
+            return
+        env = dict(os.environ)
+        env[ADDRESS_ENV] = self.bus.address
+        env[AUTHKEY_ENV] = binascii.hexlify(self.bus.authkey).decode("ascii")
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", "import midori.shard; midori.shard.worker_main()",
+             self.bus.config_file, str(self.index)], env=env, cwd=self.bus.instance.basedir)
+        logger.info("Started shard {0} (pid {1}).".format(self.index, self.process.pid))
+
+    def attach(self, conn):
+        # the state goes out first, lines queued meanwhile follow it
+        conn.send(("state", self.bus.snapshot(self.index)))
+        with self.attached:
+            self.conn = conn
+            self.attached.notify_all()
+        thread = threading.Thread(target=self.receive_loop, args=(conn,),
+                                  name="Shard-{0}-recv".format(self.index))
+        thread.daemon = 1
+        thread.start()
+
+    def detach(self, conn):
+        with self.attached:
+            if self.conn is not conn:
+                return
+            self.conn = None
+        conn.close()
+        if self.stopping:
+            return
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+        self.counters["restarts"] += 1
+        delay = self.bus.instance.config("shards.restart_delay", 5)
+        logger.error("Lost shard {0}, restarting it in {1} seconds.".format(self.index, delay))
+        self.bus.instance.timers.call_later(delay, self.spawn)
+
+    def put(self, line):
+        self.queue.put(line)
+
+    def send_loop(self):
+        while 1:
+            line = self.queue.get()
+            with self.attached:
+                while self.conn is None and not self.stopping:
+                    self.attached.wait()
+                conn = self.conn
+            if conn is None:
+                return
+            try:
+                if line is None:
+                    # queued by stop(), behind everything still to be sent
+                    conn.send(("stop",))
+                    return
+                conn.send(("line", line.network, line.raw, line.replica) if line.kind != "FLOOD"
+                          else ("flood", line.network, line.raw))
+                self.counters["sent"] += 1
+            except (EOFError, IOError, OSError):
+                self.detach(conn)
+
+    def receive_loop(self, conn):
+        networks = self.bus.instance.networks
+        while 1:
+            try:
+                kind, name, data = conn.recv()
+            except (EOFError, IOError, OSError):
+                self.detach(conn)
+                return
+            if kind == "line" and name in networks:
+                self.counters["received"] += 1
+                networks[name].write_queue.put(data)
+
+    def stop(self):
+        with self.attached:
+            self.stopping = 1
+            self.attached.notify_all()
+        self.queue.put(None)
+
+    def reap(self, timeout=5):
+        """Wait for the process to exit after stop(), killing it if it won't."""
+        if not self.process:
+            return
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if self.process.poll() is None:
+            logger.warn("Shard {0} did not exit, killing it.".format(self.index))
+            self.process.kill()
+            self.process.wait()
+        conn = self.conn
+        if conn is not None:
+            conn.close()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(self.queue.stats())
+        stats["attached"] = self.conn is not None
+        return stats
+
+class ShardWorker(object):
+    """The shard's side of the bus: runs the extensions on the lines the owner
+       sends, and sends their output back.
+
+    Arguments:
+        instance [midori.core.Midori]: This process's instance.
+        index [int]: Which shard this is.
+        address [string]: The bus's socket.
+        authkey [bytes]: The bus's key."""
+    def __init__(self, instance, index, address, authkey):
+        self.instance = instance
+        self.index = index
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+        self.send_lock = threading.Lock()
+
+    def run(self):
+        instance = self.instance
+        instance.shard_index = self.index
+        for network in instance.networks.values():
+            # the owner holds the connection
+            network.remote = 1
+        instance.load_extensions()
+        instance.ext_manager.start_extensions(instance.workers.dispatch)
+        self.conn = Client(self.address, "AF_UNIX", authkey=self.authkey)
+        self.conn.send(("hello", self.index))
+        for network in instance.networks.values():
+            thread = threading.Thread(target=self.send_loop, args=(network,),
+                                      name="ShardSend-{0}".format(network.name))
+            thread.daemon = 1
+            thread.start()
+        while 1:
+            try:
+                message = self.conn.recv()
+            except (EOFError, IOError, OSError):
+                logger.info("The owner process went away, shard {0} exiting.".format(self.index))
+                return
+            if message[0] == "line":
+                kind, name, raw, replica = message
+                network = instance.networks.get(name)
+                if network is None:
+                    continue
+                cmd = midori.core.Command(raw, network)
+                cmd.replica = replica
+                instance.dispatch_command(cmd)
+            elif message[0] == "flood":
+                kind, name, event = message
+                event = midori.api.FloodEvent(*event)
+                for callback in list(instance.flood_observers):
+                    instance.workers.dispatch(callback, args=(event,),
+                                              network=instance.networks.get(name))
+            elif message[0] == "state":
+                self.restore(message[1])
+            elif message[0] == "stop":
+                logger.info("Shard {0} stopping.".format(self.index))
+                return
+
+    def restore(self, state):
+        """Take over the owner's view of each network."""
+        for name, network_state in state.items():
+            network = self.instance.networks.get(name)
+            if network is None:
+                continue
+            api = network.api
+            api.nick = network_state["nick"]
+            api.self_mask = network_state["self_mask"]
+            api.isupport.load(network_state["isupport"])
+            network.caps.load(network_state["caps"])
+            network.connected = network_state["connected"]
+            for channel_name, members in network_state["channels"].items():
+                channel = api.channels[channel_name] = midori.api.Channel(channel_name)
+                for member in members:
+                    try:
+                        user = api.users[member[0]]
+                    except KeyError:
+                        user = api.users[member[0]] = midori.api.User(member)
+                        user.account, user.real_name, user.away = member[3:]
+                    channel.users.add(user)
+
+    def send_loop(self, network):
+        while 1:
+            data = network.write_queue.get()
+            try:
+                with self.send_lock:
+                    self.conn.send(("line", network.name, data))
+            except (EOFError, IOError, OSError):
+                return
+
+def worker_main():
+    """Entry point of a shard process: midori.shard <config file> <index>."""
+    config_file, index = sys.argv[1], int(sys.argv[2])
+    midori.init(config_file)
+    worker = ShardWorker(midori.instance, index, os.environ[ADDRESS_ENV],
+                         binascii.unhexlify(os.environ[AUTHKEY_ENV]))
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.critical("Unhandled exception in shard {0}.".format(index), exc_info=1)
+    finally:
+        sys.exit(midori.instance.exit())
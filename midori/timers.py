@@ -0,0 +1,209 @@
+import logging
+import random
+import threading
+import time
+
+import midori.workers
+
+"""
+Scheduled calls.
+All timers live in one hierarchical timing wheel driven by a single thread:
+scheduling and cancelling cost O(1) whatever the number of timers, and due
+callbacks are handed to the ThreadPool instead of running on the wheel's
+thread. Timers are as precise as the wheel's resolution. A timer scheduled
+while handling an event from a network runs with that network as current.
+"""
+
+logger = logging.getLogger(__name__)
+
+# four levels of 64 slots: at the default 50ms resolution the wheel spans
+# about ten days before timers go to the overflow list
+BITS = 6
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+
+class TimerHandle(object):
+    """A scheduled call, returned by call_later and call_every.
+       cancel() it to stop it; cancelling is cheap and always safe."""
+    def __init__(self, wheel, when, callback, args, kwargs, interval=None, jitter=0,
+                 coalesce=1):
+        self.wheel = wheel
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.coalesce = coalesce
+        self.cancelled = 0
+        self.running = 0
+        self.fired = 0
+        self.skipped = 0
+        self.network = midori.workers.current_network()
+
+    @property
+    def done(self):
+        """True once a one-shot timer has fired, or any timer was cancelled."""
+        return self.cancelled or (self.interval is None and self.fired)
+
+    def cancel(self):
+        self.cancelled = 1
+
+    def run(self):
+        """[internal] Called on the pool."""
+        try:
+            self.callback(*self.args, **self.kwargs)
+        except Exception:
+            logger.error("Exception in timer callback {0}".format(self.callback), exc_info=1)
+        finally:
+            self.running = 0
+
+    def __repr__(self):
+        return "<midori.timers.TimerHandle({0} at {1:.2f}{2})>".format(
+            self.callback, self.when, ", cancelled" if self.cancelled else "")
+
+class TimerWheel(threading.Thread):
+    """Hierarchical timing wheel.
+       Timers due within SLOTS ticks sit in the first level, one slot per
+       tick; each further level covers SLOTS times as much with the same
+       number of slots, and its timers are moved down a level when the level
+       below wraps around.
+
+    Arguments:
+        dispatch [callable]: dispatch(call, network=None), eg ThreadPool.dispatch.
+        resolution [float]: Seconds per tick."""
+    def __init__(self, dispatch, resolution=0.05):
+        super(TimerWheel, self).__init__(name="TimerWheel")
+        self.daemon = 1
+        self.dispatch = dispatch
+        self.resolution = resolution
+        self.origin = time.time()
+        self.tick = 0
+        self.wheels = [[[] for i in range(SLOTS)] for level in range(LEVELS)]
+        self.overflow = []
+        self.count = 0
+        self.stopping = 0
+        self.counters = {"fired": 0, "skipped": 0, "cancelled": 0}
+        self.wakeup = threading.Condition(threading.Lock())
+
+    def call_later(self, delay, callback, args=(), kwargs=None):
+        """Call callback(*args, **kwargs) on the pool after delay seconds.
+           Returns a TimerHandle."""
+        handle = TimerHandle(self, time.time() + delay, callback, args, kwargs or {})
+        self.schedule(handle)
+        return handle
+
+    def call_every(self, interval, callback, args=(), kwargs=None, jitter=0, coalesce=1,
+                   delay=None):
+        """Call callback(*args, **kwargs) on the pool every interval seconds.
+           Returns a TimerHandle.
+
+        Arguments:
+            interval [float]: Seconds between calls.
+            jitter [float]: Up to this many seconds are added to each delay at
+                            random, so that many pollers don't all fire at once.
+            coalesce [bool]: If true, a run that comes due while the previous
+                             one is still going is skipped, and runs missed while
+                             the process was busy are not made up for.
+            delay [float]: Seconds until the first call; defaults to interval."""
+        first = interval if delay is None else delay
+        handle = TimerHandle(self, time.time() + first + random.uniform(0, jitter), callback,
+                             args, kwargs or {}, interval, jitter, coalesce)
+        self.schedule(handle)
+        return handle
+
+    def schedule(self, handle):
+        with self.wakeup:
+            self.insert(handle)
+            self.count += 1
+            self.wakeup.notify()
+
+    def insert(self, handle, earliest=None):
+        """[internal] Put handle in the slot for its expiry, or for tick
+           earliest if that is later. earliest defaults to the next tick, as
+           the current one's slot has been emptied already: a due timer put
+           there would wait for the level to wrap around. Call with the lock
+           held."""
+        expires = int((handle.when - self.origin) / self.resolution) + 1
+        expires = max(expires, self.tick + 1 if earliest is None else earliest)
+        delta = expires - self.tick
+        for level in range(LEVELS):
+            if delta < SLOTS << (BITS * level):
+                self.wheels[level][(expires >> (BITS * level)) & MASK].append(handle)
+                return
+        self.overflow.append(handle)
+
+    def advance(self, now):
+        """[internal] Process every tick up to now. Returns the due handles."""
+        due = []
+        target = int((now - self.origin) / self.resolution)
+        with self.wakeup:
+            while self.tick < target:
+                self.tick += 1
+                self.cascade()
+                slot = self.wheels[0][self.tick & MASK]
+                if slot:
+                    self.wheels[0][self.tick & MASK] = []
+                    due.extend(slot)
+            self.count -= len(due)
+        return due
+
+    def cascade(self):
+        """[internal] Move timers down from higher levels whose slot just came
+           up. Call with the lock held."""
+        for level in range(1, LEVELS):
+            if self.tick & ((1 << (BITS * level)) - 1):
+                return
+            index = (self.tick >> (BITS * level)) & MASK
+            handles, self.wheels[level][index] = self.wheels[level][index], []
+            for handle in handles:
+                # this tick's slot is emptied after cascading
+                self.insert(handle, self.tick)
+        if not self.tick & ((1 << (BITS * LEVELS)) - 1):
+            handles, self.overflow = self.overflow, []
+            for handle in handles:
+                self.insert(handle, self.tick)
+
+    def fire(self, handle, now):
+        if handle.cancelled:
+            self.counters["cancelled"] += 1
+            return
+        if handle.coalesce and handle.running:
+            handle.skipped += 1
+            self.counters["skipped"] += 1
+        else:
+            handle.running = 1
+            handle.fired += 1
+            self.counters["fired"] += 1
+            self.dispatch(handle.run, network=handle.network)
+        if handle.interval is not None:
+            handle.when += handle.interval
+            if handle.coalesce and handle.when < now:
+                handle.when = now + handle.interval
+            handle.when += random.uniform(0, handle.jitter)
+            self.schedule(handle)
+
+    def run(self):
+        while not self.stopping:
+            with self.wakeup:
+                if not self.count:
+                    self.wakeup.wait()
+                else:
+                    self.wakeup.wait(self.resolution)
+            now = time.time()
+            for handle in self.advance(now):
+                try:
+                    self.fire(handle, now)
+                except Exception:
+                    logger.error("Cannot fire timer {0}".format(handle), exc_info=1)
+
+    def stop(self):
+        with self.wakeup:
+            self.stopping = 1
+            self.wakeup.notify()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["scheduled"] = self.count
+        return stats
@@ -0,0 +1,134 @@
+import logging
+import select
+import socket
+import ssl
+import threading
+import time
+
+"""
+TLS for IRC connections.
+Every connection made with the same settings shares one SSLContext, and the
+session of the last connection to each server is kept, so that reconnecting
+resumes it instead of doing a full handshake. Sockets are wrapped without
+handshaking; midori.workers.NetworkThread drives the handshake itself without
+blocking.
+
+Settings, per network like the rest of "server":
+    "server": {
+        "use_ssl": true,
+        "tls_verify": true,      // check the server's certificate and name
+        "tls_ca_file": null,     // trust these CAs instead of the system's
+        "tls_certfile": null,    // client certificate, eg for SASL EXTERNAL
+        "tls_keyfile": null,
+        "handshake_timeout": 30
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+# session resumption needs Python 3.6
+RESUMPTION = hasattr(ssl, "SSLSession")
+
+class TLSCache(object):
+    """Shared SSLContexts and resumable sessions for the whole process."""
+    def __init__(self):
+        # settings -> SSLContext
+        self.contexts = {}
+        # (host, port, settings) -> SSLSession
+        self.sessions = {}
+        self.counters = {"handshakes": 0, "resumed": 0, "failed": 0}
+        self.handshake_time = 0.0
+        self.last_handshake = None
+        self.lock = threading.Lock()
+
+    def settings(self, network):
+        return (bool(network.config("server.tls_verify", 1)),
+                network.config("server.tls_ca_file", None),
+                network.config("server.tls_certfile", None),
+                network.config("server.tls_keyfile", None))
+
+    def context(self, settings):
+        """Return the SSLContext for a settings tuple, making it on first use."""
+        with self.lock:
+            context = self.contexts.get(settings)
+            if context is None:
+                verify, ca_file, certfile, keyfile = settings
+                context = ssl.create_default_context(cafile=ca_file)
+                if not verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                if certfile:
+                    context.load_cert_chain(certfile, keyfile)
+                self.contexts[settings] = context
+            return context
+
+    def wrap(self, sock, host, port, network):
+        """Wrap a connected socket for network's server, offering the session
+           we last had with it. The caller does the handshake."""
+        settings = self.settings(network)
+        kwargs = {"server_hostname": host, "do_handshake_on_connect": False}
+        if RESUMPTION:
+            with self.lock:
+                session = self.sessions.get((host, port, settings))
+            if session is not None:
+                kwargs["session"] = session
+        return self.context(settings).wrap_socket(sock, **kwargs)
+
+    def handshake_done(self, sock, host, port, network, elapsed):
+        """Record a completed handshake and keep its session."""
+        resumed = getattr(sock, "session_reused", 0)
+        with self.lock:
+            self.counters["handshakes"] += 1
+            if resumed:
+                self.counters["resumed"] += 1
+            self.handshake_time += elapsed
+            self.last_handshake = elapsed
+        logger.info("TLS handshake with {0}:{1} took {2:.0f}ms{3}.".format(
+            host, port, elapsed * 1000, " (resumed)" if resumed else ""))
+        self.save_session(sock, host, port, network)
+
+    def handshake_failed(self):
+        with self.lock:
+            self.counters["failed"] += 1
+
+    def save_session(self, sock, host, port, network):
+        """Keep sock's session for the next connection to the same server.
+           With TLS 1.3 the server sends session tickets after the handshake,
+           so this is called again before the socket is closed."""
+        session = getattr(sock, "session", None)
+        if session is None:
+            return
+        with self.lock:
+            self.sessions[(host, port, self.settings(network))] = session
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["contexts"] = len(self.contexts)
+            stats["sessions"] = len(self.sessions)
+            done = self.counters["handshakes"]
+            stats["avg_handshake_ms"] = round(self.handshake_time / done * 1000, 1) if done else None
+            stats["last_handshake_ms"] = (round(self.last_handshake * 1000, 1)
+                                          if self.last_handshake is not None else None)
+            return stats
+
+def handshake(sock, timeout, should_stop=lambda: 0):
+    """Complete the handshake on a non-blocking SSLSocket, waiting on select
+       for whichever direction OpenSSL asks for. Returns the seconds taken.
+       Raises socket.timeout after timeout seconds."""
+    started = time.time()
+    deadline = started + timeout
+    while 1:
+        try:
+            sock.do_handshake()
+            return time.time() - started
+        except ssl.SSLWantReadError:
+            reads, writes = [sock], []
+        except ssl.SSLWantWriteError:
+            reads, writes = [], [sock]
+        if should_stop():
+            raise socket.timeout("TLS handshake interrupted")
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("TLS handshake timed out")
+        select.select(reads, writes, [], min(remaining, 1))
@@ -1,11 +1,16 @@
+import errno
 import logging
 import select
 import socket
 import ssl
 import threading
+import time
+from collections import deque, defaultdict
+from itertools import count
 
 import midori
 import midori.core
+import midori.tls
 
 try:
     import queue
@@ -14,13 +19,122 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# How readily an item may be dropped when its queue is full. Items that can
+# never be dropped are always accepted, even past the bound.
+SHED_NEVER = 0
+SHED_LATE = 1
+SHED_FIRST = 2
+
+# the midori.network.Network a pool thread is running a task for
+task_context = threading.local()
+
+def current_network():
+    """Return the Network whose event the calling pool thread is handling, or
+       None outside of such a task. Tasks dispatched from a task, and timers
+       scheduled from one, inherit its network."""
+    return getattr(task_context, "network", None)
+
+class SheddingQueue(object):
+    """FIFO queue with a bound and a load shedding policy.
+       shed_rank(item) returns one of the SHED_* constants. When the queue
+       holds maxsize items, a new item evicts the oldest queued item of the
+       highest rank above its own, or is itself refused if there is none.
+       SHED_NEVER items are always accepted, so protocol traffic is never
+       lost. Every dropped item is passed to on_shed(queue, item).
+       Supports the parts of the queue.Queue interface Midori uses.
+
+    Arguments:
+        name [string]: Name used in stats and overload events.
+        maxsize [int]: The bound. 0 means unbounded.
+        shed_rank [callable]: Returns an item's SHED_* rank.
+        on_shed [callable]: Called with (queue, item) for each dropped item,
+                            outside the queue's lock."""
+    def __init__(self, name, maxsize=0, shed_rank=lambda item: SHED_NEVER, on_shed=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.shed_rank = shed_rank
+        self.on_shed = on_shed
+        # one lane per rank; sequence numbers keep the overall order FIFO
+        self.lanes = [deque() for i in range(SHED_FIRST + 1)]
+        self.sequence = count()
+        self.size = 0
+        self.dropped = 0
+        self.peak = 0
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def put(self, item, block=1, timeout=None):
+        """Add item, unless the policy drops it. Never blocks.
+           Returns false if item itself was dropped."""
+        rank = self.shed_rank(item)
+        # flags rather than checks on victim, as None is a valid item
+        shed = refused = 0
+        victim = None
+        with self.not_empty:
+            if self.maxsize and self.size >= self.maxsize:
+                highest = max(r for r in range(len(self.lanes)) if self.lanes[r]) if self.size else 0
+                if rank != SHED_NEVER and rank >= highest:
+                    victim = item
+                    shed = refused = 1
+                elif highest != SHED_NEVER:
+                    victim = self.lanes[highest].popleft()[1]
+                    self.size -= 1
+                    shed = 1
+            if not refused:
+                self.lanes[rank].append((next(self.sequence), item))
+                self.size += 1
+                self.peak = max(self.peak, self.size)
+                self.not_empty.notify()
+            if shed:
+                self.dropped += 1
+        if shed and self.on_shed:
+            self.on_shed(self, victim)
+        return not refused
+
+    put_nowait = put
+
+    def get(self, block=1, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.size:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.size:
+                    self.not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            lane = min((l for l in self.lanes if l), key=lambda l: l[0][0])
+            self.size -= 1
+            return lane.popleft()[1]
+
+    def get_nowait(self):
+        return self.get(0)
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def stats(self):
+        return {"size": self.size, "maxsize": self.maxsize, "peak": self.peak,
+                "dropped": self.dropped}
+
 class ThreadPool(object):
     """Thread pool.
        stop: Stops all threads in this pool.
        dispatch: Execute call asynchronously with args and kwargs.
-                                     When and where it will execute is undefined."""
-    def __init__(self, nthreads):
-        self.queue = queue.Queue()
+                                     When and where it will execute is undefined.
+       With maxsize, at most that many tasks wait for a thread; past that,
+       tasks are shed according to the shed rank they were dispatched with.
+       A task runs with the network it was dispatched for as the current
+       network, see current_network."""
+    def __init__(self, nthreads, maxsize=0, on_shed=None):
+        self.queue = SheddingQueue("workers", maxsize, lambda task: task.shed, on_shed)
         self.threads = set()
         for i in range(nthreads):
             t = WorkerThread()
@@ -29,20 +143,27 @@ class ThreadPool(object):
             t.start()
         logger.info("Thread pool filled with {0} threads.".format(nthreads))
 
-    def dispatch(self, call, args=(), kwargs=None):
-        task = ThreadPoolTask(call, args, kwargs if kwargs else {})
-        self.queue.put(task)
+    def dispatch(self, call, args=(), kwargs=None, shed=SHED_NEVER, network=None):
+        """Run call(*args, **kwargs) on a pool thread. Returns false if the
+           task was shed straight away. network defaults to the caller's
+           current network."""
+        if network is None:
+            network = current_network()
+        task = ThreadPoolTask(call, args, kwargs if kwargs else {}, shed=shed, network=network)
+        return self.queue.put(task)
 
     def stop(self):
         for i in self.threads:
             self.queue.put(ThreadPoolTask(None, None, None, name="ThreadStop"))
 
 class ThreadPoolTask(object):
-    def __init__(self, call, args, kwargs, name="Task"):
+    def __init__(self, call, args, kwargs, name="Task", shed=SHED_NEVER, network=None):
         self.name = name
         self.call = call
         self.args = args
         self.kwargs = kwargs
+        self.shed = shed
+        self.network = network
 
 class WorkerThread(threading.Thread):
     """Thread that runs tasks from its parent ThreadPool.
@@ -55,6 +176,7 @@ class WorkerThread(threading.Thread):
                 logger.info("WorkerThread exiting.")
                 break
             else:
+                task_context.network = task.network
                 try:
                     task.call(*task.args, **task.kwargs)
                 except Exception:
@@ -62,12 +184,18 @@ class WorkerThread(threading.Thread):
                                  exc_info=1)
                     pass
                 finally:
+                    task_context.network = None
                     tasks_done += 1
 
 class NetworkThread(threading.Thread):
-    """Thread responsible for actually reading/writing to the socket."""
-    def __init__(self, midori_inst, host, port, use_ssl, read_queue, write_queue):
-        super(NetworkThread, self).__init__()
+    """Thread responsible for actually reading/writing to the socket.
+       The socket is non-blocking once connected, TLS handshake included.
+       With TLS, a read can need the socket to become writable first and a
+       write can need it to become readable (renegotiation, session tickets);
+       read_wants_write and write_wants_read track which is pending."""
+    def __init__(self, midori_inst, network, host, port, use_ssl, read_queue, write_queue):
+        super(NetworkThread, self).__init__(name="NetworkThread-{0}".format(network.name))
+        self.network = network
         self.host = host
         self.port = port
         self.ssl = use_ssl
@@ -75,75 +203,153 @@ class NetworkThread(threading.Thread):
         self.midori_inst = midori_inst
         self.read_queue = read_queue
         self.write_queue = write_queue
-        self.retry_send_with = None
+        self.irc_socket = None
+        self.stopping = 0
+        # bytes taken from write_queue and not yet accepted by the socket
+        self.outgoing = b""
+        self.read_wants_write = 0
+        self.write_wants_read = 0
 
     def parse_buffer(self):
         commands = self.read_buffer.split(b"\r\n")
         self.read_buffer = commands.pop()
         for command in commands:
-            command_obj = midori.core.Command(command.decode("utf-8"))
+            command_obj = midori.core.Command(command.decode("utf-8"), self.network)
             self.read_queue.put(command_obj)
 
     def run(self):
-        self.stopping = 0
-        address = self.midori_inst.config("bind_addr", "0.0.0.0")
+        try:
+            self.irc_socket = self.open_socket()
+        except (socket.error, OSError) as e:
+            logger.error("Cannot connect to {0}:{1}: {2}".format(self.host, self.port, e))
+            self.network.disconnected()
+            return
+        logger.info("Connected to {0}:{1}.".format(self.host, self.port))
+        try:
+            self.loop()
+        except (socket.error, OSError) as e:
+            # anything but WANT_READ/WANT_WRITE, TLS errors included
+            logger.error("Connection to {0}:{1} failed: {2}".format(self.host, self.port, e))
+            self.stop()
+            self.network.disconnected()
+
+    def open_socket(self):
+        address = self.network.config("bind_addr", "0.0.0.0")
         if ":" in address:
             af = socket.AF_INET6 # ipv6
         else:
             af = socket.AF_INET # ipv4 (plebs)
-        self.irc_socket = socket.socket(af, socket.SOCK_STREAM)
-        if self.ssl:
-            self.irc_socket = ssl.wrap_socket(self.irc_socket)
+        sock = socket.socket(af, socket.SOCK_STREAM)
         try:
-            self.irc_socket.bind((address, 0))
-        except OSError as e:
-            logger.error("Cannot bind net thread! {0}".format(e.strerror))
-            return
-        self.irc_socket.connect((self.host, self.port))
-        self.irc_socket.setblocking(0)
-        logger.info("Connected to {0}:{1}.".format(self.host, self.port))
-        while self.irc_socket.fileno() > 0:
-            if self.stopping and self.write_queue.empty():
-                self.stop()
-                return
-            reads = [self.irc_socket.fileno()]
-            writes = []
-            if not self.write_queue.empty():
-                writes.append(self.irc_socket.fileno())
-            r, w, x = select.select(reads, writes, [], 1.0 / 30)
-            if self.irc_socket.fileno() in r:
+            sock.bind((address, 0))
+            sock.settimeout(self.network.config("server.connect_timeout", 30))
+            sock.connect((self.host, self.port))
+            sock.setblocking(0)
+            if self.ssl:
+                sock = self.start_tls(sock)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def start_tls(self, sock):
+        tls = self.midori_inst.tls
+        sock = tls.wrap(sock, self.host, self.port, self.network)
+        try:
+            elapsed = midori.tls.handshake(sock, self.network.config("server.handshake_timeout", 30),
+                                           lambda: self.stopping)
+        except Exception:
+            tls.handshake_failed()
+            raise
+        tls.handshake_done(sock, self.host, self.port, self.network, elapsed)
+        cipher = sock.cipher()
+        self.network.tls = {
+            "handshake_ms": round(elapsed * 1000, 1),
+            "resumed": int(bool(getattr(sock, "session_reused", 0))),
+            "version": sock.version() if hasattr(sock, "version") else None,
+            "cipher": cipher[0] if cipher else None,
+        }
+        return sock
+
+    def loop(self):
+        sock = self.irc_socket
+        while 1:
+            if not self.outgoing:
+                if self.stopping and self.write_queue.empty():
+                    self.stop()
+                    return
                 try:
-                    data = self.irc_socket.recv(4096)
-                except ssl.SSLError:
+                    self.outgoing = self.write_queue.get_nowait()
+                except queue.Empty:
                     pass
-                except OSError:
+                else:
+                    midori.net_send.info(u"\033[31m{0}\033[0m".format(
+                        self.outgoing.decode("utf-8").strip("\r\n")))
+            reads = [sock]
+            writes = []
+            if (self.outgoing and not self.write_wants_read) or self.read_wants_write:
+                writes.append(sock)
+            if self.ssl and sock.pending():
+                # decrypted data that select can't see
+                r, w = [sock], []
+            else:
+                r, w, x = select.select(reads, writes, [], 1.0 / 30)
+            if sock in r or (self.read_wants_write and sock in w):
+                if not self.receive(sock):
                     self.stop()
-                    self.read_queue.put(None)
-                    logger.error("Socket closed unexpectedly!", exc_info=1)
+                    logger.error("Socket closed unexpectedly!")
+                    self.network.disconnected()
                     return
-                else:
-                    if not data:
-                        self.stop()
-                        self.read_queue.put(None)
-                        logger.error("Socket closed unexpectedly!")
-                        return
-                    self.read_buffer += data
-                    self.midori_inst.workers.dispatch(self.parse_buffer)
-            if self.irc_socket.fileno() in w:
-                if not self.retry_send_with:
-                    try:
-                        package = self.write_queue.get_nowait()
-                    except queue.Empty:
-                        pass
-                    midori.net_send.info(u"\033[31m{0}\033[0m".format(package.decode("utf-8")
-                                                                             .strip("\r\n")))
-                else:
-                    package = self.retry_send_with
-                    self.retry_send_with = None
-                try:
-                    self.irc_socket.send(package)
-                except ssl.SSLError:
-                    self.retry_send_with = package
+            if self.outgoing and ((sock in w and not self.write_wants_read)
+                                  or (self.write_wants_read and sock in r)):
+                self.send(sock)
+
+    def receive(self, sock):
+        """Read what is available. Returns false when the server closed the
+           connection."""
+        self.read_wants_write = 0
+        try:
+            data = sock.recv(4096)
+        except ssl.SSLWantReadError:
+            # a partial TLS record, or only handshake data
+            return 1
+        except ssl.SSLWantWriteError:
+            self.read_wants_write = 1
+            return 1
+        except socket.error as e:
+            if would_block(e):
+                return 1
+            raise
+        if not data:
+            return 0
+        self.read_buffer += data
+        self.midori_inst.workers.dispatch(self.parse_buffer)
+        return 1
+
+    def send(self, sock):
+        """Write as much of outgoing as the socket takes. After WANT_READ or
+           WANT_WRITE, the same data is written again once the socket is ready."""
+        self.write_wants_read = 0
+        try:
+            sent = sock.send(self.outgoing)
+        except ssl.SSLWantWriteError:
+            return
+        except ssl.SSLWantReadError:
+            self.write_wants_read = 1
+            return
+        except socket.error as e:
+            if would_block(e):
+                return
+            raise
+        self.outgoing = self.outgoing[sent:]
 
     def stop(self):
+        if self.irc_socket is None:
+            return
+        if self.ssl:
+            # TLS 1.3 session tickets arrive after the handshake
+            self.midori_inst.tls.save_session(self.irc_socket, self.host, self.port, self.network)
         self.irc_socket.close()
+
+def would_block(error):
+    return getattr(error, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK)
@@ -0,0 +1,62 @@
+import unittest
+
+from midori.admission import AdmissionControl
+
+def make_config(**settings):
+    """settings like user_rate=0 map to admission.user.rate."""
+    values = dict(("admission." + k.replace("_", "."), v) for k, v in settings.items())
+    return lambda key, default=None: values.get(key, default)
+
+# no refill, so nothing depends on how fast the tests run
+FROZEN = dict(user_rate=0, channel_rate=0, command_rate=0)
+
+class AdmissionControlTest(unittest.TestCase):
+    def test_burst_then_reject(self):
+        admission = AdmissionControl(make_config(user_burst=3, **FROZEN))
+        results = [admission.admit(1, user="host") for i in range(4)]
+        self.assertEqual(results, [1, 1, 1, 0])
+        self.assertEqual(admission.stats()["rejected_user"], 1)
+        # another user has their own bucket
+        self.assertTrue(admission.admit(1, user="other"))
+
+    def test_refill(self):
+        admission = AdmissionControl(make_config(user_burst=2, user_rate=1))
+        admission.admit(2, user="host")
+        self.assertFalse(admission.admit(1, user="host"))
+        # pretend the last draw was a second ago
+        admission.buckets["user"]["host"][1] -= 1.5
+        self.assertTrue(admission.admit(1, user="host"))
+        self.assertFalse(admission.admit(1, user="host"))
+
+    def test_refill_is_capped_at_burst(self):
+        admission = AdmissionControl(make_config(user_burst=2, user_rate=1))
+        admission.admit(1, user="host")
+        admission.buckets["user"]["host"][1] -= 100
+        self.assertTrue(admission.admit(2, user="host"))
+        self.assertFalse(admission.admit(1, user="host"))
+
+    def test_rejection_takes_nothing(self):
+        admission = AdmissionControl(make_config(user_burst=5, channel_burst=2, **FROZEN))
+        self.assertTrue(admission.admit(2, user="host", channel="#a"))
+        # the channel is short, so the user keeps its 3 tokens
+        self.assertFalse(admission.admit(1, user="host", channel="#a"))
+        self.assertEqual(admission.stats()["rejected_channel"], 1)
+        self.assertTrue(admission.admit(3, user="host"))
+
+    def test_free_and_disabled(self):
+        admission = AdmissionControl(make_config(user_burst=1, **FROZEN))
+        self.assertTrue(admission.admit(1, user="host"))
+        self.assertTrue(admission.admit(0, user="host"))
+        admission.config = make_config(user_burst=1, enabled=0, **FROZEN)
+        self.assertTrue(admission.admit(1, user="host"))
+
+    def test_prunes_refilled_buckets(self):
+        admission = AdmissionControl(make_config(user_burst=1, user_rate=1), max_keys=2)
+        admission.admit(1, user="a")
+        admission.admit(1, user="b")
+        admission.buckets["user"]["a"][1] -= 10
+        admission.admit(1, user="c")
+        self.assertEqual(sorted(admission.buckets["user"]), ["b", "c"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+from midori.antiflood import (AntiFlood, DecayingSketch, SlidingCounter, FLOOD_JOINS, FLOOD_RATE,
+                              FLOOD_REPEAT)
+
+def make_config(**settings):
+    values = dict(("flood." + k, v) for k, v in settings.items())
+    return lambda key, default=None: values.get(key, default)
+
+POPULAR = "https://twitter.com/someone/status/12345"
+
+class SlidingCounterTest(unittest.TestCase):
+    def test_counts_within_window(self):
+        counter = SlidingCounter(10)
+        for i in range(5):
+            self.assertEqual(counter.add(100.0 + i), i + 1)
+
+    def test_old_slots_expire(self):
+        counter = SlidingCounter(10)
+        counter.add(100.0, 3)
+        counter.add(105.0, 2)
+        self.assertEqual(counter.add(110.5), 3)
+        self.assertEqual(counter.add(200.0), 1)
+
+class DecayingSketchTest(unittest.TestCase):
+    def test_never_undercounts(self):
+        sketch = DecayingSketch(10, width=64)
+        for i in range(200):
+            sketch.add("key{0}".format(i % 50), 100.0)
+        self.assertTrue(sketch.add("key0", 100.0) >= 5)
+
+    def test_decays_after_two_windows(self):
+        sketch = DecayingSketch(10)
+        for i in range(3):
+            sketch.add("spam", 100.0)
+        self.assertEqual(sketch.add("spam", 111.0), 4)
+        self.assertEqual(sketch.add("spam", 125.0), 2)
+        self.assertEqual(sketch.add("spam", 150.0), 1)
+
+class AntiFloodTest(unittest.TestCase):
+    def test_sender_repeats_are_suppressed(self):
+        flood = AntiFlood(make_config())
+        results = [flood.message("#a", "spammer", "bad.host", "buy cheap stuff now")
+                   for i in range(7)]
+        self.assertEqual([spam for spam, events in results], [0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual([e.kind for e in results[5][1]], [FLOOD_REPEAT])
+        self.assertEqual(results[6][1], [])
+
+    def test_popular_message_from_many_senders_passes(self):
+        flood = AntiFlood(make_config())
+        results = [flood.message("#a", "user{0}".format(i), "host{0}".format(i), POPULAR)
+                   for i in range(20)]
+        self.assertFalse(any(spam for spam, events in results))
+        # still reported, for observers and policies
+        self.assertEqual(flood.stats()[FLOOD_REPEAT], 1)
+        self.assertEqual(flood.stats()["suppressed"], 0)
+
+    def test_channel_with_repeat_policy_suppresses_copies(self):
+        flood = AntiFlood(make_config())
+        flood.set_policy("#Guarded", repeat="kickban")
+        results = [flood.message("#guarded", "user{0}".format(i), "host{0}".format(i), POPULAR)
+                   for i in range(7)]
+        self.assertEqual([spam for spam, events in results], [0, 0, 0, 0, 0, 1, 1])
+
+    def test_suppression_can_be_turned_off(self):
+        flood = AntiFlood(make_config(suppress_repeats=0))
+        results = [flood.message("#a", "spammer", "bad.host", "buy cheap stuff now")
+                   for i in range(10)]
+        self.assertFalse(any(spam for spam, events in results))
+        self.assertEqual(flood.stats()[FLOOD_REPEAT], 1)
+
+    def test_short_messages_are_never_spam(self):
+        flood = AntiFlood(make_config())
+        results = [flood.message("#a", "n", "h", "lol") for i in range(20)]
+        self.assertFalse(any(spam for spam, events in results))
+
+    def test_channel_rate(self):
+        flood = AntiFlood(make_config(channel_rate=3))
+        kinds = []
+        for i in range(5):
+            spam, events = flood.message("#a", "n{0}".format(i), "h{0}".format(i),
+                                         "message {0}".format(i))
+            kinds.extend(e.kind for e in events)
+        self.assertEqual(kinds, [FLOOD_RATE])
+
+    def test_join_flood_and_cooldown(self):
+        flood = AntiFlood(make_config(joins=2))
+        events = []
+        for i in range(6):
+            events.extend(flood.membership("#a", "n{0}".format(i), "h"))
+        self.assertEqual([(e.kind, e.count) for e in events], [(FLOOD_JOINS, 3)])
+
+    def test_forget(self):
+        flood = AntiFlood(make_config(joins=2))
+        for i in range(3):
+            flood.membership("#a", "n", "h")
+        flood.forget("#A")
+        self.assertEqual(flood.membership("#a", "n", "h"), [])
+
+    def test_policy_validation(self):
+        flood = AntiFlood(make_config())
+        self.assertRaises(ValueError, flood.set_policy, "#a", rate="ban")
+        self.assertRaises(ValueError, flood.set_policy, "#a", bogus="moderate")
+        flood.set_policy("#a", joins="moderate")
+        flood.set_policy("#a", joins=None)
+        self.assertEqual(flood.action_for_kind("#a", FLOOD_JOINS), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+import midori
+from midori.api import API, Channel, ExtensionAPI, PrivateMessage, User
+
+class FakeBase(object):
+    """Stands in for midori.base, which keeps the command hooks."""
+    def hook_privcommand(self, context, callback, predicate=lambda cmd: 1, cost=0):
+        pass
+
+    def hook_url(self, host, callback, context=midori.CONTEXT_ALL, predicate=lambda cmd: 1,
+                 cost=0):
+        pass
+
+class FakeExtensionManager(object):
+    def get_extension(self, ext_id):
+        return FakeBase()
+
+class FakeInstance(object):
+    ext_manager = FakeExtensionManager()
+
+class FakeNetwork(object):
+    def __init__(self, **settings):
+        self.instance = FakeInstance()
+        self.settings = settings
+        self.api = API(self.instance, self)
+
+    def config(self, key, default=None):
+        return self.settings.get(key, default)
+
+class RedeliverTest(unittest.TestCase):
+    def setUp(self):
+        # five user tokens that don't refill during the test
+        self.network = FakeNetwork(**{"admission.user.burst": 5, "admission.user.rate": 0})
+        self.ext_api = ExtensionAPI(self.network.api, "test.lazy")
+        self.calls = []
+
+    def message(self, text, host="spam.example.org"):
+        return PrivateMessage(User(("nick", "user", host)), Channel("#chan"),
+                              midori.CONTEXT_CHANNEL, text, self.network)
+
+    def test_redelivered_commands_are_charged(self):
+        self.ext_api.hook_command(midori.CONTEXT_ALL, self.calls.append, cost=3)
+        for i in range(3):
+            self.ext_api.redeliver(self.message("!expensive"))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.network.api.admission.stats()["rejected_user"], 2)
+        # another sender has tokens of their own
+        self.ext_api.redeliver(self.message("!expensive", "other.example.org"))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_redelivered_url_hooks_are_charged(self):
+        self.ext_api.hook_url("example.com", self.calls.append, cost=3)
+        self.ext_api.redeliver(self.message("see https://example.com/a"))
+        self.ext_api.redeliver(self.message("see https://www.example.com/b"))
+        self.assertEqual(len(self.calls), 1)
+        self.assertIn("url:example.com", self.network.api.admission.buckets["command"])
+
+    def test_free_hooks_are_not_charged(self):
+        self.ext_api.hook_command(midori.CONTEXT_ALL, self.calls.append)
+        for i in range(10):
+            self.ext_api.redeliver(self.message("!free"))
+        self.assertEqual(len(self.calls), 10)
+        self.assertEqual(self.network.api.admission.stats()["tracked_user"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
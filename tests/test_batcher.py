@@ -0,0 +1,206 @@
+from __future__ import unicode_literals
+import unittest
+
+from midori.batcher import ModeQueue, OutputBatcher, split_message
+from midori.isupport import ISupport
+
+# what Libera.Chat (Solanum) sends; TARGMAX leaves out JOIN and PART
+SOLANUM = ["CHANTYPES=#", "EXCEPTS", "INVEX", "CHANMODES=eIbq,k,flj,CFLMPQRSTcgimnprstuz",
+           "CHANLIMIT=#:250", "PREFIX=(ov)@+", "MAXLIST=bqeI:100", "MODES=4",
+           "NETWORK=Libera.Chat", "STATUSMSG=@+", "CASEMAPPING=rfc1459", "NICKLEN=16",
+           "CHANNELLEN=50", "TOPICLEN=390",
+           "TARGMAX=NAMES:1,LIST:1,KICK:1,WHOIS:1,PRIVMSG:4,NOTICE:4,ACCEPT:,MONITOR:"]
+
+class FakeTimer(object):
+    def cancel(self):
+        pass
+
+def make_batcher(tokens=()):
+    isupport = ISupport()
+    isupport.update(list(tokens))
+    lines = []
+    batcher = OutputBatcher(isupport, lines.append, lambda: "bot!bot@example.org",
+                            lambda delay, callback: FakeTimer())
+    return batcher, lines
+
+class ISupportTest(unittest.TestCase):
+    def test_targmax_lists(self):
+        isupport = ISupport()
+        isupport.update(SOLANUM)
+        self.assertEqual(isupport.targmax("PRIVMSG"), 4)
+        self.assertEqual(isupport.targmax("kick"), 1)
+        self.assertEqual(isupport.targmax("MONITOR"), None)
+
+    def test_targmax_unlisted_falls_back(self):
+        isupport = ISupport()
+        isupport.update(SOLANUM)
+        self.assertEqual(isupport.targmax("JOIN"), None)
+        self.assertEqual(isupport.targmax("PART"), None)
+        self.assertEqual(isupport.targmax("INVITE"), 1)
+
+    def test_targmax_without_token(self):
+        isupport = ISupport()
+        self.assertEqual(isupport.targmax("PRIVMSG"), 1)
+        isupport.update(["MAXTARGETS=3"])
+        self.assertEqual(isupport.targmax("NOTICE"), 3)
+        self.assertEqual(isupport.targmax("JOIN"), None)
+
+    def test_update_and_reset(self):
+        isupport = ISupport()
+        isupport.update(["LINELEN=1024", "MODES=", "NETWORK=a\\x20b"])
+        self.assertEqual(isupport.linelen, 1024)
+        self.assertEqual(isupport.modes, 12)
+        self.assertEqual(isupport.get("NETWORK"), "a b")
+        isupport.update(["-LINELEN"])
+        self.assertEqual(isupport.linelen, 512)
+        isupport.reset()
+        self.assertEqual(isupport.modes, 3)
+
+    def test_casefold(self):
+        isupport = ISupport()
+        self.assertEqual(isupport.casefold("Nick[a]~"), "nick{a}^")
+        isupport.update(["CASEMAPPING=ascii"])
+        self.assertEqual(isupport.casefold("Nick[a]^"), "nick[a]^")
+
+    def test_prefixes_and_chanmodes(self):
+        isupport = ISupport()
+        isupport.update(SOLANUM)
+        self.assertEqual(isupport.prefixes, [("o", "@"), ("v", "+")])
+        self.assertEqual(isupport.chanmodes, ["eIbq", "k", "flj", "CFLMPQRSTcgimnprstuz"])
+
+class JoinLinesTest(unittest.TestCase):
+    def test_solanum_joins_are_batched(self):
+        batcher, lines = make_batcher(SOLANUM)
+        self.assertEqual(batcher.join_lines([("#a", None), ("#b", None), ("#c", None)]),
+                         ["JOIN #a,#b,#c"])
+
+    def test_keyed_channels_first(self):
+        batcher, lines = make_batcher(SOLANUM)
+        self.assertEqual(batcher.join_lines([("#a", None), ("#b", "key"), ("#c", None)]),
+                         ["JOIN #b,#a,#c key"])
+
+    def test_targmax_limit(self):
+        batcher, lines = make_batcher(["TARGMAX=JOIN:2"])
+        self.assertEqual(batcher.join_lines([("#a", None), ("#b", None), ("#c", None)]),
+                         ["JOIN #a,#b", "JOIN #c"])
+
+    def test_line_length(self):
+        batcher, lines = make_batcher(SOLANUM)
+        channels = [("#" + "x" * 48 + "{0:02}".format(i), None) for i in range(30)]
+        result = batcher.join_lines(channels)
+        self.assertTrue(len(result) > 1)
+        for line in result:
+            self.assertTrue(len(line.encode("utf-8")) <= 510)
+        joined = ",".join(line.split()[1] for line in result).split(",")
+        self.assertEqual(joined, [c for c, k in channels])
+
+    def test_join_deduplicates_and_flushes(self):
+        batcher, lines = make_batcher(SOLANUM)
+        batcher.join("#Chan")
+        batcher.join("#chan")
+        batcher.join("#other")
+        self.assertTrue(batcher.pending)
+        batcher.flush()
+        self.assertEqual(lines, ["JOIN #Chan,#other"])
+        self.assertFalse(batcher.pending)
+
+class GroupTargetsTest(unittest.TestCase):
+    def test_solanum_privmsg_groups_of_four(self):
+        batcher, lines = make_batcher(SOLANUM)
+        targets = ["#{0}".format(i) for i in range(10)]
+        self.assertEqual(batcher.group_targets("PRIVMSG", targets, 400),
+                         ["#0,#1,#2,#3", "#4,#5,#6,#7", "#8,#9"])
+
+    def test_room(self):
+        batcher, lines = make_batcher(["TARGMAX=PRIVMSG:"])
+        self.assertEqual(batcher.group_targets("PRIVMSG", ["#aa", "#bb", "#cc"], 7),
+                         ["#aa,#bb", "#cc"])
+
+    def test_message_to_several_targets(self):
+        batcher, lines = make_batcher(SOLANUM)
+        batcher.message("PRIVMSG", ["#a", "#b", "#c", "#d", "#e"], "hello\nworld")
+        self.assertEqual(lines, ["PRIVMSG #a,#b,#c,#d :hello", "PRIVMSG #a,#b,#c,#d :world",
+                                 "PRIVMSG #e :hello", "PRIVMSG #e :world"])
+
+    def test_message_flushes_joins_first(self):
+        batcher, lines = make_batcher(SOLANUM)
+        batcher.join("#a")
+        batcher.message("PRIVMSG", ["#a"], "hi")
+        self.assertEqual(lines, ["JOIN #a", "PRIVMSG #a :hi"])
+
+class ModeQueueTest(unittest.TestCase):
+    def setUp(self):
+        isupport = ISupport()
+        isupport.update(SOLANUM)
+        self.lines = []
+        self.timers = []
+        self.modes = ModeQueue(isupport, self.lines.append, self.call_later)
+
+    def call_later(self, delay, callback, args):
+        self.timers.append((delay, callback, args))
+        return FakeTimer()
+
+    def test_packs_up_to_modes_limit(self):
+        for nick in "abcdef":
+            self.modes.queue("#c", "+v", nick)
+        self.modes.flush()
+        self.assertEqual(self.lines, ["MODE #c +vvvv a b c d", "MODE #c +vv e f"])
+
+    def test_flags_do_not_count_against_limit(self):
+        self.modes.queue("#c", "+m")
+        for nick in "abcd":
+            self.modes.queue("#c", "-o", nick)
+        self.modes.flush()
+        self.assertEqual(self.lines, ["MODE #c +m-oooo a b c d"])
+
+    def test_undo_cancels_pending_change(self):
+        self.modes.queue("#c", "+v", "Nick[1]")
+        self.modes.queue("#C", "-v", "nick{1}")
+        self.modes.queue("#c", "+b", "*!*@spam")
+        self.modes.flush()
+        self.assertEqual(self.lines, ["MODE #c +b *!*@spam"])
+        self.assertEqual(self.modes.stats()["cancelled"], 2)
+
+    def test_repeat_is_sent_once(self):
+        self.modes.queue("#c", "+o", "a")
+        self.modes.queue("#c", "+o", "A")
+        self.modes.flush()
+        self.assertEqual(self.lines, ["MODE #c +o A"])
+
+    def test_single_value_mode_is_replaced(self):
+        self.modes.queue("#c", "+l", "10")
+        self.modes.queue("#c", "+l", "20")
+        self.modes.flush()
+        self.assertEqual(self.lines, ["MODE #c +l 20"])
+
+    def test_window_timer_per_channel(self):
+        self.modes.queue("#a", "+v", "x")
+        self.modes.queue("#a", "+v", "y")
+        self.modes.queue("#b", "+v", "x")
+        self.assertEqual([(delay, args) for delay, callback, args in self.timers],
+                         [(0.3, ("#a",)), (0.3, ("#b",))])
+        delay, callback, args = self.timers[0]
+        callback(*args)
+        self.assertEqual(self.lines, ["MODE #a +vv x y"])
+        self.assertEqual(self.modes.stats()["pending"], 1)
+
+class SplitMessageTest(unittest.TestCase):
+    def test_splits_at_spaces(self):
+        self.assertEqual(split_message("aaa bbb ccc", 7), ["aaa bbb", "ccc"])
+
+    def test_never_cuts_a_character(self):
+        chunks = split_message("\u00e9" * 10, 5)
+        self.assertEqual("".join(chunks), "\u00e9" * 10)
+        for chunk in chunks:
+            self.assertTrue(len(chunk.encode("utf-8")) <= 5)
+
+    def test_fits_after_hostmask(self):
+        batcher, lines = make_batcher()
+        batcher.message("PRIVMSG", ["#a"], "word " * 200)
+        relayed = len(":bot!bot@example.org  :\r\n") + len("PRIVMSG #a")
+        for line in lines:
+            text = line.split(" :", 1)[1]
+            self.assertTrue(len(text.encode("utf-8")) + relayed <= 512)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+from __future__ import unicode_literals
+import base64
+import unittest
+
+from midori.caps import Capabilities, parse_tags, parse_time, unescape_tag
+from midori.core import Command
+
+class FakeTimer(object):
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = 0
+
+    def cancel(self):
+        self.cancelled = 1
+
+    def fire(self):
+        """Run the callback, as a timer that went off just before it was
+           cancelled would."""
+        self.callback(*self.args)
+
+class FakeTimers(object):
+    def __init__(self):
+        self.handles = []
+
+    def call_later(self, delay, callback, args=(), kwargs=None):
+        self.handles.append(FakeTimer(callback, args))
+        return self.handles[-1]
+
+class FakeInstance(object):
+    def __init__(self):
+        self.timers = FakeTimers()
+
+class FakeAPI(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_raw(self, line):
+        self.sent.append(line)
+
+class FakeNetwork(object):
+    """What Capabilities uses of midori.network.Network."""
+    def __init__(self, **settings):
+        self.name = "test"
+        self.remote = 0
+        self.instance = FakeInstance()
+        self.api = FakeAPI()
+        self.settings = settings
+        self.settings.setdefault("identity", {"nick": "bot"})
+
+    def config(self, key, default=None):
+        value = self.settings
+        for part in key.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return default
+            value = value[part]
+        return value
+
+class TagsTest(unittest.TestCase):
+    def test_parse_tags(self):
+        self.assertEqual(parse_tags("time=2011-10-19T16:40:51.620Z;batch=ref;account;+draft/x="),
+                         {"time": "2011-10-19T16:40:51.620Z", "batch": "ref", "account": "",
+                          "+draft/x": ""})
+
+    def test_unescape(self):
+        self.assertEqual(unescape_tag("a\\sb\\:c\\\\d\\r\\n"), "a b;c\\d\r\n")
+        # unknown escapes drop the backslash, a trailing one is dropped
+        self.assertEqual(unescape_tag("\\b\\"), "b")
+        self.assertEqual(unescape_tag("plain"), "plain")
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("2011-10-19T16:40:51Z"), 1319042451)
+        self.assertAlmostEqual(parse_time("2011-10-19T16:40:51.620Z"), 1319042451.62)
+        self.assertIsNone(parse_time("yesterday"))
+        self.assertIsNone(parse_time(None))
+
+    def test_command_tags(self):
+        cmd = Command("@time=2011-10-19T16:40:51.620Z;msgid=abc :nick!user@host PRIVMSG "
+                      "#chan :hello there")
+        self.assertEqual(cmd.tags["msgid"], "abc")
+        self.assertEqual(cmd.sender, ("nick", "user", "host"))
+        self.assertEqual(cmd.kind, "PRIVMSG")
+        self.assertEqual(cmd.args, ["#chan"])
+        self.assertEqual(cmd.message, "hello there")
+        self.assertAlmostEqual(cmd.time, 1319042451.62)
+
+    def test_command_without_tags(self):
+        cmd = Command(":server 001 bot :Welcome")
+        self.assertEqual(cmd.tags, {})
+        self.assertEqual(cmd.time, cmd.received)
+
+class CapabilitiesTest(unittest.TestCase):
+    def negotiate(self, network, *lines):
+        caps = Capabilities(network)
+        caps.start()
+        for line in lines:
+            self.feed(caps, line)
+        return caps
+
+    def feed(self, caps, line):
+        cmd = Command(line)
+        if cmd.kind == "CAP":
+            caps.on_cap(cmd)
+        elif cmd.kind == "AUTHENTICATE":
+            caps.on_authenticate(cmd)
+        else:
+            caps.on_sasl_result(cmd)
+
+    def test_requests_what_server_has(self):
+        network = FakeNetwork()
+        caps = self.negotiate(network,
+                              ":server CAP * LS * :multi-prefix away-notify unknown",
+                              ":server CAP * LS :server-time batch")
+        self.assertEqual(network.api.sent, [
+            "CAP LS 302", "CAP REQ :away-notify batch multi-prefix server-time"])
+        self.feed(caps, ":server CAP * ACK :away-notify batch multi-prefix server-time")
+        self.assertIn("batch", caps)
+        self.assertEqual(network.api.sent[-1], "CAP END")
+
+    def test_nak_still_ends(self):
+        network = FakeNetwork()
+        caps = self.negotiate(network, ":server CAP * LS :batch",
+                              ":server CAP * NAK :batch")
+        self.assertNotIn("batch", caps)
+        self.assertEqual(network.api.sent[-1], "CAP END")
+
+    def test_nothing_to_request(self):
+        network = FakeNetwork()
+        self.negotiate(network, ":server CAP * LS :unknown")
+        self.assertEqual(network.api.sent, ["CAP LS 302", "CAP END"])
+
+    def test_sasl_plain(self):
+        network = FakeNetwork(sasl={"username": "acct", "password": "secret"})
+        caps = self.negotiate(network, ":server CAP * LS :sasl=PLAIN,EXTERNAL",
+                              ":server CAP * ACK :sasl",
+                              "AUTHENTICATE +")
+        payload = base64.b64encode(b"acct\0acct\0secret").decode("ascii")
+        self.assertEqual(network.api.sent, ["CAP LS 302", "CAP REQ :sasl", "AUTHENTICATE PLAIN",
+                                            "AUTHENTICATE " + payload])
+        self.feed(caps, ":server 900 bot bot!u@h acct :You are now logged in")
+        self.feed(caps, ":server 903 bot :SASL authentication successful")
+        self.assertEqual(caps.account, "acct")
+        self.assertEqual(caps.sasl_state, "done")
+        self.assertEqual(network.api.sent[-1], "CAP END")
+
+    def test_sasl_mechanism_not_offered(self):
+        network = FakeNetwork(sasl={"mechanism": "EXTERNAL"})
+        self.negotiate(network, ":server CAP * LS :sasl=PLAIN")
+        self.assertEqual(network.api.sent, ["CAP LS 302", "CAP END"])
+
+    def test_sasl_failure(self):
+        network = FakeNetwork(sasl={"password": "wrong"})
+        lines = [":server CAP * LS :sasl", ":server CAP * ACK :sasl", "AUTHENTICATE +",
+                 ":server 904 bot :SASL authentication failed"]
+        caps = self.negotiate(network, *lines)
+        self.assertEqual(caps.sasl_state, "failed")
+        self.assertEqual(network.api.sent[-1], "CAP END")
+        network = FakeNetwork(sasl={"password": "wrong", "required": True})
+        self.negotiate(network, *lines)
+        self.assertEqual(network.api.sent[-1], "QUIT :SASL authentication failed")
+
+    def test_timeout_ends_negotiation(self):
+        network = FakeNetwork()
+        caps = self.negotiate(network, ":server CAP * LS * :batch")
+        network.instance.timers.handles[-1].fire()
+        self.assertEqual(network.api.sent[-1], "CAP END")
+        self.assertFalse(caps.negotiating)
+
+    def test_stale_timeout_after_reconnect(self):
+        network = FakeNetwork(sasl={"password": "secret"})
+        lines = [":server CAP * LS :sasl", ":server CAP * ACK :sasl"]
+        caps = self.negotiate(network, *lines)
+        # the connection drops mid-negotiation and the next one gets as far
+        caps.disconnected()
+        stale = network.instance.timers.handles[0]
+        self.assertTrue(stale.cancelled)
+        caps.start()
+        for line in lines:
+            self.feed(caps, line)
+        self.assertTrue(stale.cancelled)
+        sent = len(network.api.sent)
+        stale.fire()
+        self.assertEqual(len(network.api.sent), sent)
+        self.assertEqual(caps.sasl_state, "authenticating")
+        self.assertTrue(caps.negotiating)
+
+    def test_restart_cancels_timeout(self):
+        network = FakeNetwork()
+        caps = Capabilities(network)
+        caps.start()
+        caps.start()
+        stale, current = network.instance.timers.handles
+        self.assertTrue(stale.cancelled)
+        self.assertFalse(current.cancelled)
+        stale.fire()
+        self.assertNotIn("CAP END", network.api.sent)
+
+if __name__ == "__main__":
+    unittest.main()
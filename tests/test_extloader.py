@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from midori.extloader import DependencyError, ExtensionManager
+
+EXTENSION = '''class Extension(object):
+    def __init__(self, log, config):
+        log.append(__identifier__)
+
+__identifier__ = "{identifier}"
+__dependencies__ = {dependencies!r}
+__version__ = "1.0"
+__ext_class__ = Extension
+{triggers}'''
+
+class ExtensionOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="midori-extloader-")
+        self.log = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        for name in [n for n in sys.modules if n.startswith("pbx.")]:
+            del sys.modules[name]
+
+    def write(self, filename, identifier, dependencies=(), triggers=None):
+        with open(os.path.join(self.directory, filename), "w") as f:
+            f.write(EXTENSION.format(
+                identifier=identifier, dependencies=list(dependencies),
+                triggers="__triggers__ = {0!r}\n".format(triggers) if triggers else ""))
+
+    def manager(self):
+        return ExtensionManager(search_dirs=[self.directory], pinned=["midori.base"])
+
+    def preload(self, mod):
+        return (self.log, {})
+
+    def park(self, ext_id, manifest):
+        if manifest is not None:
+            self.log.append("parked " + ext_id)
+
+    def test_pinned_core_loads_first(self):
+        # "admin" sorts before "midori.base" and doesn't declare it
+        self.write("admin.py", "admin")
+        self.write("base.py", "midori.base")
+        self.write("zeta.py", "zeta", ["admin"])
+        self.manager().load_extensions(self.preload)
+        self.assertEqual(self.log, ["midori.base", "admin", "zeta"])
+
+    def test_pinned_core_comes_before_stubs(self):
+        self.write("admin.py", "admin", triggers={"commands": ["!admin"]})
+        self.write("base.py", "midori.base")
+        self.manager().load_extensions(self.preload, self.park)
+        self.assertEqual(self.log, ["midori.base", "parked admin"])
+
+    def test_dependencies_come_first(self):
+        self.write("base.py", "midori.base")
+        self.write("a.py", "a", ["c"])
+        self.write("b.py", "b")
+        self.write("c.py", "c", ["b"])
+        self.manager().load_extensions(self.preload)
+        self.assertEqual(self.log, ["midori.base", "b", "c", "a"])
+
+    def test_cycle(self):
+        self.write("a.py", "a", ["b"])
+        self.write("b.py", "b", ["a"])
+        self.assertRaises(DependencyError, self.manager().load_extensions, self.preload)
+
+if __name__ == "__main__":
+    unittest.main()
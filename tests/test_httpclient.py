@@ -0,0 +1,84 @@
+import unittest
+
+from midori import httpclient
+from midori.httpclient import HTTPClient, HTTPOverloadError, HTTPUnavailableError
+
+class FakeResponse(object):
+    def __init__(self, url):
+        self.url = url
+
+@unittest.skipIf(httpclient.requests is None, "requests is not installed")
+class HTTPClientTest(unittest.TestCase):
+    def make_client(self, **kwargs):
+        """A client whose jobs are collected in self.submitted instead of
+           running; finish() runs them."""
+        client = HTTPClient(**kwargs)
+        self.addCleanup(client.close)
+        self.submitted = []
+        client.submit = self.submitted.extend
+        client.session.request = lambda method, url, **kwargs: FakeResponse(url)
+        return client
+
+    def submitted_urls(self):
+        return [job[2] for host, job in self.submitted]
+
+    def finish(self, client):
+        """Run the oldest submitted job, which may submit more."""
+        host, job = self.submitted.pop(0)
+        client.perform(host, job)
+        return job[2]
+
+    def test_global_and_per_host_limits(self):
+        client = self.make_client(max_concurrency=3, per_host=2)
+        futures = [client.get("http://{0}/{1}".format(host, i))
+                   for host in ("a", "b") for i in range(3)]
+        self.assertEqual(self.submitted_urls(), ["http://a/0", "http://a/1", "http://b/0"])
+        self.assertEqual(client.stats()["running"], 3)
+        self.assertEqual(client.stats()["queued"], 3)
+        # a finished request to a makes room for the next one there
+        self.finish(client)
+        self.assertEqual(futures[0].result().url, "http://a/0")
+        self.assertEqual(self.submitted_urls()[-1], "http://a/2")
+        # finishing b/0 lets b/1 in, and leaves the client at its global limit
+        self.finish(client)
+        self.finish(client)
+        self.assertEqual(client.stats()["running"], 3)
+        self.assertEqual(client.stats()["queued"], 0)
+
+    def test_hosts_are_served_round_robin(self):
+        client = self.make_client(max_concurrency=1, per_host=1)
+        for url in ["http://slow/0", "http://slow/1", "http://slow/2", "http://slow/3",
+                    "http://b/0", "http://c/0", "http://b/1"]:
+            client.get(url)
+        order = []
+        while self.submitted:
+            order.append(self.finish(client))
+        self.assertEqual(order, ["http://slow/0", "http://slow/1", "http://b/0", "http://c/0",
+                                 "http://slow/2", "http://b/1", "http://slow/3"])
+
+    def test_rejects_past_max_queued(self):
+        client = self.make_client(max_concurrency=1, max_queued=1)
+        client.get("http://a/0")
+        client.get("http://a/1")
+        future = client.get("http://a/2")
+        self.assertIsInstance(future.exception(0), HTTPOverloadError)
+        self.assertEqual(client.stats()["rejected"], 1)
+
+    def test_close_fails_waiting_requests(self):
+        client = self.make_client(max_concurrency=1)
+        running = client.get("http://a/0")
+        waiting = client.get("http://a/1")
+        seen = []
+        waiting.add_done_callback(lambda future: seen.append(future.exception()))
+        client.close()
+        self.assertFalse(waiting.cancelled())
+        self.assertEqual(len(seen), 1)
+        self.assertIsInstance(seen[0], HTTPUnavailableError)
+        # the running request still completes, and nothing new starts
+        self.finish(client)
+        self.assertEqual(running.result().url, "http://a/0")
+        self.assertEqual(self.submitted, [])
+        self.assertIsInstance(client.get("http://a/2").exception(0), HTTPUnavailableError)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+from midori.timers import SLOTS, TimerHandle, TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.wheel = TimerWheel(self.dispatch, resolution=1.0)
+        # the wheel's thread is never started; time is whatever run() says
+        self.wheel.origin = 0.0
+
+    def dispatch(self, call, network=None):
+        call()
+
+    def schedule(self, when, name, interval=None, coalesce=1):
+        handle = TimerHandle(self.wheel, when, self.calls.append, (name,), {}, interval,
+                             coalesce=coalesce)
+        self.wheel.schedule(handle)
+        return handle
+
+    def run_until(self, now):
+        """Advance the wheel to now and fire what is due, like its thread."""
+        for handle in self.wheel.advance(now):
+            self.wheel.fire(handle, now)
+
+    def test_fires_once_due(self):
+        self.schedule(5.5, "a")
+        self.schedule(2.0, "b")
+        self.run_until(5.0)
+        self.assertEqual(self.calls, ["b"])
+        self.run_until(6.0)
+        self.assertEqual(self.calls, ["b", "a"])
+        self.assertEqual(self.wheel.stats()["scheduled"], 0)
+
+    def test_higher_levels_cascade_down(self):
+        far = SLOTS * SLOTS + 10.5
+        self.schedule(far, "far")
+        self.schedule(SLOTS + 3.5, "near")
+        self.run_until(SLOTS + 4.0)
+        self.assertEqual(self.calls, ["near"])
+        self.run_until(far - 1)
+        self.assertEqual(self.calls, ["near"])
+        self.run_until(far + 1)
+        self.assertEqual(self.calls, ["near", "far"])
+
+    def test_cascaded_timer_due_on_level_boundary(self):
+        self.schedule(SLOTS - 1.0, "boundary")
+        self.run_until(SLOTS - 1.0)
+        self.assertEqual(self.calls, [])
+        self.run_until(float(SLOTS))
+        self.assertEqual(self.calls, ["boundary"])
+
+    def test_cancelled_timers_do_not_fire(self):
+        handle = self.schedule(3.5, "a")
+        handle.cancel()
+        self.run_until(10.0)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.wheel.stats()["cancelled"], 1)
+        self.assertTrue(handle.done)
+
+    def test_interval(self):
+        handle = self.schedule(10.5, "tick", interval=10)
+        for now in range(1, 41):
+            self.run_until(float(now))
+        self.assertEqual(self.calls, ["tick"] * 3)
+        self.assertEqual(handle.when, 40.5)
+
+    def test_due_timer_fires_on_next_tick(self):
+        self.run_until(10.0)
+        self.schedule(3.0, "late")
+        self.run_until(11.0)
+        self.assertEqual(self.calls, ["late"])
+
+    def test_catch_up_without_coalescing(self):
+        self.schedule(0.5, "tick", interval=1, coalesce=0)
+        self.run_until(10.0)
+        self.assertEqual(self.calls, ["tick"])
+        # each missed run is due at once, so one fires per tick
+        self.run_until(11.0)
+        self.run_until(12.0)
+        self.assertEqual(self.calls, ["tick"] * 3)
+
+    def test_coalesced_interval_skips_missed_runs(self):
+        handle = self.schedule(0.5, "tick", interval=2)
+        self.run_until(10.0)
+        self.assertEqual(handle.when, 12.0)
+        self.run_until(12.0)
+        self.assertEqual(self.calls, ["tick"])
+        self.run_until(13.0)
+        self.assertEqual(self.calls, ["tick", "tick"])
+
+    def test_running_coalesced_timer_is_skipped(self):
+        calls = []
+        handle = TimerHandle(self.wheel, 1.5, calls.append, ("tick",), {}, 1)
+        self.wheel.dispatch = lambda call, network=None: calls.append("dispatched")
+        self.wheel.schedule(handle)
+        self.run_until(2.0)
+        # still running, as the dispatched call never ran
+        self.run_until(3.0)
+        self.assertEqual(calls, ["dispatched"])
+        self.assertEqual(handle.skipped, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import imp
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from midori.timers import TimerWheel
+from midori.workers import ThreadPool
+
+REPO = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+try:
+    tweeter = imp.load_source("tweeter", os.path.join(REPO, "extensions", "tweeter.py"))
+except ImportError:
+    # needs tweepy (and the HTMLParser module of Python 2)
+    tweeter = None
+
+INSERT = "INSERT INTO links (source, artoday, archived) VALUES (?, ?, ?)"
+
+@unittest.skipIf(tweeter is None, "the tweeter extension's dependencies are not installed")
+class DatabaseWriterTest(unittest.TestCase):
+    def setUp(self):
+        # connect_db() opens archived_stuff.db in the current directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="midori-tweeter-")
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def count_rows(self):
+        connection = sqlite3.connect("archived_stuff.db")
+        try:
+            return connection.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_burst_is_written_in_batches(self):
+        writer = tweeter.DatabaseWriter(batch_size=200, batch_ms=50)
+        for i in range(1000):
+            writer.write(INSERT, ("https://example.com/{0}".format(i), None, None))
+        writer.start()
+        writer.close()
+        self.assertEqual(writer.rows_written, 1000)
+        self.assertEqual(writer.batches, 5)
+        self.assertEqual(self.count_rows(), 1000)
+
+    def test_close_flushes_pending_rows(self):
+        # rows still waiting for their batch window are written by close()
+        writer = tweeter.DatabaseWriter(batch_size=200, batch_ms=60000)
+        writer.start()
+        for i in range(10):
+            writer.write(INSERT, ("https://example.com/{0}".format(i), None, None))
+        writer.close()
+        self.assertEqual(writer.rows_written, 10)
+        self.assertEqual(self.count_rows(), 10)
+
+    def test_failed_batch_is_dropped(self):
+        writer = tweeter.DatabaseWriter(batch_size=200, batch_ms=50)
+        writer.write("INSERT INTO missing VALUES (?)", (1,))
+        writer.write(INSERT, ("https://example.com/", None, None))
+        writer.start()
+        writer.close()
+        self.assertEqual(writer.rows_written, 0)
+        self.assertEqual(writer.batches, 0)
+        self.assertEqual(self.count_rows(), 0)
+
+class FakeTwitterUser(object):
+    def __init__(self, id_str, screen_name):
+        self.id_str = id_str
+        self.screen_name = screen_name
+
+class FakeTwitterAPI(object):
+    USERS = [FakeTwitterUser("1", "Alice"), FakeTwitterUser("2", "bob")]
+
+    def __init__(self):
+        self.calls = []
+
+    def lookup_users(self, user_ids=None, screen_names=None):
+        self.calls.append((user_ids, screen_names))
+        return [u for u in self.USERS
+                if u.id_str in (user_ids or ()) or u.screen_name.lower() in (screen_names or ())]
+
+@unittest.skipIf(tweeter is None, "the tweeter extension's dependencies are not installed")
+class UserResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="midori-tweeter-")
+        os.chdir(self.directory)
+        self.database = tweeter.connect_db()
+        self.writer = tweeter.DatabaseWriter()
+        self.writer.start()
+        # one pool thread, like a bot whose every worker runs a command
+        self.pool = ThreadPool(1)
+        self.timers = TimerWheel(self.pool.dispatch, resolution=0.01)
+        self.timers.start()
+        self.twapi = FakeTwitterAPI()
+        self.resolver = tweeter.UserResolver(
+            self.twapi, self.database, threading.RLock(), self.writer,
+            tweeter.TTLCache(100, 60), 60, self.timers.call_later, window_ms=50, timeout=5)
+
+    def tearDown(self):
+        self.timers.stop()
+        self.pool.stop()
+        self.writer.close()
+        self.database.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def on_pool(self, call, *args):
+        """Run call on the pool thread and return its result."""
+        result = []
+        done = threading.Event()
+        def task():
+            try:
+                result.append(call(*args))
+            finally:
+                done.set()
+        self.pool.dispatch(task)
+        self.assertTrue(done.wait(10))
+        return result[0]
+
+    def test_resolves_from_a_pool_thread(self):
+        started = time.time()
+        user = self.on_pool(self.resolver.by_name, "alice")
+        self.assertEqual(user, tweeter.TwitterUser("1", "Alice"))
+        # well within the timeout: the waiting caller flushed the batch itself
+        self.assertTrue(time.time() - started < 2)
+
+    def test_lookups_are_batched_and_cached(self):
+        self.resolver.prefetch(["1", "2"])
+        users = self.on_pool(self.resolver.by_ids, ["1", "2", "3"])
+        self.assertEqual([u.screen_name for u in users], ["Alice", "bob"])
+        self.assertEqual(self.twapi.calls, [(["1", "2", "3"], None)])
+        self.assertEqual(self.resolver.by_name("BOB"), tweeter.TwitterUser("2", "bob"))
+        self.assertEqual(len(self.twapi.calls), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from midori.workers import SheddingQueue, SHED_FIRST, SHED_LATE, SHED_NEVER
+
+def rank(item):
+    """Items are (rank, name) pairs."""
+    return item[0]
+
+def make_queue(maxsize, shed_rank=rank):
+    shed = []
+    q = SheddingQueue("test", maxsize, shed_rank, lambda queue, item: shed.append(item))
+    return q, shed
+
+def drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+    return items
+
+class SheddingQueueTest(unittest.TestCase):
+    def test_fifo_across_ranks(self):
+        q, shed = make_queue(0)
+        items = [(SHED_FIRST, "a"), (SHED_NEVER, "b"), (SHED_LATE, "c"), (SHED_FIRST, "d")]
+        for item in items:
+            self.assertTrue(q.put(item))
+        self.assertEqual(drain(q), items)
+
+    def test_evicts_oldest_of_highest_rank(self):
+        q, shed = make_queue(4)
+        for item in [(SHED_LATE, "l1"), (SHED_FIRST, "f1"), (SHED_FIRST, "f2"),
+                     (SHED_NEVER, "n1")]:
+            q.put(item)
+        self.assertTrue(q.put((SHED_NEVER, "n2")))
+        self.assertTrue(q.put((SHED_LATE, "l2")))
+        self.assertEqual(shed, [(SHED_FIRST, "f1"), (SHED_FIRST, "f2")])
+        # with no SHED_FIRST left, a SHED_NEVER item evicts the SHED_LATE one
+        self.assertTrue(q.put((SHED_NEVER, "n3")))
+        self.assertEqual(shed[-1], (SHED_LATE, "l1"))
+        self.assertEqual([name for r, name in drain(q)], ["n1", "n2", "l2", "n3"])
+        self.assertEqual(q.stats()["dropped"], 3)
+
+    def test_refuses_item_without_lower_ranked_victim(self):
+        q, shed = make_queue(2)
+        q.put((SHED_LATE, "l1"))
+        q.put((SHED_FIRST, "f1"))
+        self.assertFalse(q.put((SHED_FIRST, "f2")))
+        self.assertEqual(shed, [(SHED_FIRST, "f2")])
+        # a SHED_LATE item still evicts the SHED_FIRST one
+        self.assertTrue(q.put((SHED_LATE, "l2")))
+        self.assertEqual(shed[-1], (SHED_FIRST, "f1"))
+        self.assertFalse(q.put((SHED_LATE, "l3")))
+        self.assertEqual([name for r, name in drain(q)], ["l1", "l2"])
+
+    def test_shed_never_grows_past_bound(self):
+        q, shed = make_queue(2)
+        for i in range(5):
+            self.assertTrue(q.put((SHED_NEVER, i)))
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(q.stats()["peak"], 5)
+        self.assertEqual(shed, [])
+        # until it drains below the bound, droppable items are refused
+        self.assertFalse(q.put((SHED_FIRST, "f")))
+        self.assertEqual([name for r, name in drain(q)], [0, 1, 2, 3, 4])
+
+    def test_none_is_an_item(self):
+        q, shed = make_queue(1, lambda item: SHED_FIRST)
+        self.assertTrue(q.put(None))
+        self.assertEqual(q.qsize(), 1)
+        self.assertFalse(q.put(None))
+        self.assertEqual(shed, [None])
+        self.assertIsNone(q.get_nowait())
+        self.assertTrue(q.empty())
+
+    def test_none_can_be_evicted(self):
+        q, shed = make_queue(1, lambda item: SHED_FIRST if item is None else SHED_NEVER)
+        q.put(None)
+        self.assertTrue(q.put("protocol"))
+        self.assertEqual(shed, [None])
+        self.assertEqual(drain(q), ["protocol"])
+
+if __name__ == "__main__":
+    unittest.main()
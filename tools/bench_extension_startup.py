@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import benchlib
+sys.path.insert(0, benchlib.REPO)
+import midori.extloader
+
+"""
+Time ExtensionManager startup with many extensions, in process.
+N dummy extensions are generated (see benchlib.write_extensions), along with a
+stand-in for midori.base that they depend on, and a fresh ExtensionManager
+loads them all:
+    cold     no manifest cache: every file is read and hashed
+    warm     the manifest cache from the previous run, files unchanged
+    touched  the cache, but every file's mtime has changed, so each is
+             hashed again and matches
+"total" is the time to construct the manager (reading the cache) and run
+load_extensions, which imports and constructs the extensions, and "scan" is
+the part of it spent reading manifests. With --lazy the extensions declare
+triggers and stay dormant instead.
+
+    python3 tools/bench_extension_startup.py --extensions 50 --runs 5
+"""
+
+BASE_EXTENSION = '''class Base(object):
+    def __init__(self, api, config):
+        pass
+
+__identifier__ = "midori.base"
+__dependencies__ = []
+__version__ = "1.0"
+__ext_class__ = Base
+'''
+
+class BenchAPI(object):
+    """What the dummy extensions use of midori.api.API."""
+    def hook_command(self, context, callback, predicate):
+        pass
+
+    def privmsg(self, target, message):
+        pass
+
+def preload(mod):
+    return (BenchAPI(), {})
+
+def lazy_callback(ext_id, manifest):
+    pass
+
+def forget_modules():
+    for name in [n for n in sys.modules if n.startswith("pbx.")]:
+        del sys.modules[name]
+
+def load(directory, cache, lazy):
+    forget_modules()
+    began = time.time()
+    manager = midori.extloader.ExtensionManager(search_dirs=[directory], manifest_cache=cache)
+    scans = []
+    scan_dirs = manager.scan_dirs
+    def timed_scan():
+        started = time.time()
+        try:
+            return scan_dirs()
+        finally:
+            scans.append(time.time() - started)
+    manager.scan_dirs = timed_scan
+    manager.load_extensions(preload, lazy_callback if lazy else None)
+    return sum(scans), time.time() - began, manager
+
+def touch(directory):
+    later = time.time() + 10
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name), (later, later))
+
+def measure(count, import_cost, lazy, runs):
+    directory = tempfile.mkdtemp(prefix="midori-extbench-")
+    extensions = os.path.join(directory, "extensions")
+    cache = os.path.join(directory, "manifests.json")
+    results = {"cold": [], "warm": [], "touched": []}
+    try:
+        benchlib.write_extensions(extensions, count, import_cost, lazy)
+        with open(os.path.join(extensions, "base.py"), "w") as f:
+            f.write(BASE_EXTENSION)
+        for i in range(runs):
+            if os.path.exists(cache):
+                os.remove(cache)
+            scanned, total, manager = load(extensions, cache, lazy)
+            if manager.count() + len(manager.dormant) != count + 1:
+                raise RuntimeError("loaded {0} of {1} extensions".format(
+                    manager.count() + len(manager.dormant), count + 1))
+            results["cold"].append((scanned, total))
+            scanned, total, manager = load(extensions, cache, lazy)
+            results["warm"].append((scanned, total))
+            touch(extensions)
+            scanned, total, manager = load(extensions, cache, lazy)
+            results["touched"].append((scanned, total))
+    finally:
+        forget_modules()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    logging.getLogger("midori").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Time ExtensionManager startup.")
+    parser.add_argument("--extensions", type=int, default=50)
+    parser.add_argument("--import-cost", type=int, default=2000,
+                        help="table rows each extension builds at import")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--lazy", action="store_true",
+                        help="extensions declare triggers and are loaded on demand")
+    args = parser.parse_args()
+    results = measure(args.extensions, args.import_cost, args.lazy, args.runs)
+    print("{0} extensions{1}, median of {2} runs".format(
+        args.extensions, " (lazy)" if args.lazy else "", args.runs))
+    print("{0:8} {1:>10} {2:>10}".format("cache", "scan", "total"))
+    for kind in ("cold", "warm", "touched"):
+        print("{0:8} {1:>9.1f}ms {2:>9.1f}ms".format(
+            kind, median(r[0] for r in results[kind]) * 1000,
+            median(r[1] for r in results[kind]) * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import benchlib
+
+"""
+Command throughput and memory of a bot with and without shards.
+For each shard count (0 runs the extensions in the bot's own process) a bot
+with --extensions dummy extensions joins --channels channels on a local fake
+server, which then sends --messages commands spread over the channels and
+many senders, all at once. Each command costs --work rounds of sha1 in its
+extension. Reported are the commands answered per second, from the first
+one sent to the last reply, and the resident memory of the bot and its
+shard processes afterwards.
+Flood checks and admission control are turned off, so every command is
+answered.
+
+    python3 tools/bench_shards.py --shards 0 1 2 4 --messages 4000
+"""
+
+def is_reply(line):
+    return line.startswith("PRIVMSG") and " :dummy" in line and not line.endswith(" warm")
+
+def measure(shards, args):
+    directory = tempfile.mkdtemp(prefix="midori-shards-")
+    server = benchlib.FakeServer()
+    channels = ["#bench{0}".format(i) for i in range(args.channels)]
+    try:
+        benchlib.write_extensions(os.path.join(directory, "extensions"), args.extensions,
+                                  import_cost=0, work=args.work)
+        benchlib.write_config(directory, server.port, channels=channels,
+                              extension_lazy_load=0,
+                              workers_size=args.workers,
+                              shards={"count": shards},
+                              flood={"channel_rate": 10 ** 9, "suppress_repeats": 0},
+                              admission={"enabled": 0},
+                              queues={"read": 10 ** 6, "workers": 10 ** 6,
+                                      "write": 10 ** 6})
+        process = benchlib.spawn_bot(directory)
+        try:
+            joined = server.wait_for(lambda line: line.startswith("JOIN") and
+                                     channels[-1] in line.split()[1].split(","))
+            if joined is None:
+                raise RuntimeError("the bot didn't join; see {0}".format(
+                    os.path.join(directory, "midori.log")))
+            # let it handle the JOINs before talking in the channels
+            time.sleep(args.settle)
+            # one command per extension, so every shard is up
+            warmup = [":warm!u@h PRIVMSG {0} :!dummy{1} warm".format(channels[0], i)
+                      for i in range(args.extensions)]
+            server.send_many(warmup)
+            if server.wait_for(lambda line: line.endswith(" warm"), timeout=120,
+                               count=len(warmup)) is None:
+                raise RuntimeError("the bot didn't answer; see {0}".format(
+                    os.path.join(directory, "midori.log")))
+            lines = [":user{0}!u@host{0} PRIVMSG {1} :!dummy{2} m{0}".format(
+                i, channels[i % len(channels)], i % args.extensions)
+                for i in range(args.messages)]
+            began = time.time()
+            server.send_many(lines)
+            done = server.wait_for(is_reply, timeout=args.timeout, count=args.messages)
+            answered = len([1 for t, line in server.lines if is_reply(line)])
+            return {
+                "rate": args.messages / (done - began) if done else None,
+                "answered": answered,
+                "rss": benchlib.tree_rss_kb(process.pid),
+                "processes": 1 + len(benchlib.children(process.pid)),
+            }
+        finally:
+            benchlib.stop_bot(process)
+    finally:
+        server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput with shards.")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--extensions", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=4000)
+    parser.add_argument("--work", type=int, default=2000,
+                        help="sha1 rounds per command")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="worker threads per process")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to wait after joining")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    print("{0} commands over {1} channels, {2} sha1 rounds each".format(
+        args.messages, args.channels, args.work))
+    print("{0:>6} {1:>10} {2:>10} {3:>10} {4:>10}".format("shards", "processes", "cmds/s",
+                                                          "answered", "RSS"))
+    for shards in args.shards:
+        result = measure(shards, args)
+        rss = result["rss"]
+        print("{0:>6} {1:>10} {2:>10} {3:>10} {4:>10}".format(
+            shards, result["processes"],
+            "{0:.0f}".format(result["rate"]) if result["rate"] else "timeout",
+            result["answered"], "{0:.1f}MB".format(rss / 1024.0) if rss else "n/a"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+"""
+Helpers shared by the scripts in tools/: throwaway bot directories filled with
+generated extensions, just enough of an IRC server to register a bot against,
+and memory readings for a process and its children.
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+EXTENSION_TEMPLATE = '''import hashlib
+import midori
+
+# stands in for the imports and tables a real extension builds at import time
+TABLE = [hashlib.sha1(str(i).encode("ascii")).hexdigest() for i in range({import_cost})]
+# rounds of hashing per reply, standing in for the work of handling a command
+WORK = {work}
+
+class Dummy(object):
+    def __init__(self, api, config):
+        self.api = api
+        api.hook_command(midori.CONTEXT_ALL, self.reply,
+                         lambda cmd: cmd.message.startswith("!dummy{index} "))
+
+    def start(self):
+        pass
+
+    def reply(self, cmd):
+        digest = cmd.message.encode("utf-8")
+        for i in range(WORK):
+            digest = hashlib.sha1(digest).digest()
+        self.api.privmsg(cmd.channel or cmd.sender, "dummy{index} " + cmd.message.split()[-1])
+
+__identifier__ = "bench.dummy{index}"
+__dependencies__ = ["midori.base"]
+__version__ = "1.0"
+__ext_class__ = Dummy
+{triggers}'''
+
+def write_extensions(directory, count, import_cost=2000, lazy=0, work=0):
+    """Write count dummy extensions, bench.dummy0 to bench.dummyN, into
+       directory. Extension i answers "!dummy<i> <word>" with "dummy<i> <word>",
+       after work rounds of sha1. With lazy, each declares its command as a
+       trigger."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for i in range(count):
+        triggers = ""
+        if lazy:
+            triggers = '__triggers__ = {{"commands": ["!dummy{0} "]}}\n'.format(i)
+        with open(os.path.join(directory, "dummy{0}.py".format(i)), "w") as f:
+            f.write(EXTENSION_TEMPLATE.format(index=i, import_cost=import_cost,
+                                              work=work, triggers=triggers))
+
+def write_config(directory, port, **overrides):
+    """Write a config.json for a bot connecting to 127.0.0.1:port."""
+    config = {
+        "identity": {"nick": "bench", "user": "bench", "real_name": "bench"},
+        "server": {"host": "127.0.0.1", "port": port, "use_ssl": False},
+        "bind_addr": "127.0.0.1",
+        "channels": ["#bench"],
+        "modes": "+i",
+        "extension_autoreload": 0,
+    }
+    config.update(overrides)
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+
+def spawn_bot(directory):
+    """Start midori.py in directory, logging to a file there."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO + os.pathsep + env.get("PYTHONPATH", "")
+    env["__MIDORI_SHOULD_LOG_TO_THIS_FILE__"] = os.path.join(directory, "midori.log")
+    return subprocess.Popen([sys.executable, os.path.join(REPO, "midori.py"), "config.json"],
+                            cwd=directory, env=env)
+
+def stop_bot(process, timeout=10):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except Exception:
+        process.kill()
+        process.wait()
+
+def rss_kb(pid):
+    """Resident memory of a process in kB, or None where /proc isn't available."""
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        return None
+    return None
+
+def children(pid):
+    """Return the pids of pid's child processes (Linux only)."""
+    found = []
+    try:
+        names = os.listdir("/proc")
+    except OSError:
+        return found
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(name)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(name))
+    return found
+
+def tree_rss_kb(pid):
+    """Resident memory of a process and its children in kB, or None."""
+    total = rss_kb(pid)
+    if total is None:
+        return None
+    for child in children(pid):
+        total += rss_kb(child) or 0
+    return total
+
+class FakeServer(object):
+    """Just enough of an IRC server for benchmarks: it welcomes a client
+       after USER, answers PINGs and echoes JOINs. Every line received is
+       recorded with the time it arrived."""
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.lines = []
+        self.conn = None
+        self.nick = "bench"
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while 1:
+            try:
+                conn, addr = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            self.conn = conn
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        buf = b""
+        while 1:
+            try:
+                data = conn.recv(65536)
+            except (socket.error, OSError):
+                return
+            if not data:
+                return
+            buf += data
+            while b"\r\n" in buf:
+                raw, buf = buf.split(b"\r\n", 1)
+                line = raw.decode("utf-8", "replace")
+                with self.condition:
+                    self.lines.append((time.time(), line))
+                    self.condition.notify_all()
+                self.respond(line)
+
+    def respond(self, line):
+        words = line.split()
+        if not words:
+            return
+        if words[0] == "NICK":
+            self.nick = words[1].lstrip(":")
+        elif words[0] == "USER":
+            self.send(":fake.server 001 {0} :Welcome".format(self.nick))
+        elif words[0] == "PING":
+            self.send(":fake.server PONG fake.server {0}".format(words[-1]))
+        elif words[0] == "JOIN":
+            for channel in words[1].split(","):
+                self.send(":{0}!bench@127.0.0.1 JOIN {1}".format(self.nick, channel))
+                self.send(":fake.server 353 {0} = {1} :{0} user".format(self.nick, channel))
+
+    def send(self, line):
+        self.send_many([line])
+
+    def send_many(self, lines):
+        self.conn.sendall("".join(l + "\r\n" for l in lines).encode("utf-8"))
+
+    def wait_for(self, predicate, timeout=60, count=1):
+        """Wait until count received lines match predicate(line). Returns the
+           time the last of them arrived, or None on timeout."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while 1:
+                matched = [t for t, line in self.lines if predicate(line)]
+                if len(matched) >= count:
+                    return matched[count - 1]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def close(self):
+        self.sock.close()
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import benchlib
+
+"""
+Time to 001 and resident memory of a bot with many extensions, loaded eagerly
+and on demand (__triggers__).
+A bot is started against a local fake server. "connect" is the time from
+starting the process until the server receives NICK, and "ready" is the time
+until the bot answers 001 (its user MODE), both of which wait for extension
+loading. RSS is read once the bot has settled, and again after one on-demand
+extension has been triggered.
+
+    python3 tools/measure_startup.py --extensions 50 --runs 3
+"""
+
+def measure(count, import_cost, lazy, settle):
+    directory = tempfile.mkdtemp(prefix="midori-startup-")
+    server = benchlib.FakeServer()
+    try:
+        benchlib.write_extensions(os.path.join(directory, "extensions"), count, import_cost,
+                                  lazy)
+        benchlib.write_config(directory, server.port, extension_lazy_load=int(lazy))
+        began = time.time()
+        process = benchlib.spawn_bot(directory)
+        try:
+            connected = server.wait_for(lambda line: line.startswith("NICK"))
+            ready = server.wait_for(lambda line: line.startswith("MODE"))
+            if connected is None or ready is None:
+                raise RuntimeError("the bot didn't register; see {0}".format(
+                    os.path.join(directory, "midori.log")))
+            time.sleep(settle)
+            rss = benchlib.rss_kb(process.pid)
+            server.send(":user!u@h PRIVMSG #bench :!dummy0 ping")
+            server.wait_for(lambda line: line.endswith("dummy0 ping"), timeout=30)
+            triggered_rss = benchlib.rss_kb(process.pid)
+            return {
+                "connect": connected - began,
+                "ready": ready - began,
+                "rss": rss,
+                "rss_triggered": triggered_rss,
+            }
+        finally:
+            benchlib.stop_bot(process)
+    finally:
+        server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def show(value, unit):
+    if value is None:
+        return "n/a"
+    if unit == "s":
+        return "{0:.3f}s".format(value)
+    return "{0:.1f}MB".format(value / 1024.0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time to 001 and RSS.")
+    parser.add_argument("--extensions", type=int, default=50)
+    parser.add_argument("--import-cost", type=int, default=2000,
+                        help="table rows each extension builds at import")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to wait after 001 before reading RSS")
+    args = parser.parse_args()
+    print("{0} extensions, best of {1} runs".format(args.extensions, args.runs))
+    print("{0:8} {1:>9} {2:>9} {3:>10} {4:>10}".format("mode", "connect", "ready", "RSS",
+                                                       "RSS+1"))
+    for lazy in (0, 1):
+        runs = [measure(args.extensions, args.import_cost, lazy, args.settle)
+                for i in range(args.runs)]
+        best = min(runs, key=lambda r: r["ready"])
+        print("{0:8} {1:>9} {2:>9} {3:>10} {4:>10}".format(
+            "lazy" if lazy else "eager", show(best["connect"], "s"), show(best["ready"], "s"),
+            show(best["rss"], "kB"), show(best["rss_triggered"], "kB")))
+
+if __name__ == "__main__":
+    main()